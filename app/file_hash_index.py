@@ -0,0 +1,56 @@
+import os
+import sqlite3
+import threading
+
+
+class FileHashIndex:
+    """
+    Persistent index of file content hashes, used to tell if an upload is a duplicate of a file that
+    already exists without reading that file again. Entries are keyed by absolute path and only trusted
+    while the size and modification time of the file are unchanged.
+    """
+    def __init__(self, path, hasher, hasher_name):
+        self.hasher = hasher
+        self.hasher_name = hasher_name
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS file_hashes (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            algorithm TEXT NOT NULL,
+            digest TEXT NOT NULL)""")
+
+    def set(self, path, digest):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, algorithm, digest) VALUES (?, ?, ?, ?, ?)",
+                                    (path, st.st_size, st.st_mtime_ns, self.hasher_name, digest))
+
+    def digest(self, path):
+        """Returns the content hash of the file at path, only hashing it if it isn't indexed or has changed since."""
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime_ns, algorithm, digest FROM file_hashes WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns and row[2] == self.hasher_name:
+            return row[3]
+
+        h = self.hasher()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, algorithm, digest) VALUES (?, ?, ?, ?, ?)",
+                                    (path, st.st_size, st.st_mtime_ns, self.hasher_name, digest))
+        return digest
+
+    def remove(self, path):
+        with self.lock:
+            self.connection.execute("DELETE FROM file_hashes WHERE path = ?", (os.path.abspath(path),))
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import logging
+import threading
+import traceback
+import uuid
+
+import folder_paths
+
+
+# Modules of the nodes that come with ComfyUI, they look up the filesystem through folder_paths
+BUILTIN_MODULE = "nodes"
+BUILTIN_PACKAGE = "comfy_extras."
+
+
+def cacheable(obj_class, dependencies):
+    """
+    Whether the definition of a node can be kept until its dependencies change. Custom nodes that looked up nothing
+    through folder_paths may list files some other way, they are only kept if they set CACHEABLE_INPUT_TYPES.
+    """
+    if dependencies or getattr(obj_class, "CACHEABLE_INPUT_TYPES", False):
+        return True
+    module = getattr(obj_class, "RELATIVE_PYTHON_MODULE", BUILTIN_MODULE)
+    return module == BUILTIN_MODULE or module.startswith(BUILTIN_PACKAGE)
+
+
+class NodeEntry:
+    def __init__(self, obj_class, data, dependencies, generation, cacheable=True):
+        self.obj_class = obj_class
+        # The serialized node_info
+        self.data = data
+        # Version of each folder or directory INPUT_TYPES looked up
+        self.dependencies = dependencies
+        self.generation = generation
+        # False if the node info has to be computed again every time
+        self.cacheable = cacheable
+
+
+class ObjectInfoCache:
+    """
+    The node definitions of /object_info, serialized once per node and kept until the node class changes or one of
+    the model folders or directories it looked up changes (see folder_paths.DependencyRecorder and cacheable). Every
+    change bumps the generation: the full document is only rebuilt after changes and clients that have the document
+    of an older version can fetch only the nodes that changed since.
+    """
+    def __init__(self, node_info):
+        self.node_info = node_info
+        self.lock = threading.Lock()
+        # Versions of an earlier run of the server don't apply
+        self.instance = uuid.uuid4().hex[:8]
+        self.generation = 0
+        self.entries: dict[str, NodeEntry] = {}
+        # Generation each node was removed at
+        self.removed: dict[str, int] = {}
+        self.document = None
+        self.etag = None
+
+    def version(self):
+        return "{}-{}".format(self.instance, self.generation)
+
+    def parse_version(self, version):
+        """The generation of a version of this instance, None if it is from another one."""
+        instance, _, generation = version.partition("-")
+        if instance != self.instance:
+            return None
+        try:
+            generation = int(generation)
+        except ValueError:
+            return None
+        return generation if generation <= self.generation else None
+
+    def up_to_date(self, entry, obj_class, versions):
+        if entry.obj_class is not obj_class or not entry.cacheable:
+            return False
+        for dependency, version in entry.dependencies.items():
+            if dependency not in versions:
+                versions[dependency] = folder_paths.dependency_version(dependency)
+            if versions[dependency] != version:
+                return False
+        return True
+
+    def refresh_node(self, name, obj_class, versions):
+        """Updates the entry of a node if it is out of date, returns True if its definition changed."""
+        entry = self.entries.get(name, None)
+        if entry is not None and self.up_to_date(entry, obj_class, versions):
+            return False
+
+        try:
+            with folder_paths.dependency_recorder.record() as recorded:
+                data = json.dumps(self.node_info(name)).encode("utf-8")
+        except Exception:
+            logging.error(f"[ERROR] An error occurred while retrieving information for the '{name}' node.")
+            logging.error(traceback.format_exc())
+            if entry is not None:
+                self.remove(name)
+                return True
+            return False
+
+        dependencies = {}
+        for dependency in recorded:
+            if dependency not in versions:
+                versions[dependency] = folder_paths.dependency_version(dependency)
+            dependencies[dependency] = versions[dependency]
+
+        if entry is not None and entry.data == data:
+            entry.obj_class = obj_class
+            entry.dependencies = dependencies
+            entry.cacheable = cacheable(obj_class, dependencies)
+            return False
+        self.generation += 1
+        self.entries[name] = NodeEntry(obj_class, data, dependencies, self.generation, cacheable(obj_class, dependencies))
+        self.removed.pop(name, None)
+        return True
+
+    def remove(self, name):
+        self.generation += 1
+        self.entries.pop(name, None)
+        self.removed[name] = self.generation
+
+    def refresh(self, node_class_mappings):
+        """Brings the entries up to date with node_class_mappings."""
+        versions = {}
+        changed = False
+        with folder_paths.cache_helper:
+            for name, obj_class in node_class_mappings.items():
+                changed |= self.refresh_node(name, obj_class, versions)
+        for name in list(self.entries):
+            if name not in node_class_mappings:
+                self.remove(name)
+                changed = True
+
+        if changed or self.document is None:
+            parts = [json.dumps(name).encode("utf-8") + b": " + self.entries[name].data for name in node_class_mappings if name in self.entries]
+            self.document = b"{" + b", ".join(parts) + b"}"
+            self.etag = '"{}"'.format(hashlib.sha256(self.document).hexdigest()[:32])
+
+    def get(self, node_class_mappings):
+        """The object_info document of all the nodes as json bytes, its etag and version."""
+        with self.lock:
+            self.refresh(node_class_mappings)
+            return self.document, self.etag, self.version()
+
+    def get_changes(self, node_class_mappings, since):
+        """
+        The changes since the version since as json bytes: the definitions of the nodes that were added or changed
+        and the names of the ones that were removed. None if since isn't a version of this instance, the client
+        needs the full document.
+        """
+        with self.lock:
+            self.refresh(node_class_mappings)
+            generation = self.parse_version(since)
+            if generation is None:
+                return None
+            changed = [json.dumps(name).encode("utf-8") + b": " + entry.data for name, entry in self.entries.items() if entry.generation > generation]
+            removed = [name for name, removed_at in self.removed.items() if removed_at > generation]
+            header = json.dumps({"version": self.version(), "removed": removed})
+            return header[:-1].encode("utf-8") + b', "nodes": {' + b", ".join(changed) + b"}}"
+
+    def get_node(self, node_class_mappings, name):
+        """The object_info document of one node as json bytes."""
+        with self.lock:
+            with folder_paths.cache_helper:
+                if self.refresh_node(name, node_class_mappings[name], {}):
+                    # The full document has to be rebuilt
+                    self.document = None
+            entry = self.entries.get(name, None)
+            if entry is None:
+                return b"{}"
+            return b"{" + json.dumps(name).encode("utf-8") + b": " + entry.data + b"}"
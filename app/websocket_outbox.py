@@ -0,0 +1,62 @@
+import asyncio
+import collections
+import logging
+
+import aiohttp
+
+# Messages queued for a single client before stale progress and preview messages start getting dropped
+OUTBOX_SIZE = 64
+
+
+class WebSocketOutbox:
+    """
+    Outgoing messages of a single websocket client, sent by their own task so a slow client
+    never holds up the others.
+    Messages are queued already encoded. Messages queued with a coalesce key replace any older
+    unsent message with the same key and once the outbox is full they are dropped instead of queued,
+    everything else is always delivered.
+    """
+    def __init__(self, ws, max_size=OUTBOX_SIZE):
+        self.ws = ws
+        self.max_size = max_size
+        self.pending = collections.deque()
+        self.ready = asyncio.Event()
+        self.task = None
+        self.dropped = 0
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def put(self, message, coalesce_key=None):
+        """message is a str sent as text or bytes sent as binary."""
+        if coalesce_key is not None:
+            for i, (key, _) in enumerate(self.pending):
+                if key == coalesce_key:
+                    del self.pending[i]
+                    self.dropped += 1
+                    break
+            else:
+                if len(self.pending) >= self.max_size:
+                    self.dropped += 1
+                    return
+        self.pending.append((coalesce_key, message))
+        self.ready.set()
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while len(self.pending) > 0:
+                _, message = self.pending.popleft()
+                try:
+                    if isinstance(message, str):
+                        await self.ws.send_str(message)
+                    else:
+                        await self.ws.send_bytes(message)
+                except (aiohttp.ClientError, aiohttp.ClientPayloadError, ConnectionResetError, BrokenPipeError, ConnectionError) as err:
+                    logging.warning("send error: {}".format(err))
@@ -0,0 +1,90 @@
+"""
+Chunked work that adapts its chunk size to running out of memory.
+
+Work split in chunks sized from a memory estimate (VAE batches, upscale model tiles, cond batches) used to start
+over with a fallback when a chunk ran out of memory, throwing away the chunks that were done. run_chunks instead
+keeps them, halves the chunk size and goes on from the chunk that failed. The size that works is remembered per
+(model instance, shape, dtype, device) so later calls start with it instead of running out of memory again, until
+more memory is free than when it was learnt.
+"""
+import collections
+import logging
+import threading
+
+import torch
+
+import comfy.model_management
+
+# A learnt size stops applying once this much more memory is free than when it was learnt
+FORGET_FREE_RATIO = 1.25
+
+SizeKey = collections.namedtuple("SizeKey", ["model", "shape", "dtype", "device"])
+
+size_limits = {}
+size_limits_lock = threading.Lock()
+
+
+def size_key(model, shape, dtype, device):
+    """
+    Key of the learnt chunk sizes of model on inputs of shape (without the dim that is chunked). Models of the same
+    class can need very different amounts of memory (an SD1.5 and an SDXL UNet) so the key is the model instance.
+    """
+    return SizeKey(id(model), tuple(shape), str(dtype), torch.device(device))
+
+
+def free_memory(key):
+    return comfy.model_management.get_free_memory(key.device)
+
+
+def limit(key, size):
+    """size, or less if chunks of key ran out of memory before with about as much memory free."""
+    if key is None:
+        return size
+    with size_limits_lock:
+        learnt = size_limits.get(key, None)
+    if learnt is None:
+        return size
+    learnt_size, learnt_free = learnt
+    if free_memory(key) > learnt_free * FORGET_FREE_RATIO:
+        with size_limits_lock:
+            size_limits.pop(key, None)
+        return size
+    return min(size, learnt_size)
+
+
+def shrink(key, size):
+    """The size to retry with after a chunk of size ran out of memory, remembered for key."""
+    size = max(1, (size + 1) // 2)
+    if key is not None:
+        with size_limits_lock:
+            size_limits[key] = (size, free_memory(key))
+    return size
+
+
+def run_chunks(fn, total, size, key=None):
+    """
+    Processes range(total) with fn(start, size), a generator that processes range(start, total) in chunks of at most
+    size items and yields the end of each chunk once it is done. When a chunk runs out of memory fn is started again
+    from the end of the last chunk that was done with half the size, the error is raised when a chunk of one item
+    runs out of memory. Returns the last size used.
+
+    A chunk that ran out of memory is run again, so fn must not change its outputs before all the allocations of
+    the chunk are done.
+    """
+    size = max(1, limit(key, size))
+    done = 0
+    while True:
+        oom = False
+        try:
+            for done in fn(done, size):
+                pass
+        except comfy.model_management.OOM_EXCEPTION:
+            if min(size, total - done) <= 1:
+                raise
+            oom = True
+        if not oom:
+            return size
+        # Outside of the except block so the memory held by the traceback is freed
+        comfy.model_management.soft_empty_cache()
+        size = shrink(key, min(size, total - done))
+        logging.warning("Ran out of memory, retrying the remaining {} of {} items in chunks of {}.".format(total - done, total, size))
@@ -0,0 +1,204 @@
+"""
+Pipelined processing of large batches in chunks (used by the VAE).
+
+Running a model on a batch one chunk at a time with plain .to() calls serializes everything: the chunk is copied to
+the GPU, processed, and its output copied back before the next chunk starts. On CUDA, when the inputs and outputs
+live in CPU memory, run_batches copies the chunks through pinned staging buffers on an upload and a download stream
+so the copies of one chunk overlap the compute of the others, and writes every output straight into the
+preallocated output tensor. Everywhere else the chunks run one after the other.
+"""
+import threading
+
+import torch
+
+import comfy.adaptive_chunks
+import comfy.model_management
+
+# Size of each pinned staging buffer, there are two per direction
+STAGING_BYTES = 32 * 1024 * 1024
+
+
+class StagingBuffers:
+    """Pinned host buffers that the copies of a direction alternate between, with the event of their last copy."""
+    def __init__(self, size=STAGING_BYTES):
+        self.buffers = [torch.empty(size, dtype=torch.uint8, pin_memory=True) for _ in range(2)]
+        self.events = [None, None]
+        # Output slices still waiting in each buffer to be copied to their destination
+        self.pending = [None, None]
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def take(self, dtype, numel):
+        """The next buffer as numel elements of dtype once its last copy finished."""
+        i = self.next
+        self.next = (i + 1) % len(self.buffers)
+        self.flush(i)
+        return i, self.buffers[i][:numel * dtype.itemsize].view(dtype)
+
+    def flush(self, i):
+        if self.events[i] is not None:
+            self.events[i].synchronize()
+            self.events[i] = None
+        if self.pending[i] is not None:
+            destination, source = self.pending[i]
+            destination.copy_(source)
+            self.pending[i] = None
+
+    def flush_all(self):
+        for i in range(len(self.buffers)):
+            self.flush(i)
+
+
+staging_pool = {}
+staging_pool_lock = threading.Lock()
+
+def get_staging(direction):
+    with staging_pool_lock:
+        staging = staging_pool.get(direction, None)
+        if staging is None:
+            staging = StagingBuffers()
+            staging_pool[direction] = staging
+    if staging.lock.acquire(blocking=False):
+        return staging
+    # In use by another thread, this run gets its own
+    staging = StagingBuffers()
+    staging.lock.acquire()
+    return staging
+
+
+def pipelined(device, inputs, output_device):
+    if not comfy.model_management.is_device_cuda(device) or not torch.cuda.is_available():
+        return False
+    if not comfy.model_management.device_supports_non_blocking(device):
+        return False
+    return inputs.device.type == "cpu" or output_device.type == "cpu"
+
+
+def run_batches(fn, inputs, batch_number, device, input_dtype, output_device, output_dtype=torch.float32, key=None, fallback=None):
+    """
+    Runs fn on batch_number items of inputs at a time on device and returns all the outputs in one output_dtype tensor
+    on output_device. fn gets each chunk as input_dtype on device.
+
+    Chunks that run out of memory are retried at half the size with the chunk sizes learnt for key (see
+    comfy.adaptive_chunks). If one item still runs out of memory the remaining items are given to fallback, which
+    returns their output on output_device, if there is one.
+    """
+    run = BatchRun(fn, inputs, device, input_dtype, output_device, output_dtype)
+    chunks = run.chunks_cuda if pipelined(device, inputs, output_device) else run.chunks
+    oom = False
+    try:
+        comfy.adaptive_chunks.run_chunks(chunks, inputs.shape[0], batch_number, key)
+    except comfy.model_management.OOM_EXCEPTION:
+        if fallback is None:
+            raise
+        oom = True
+    if oom:
+        comfy.model_management.soft_empty_cache()
+        run.store(run.done, fallback(inputs[run.done:]))
+    return run.output
+
+
+def upload(chunk, device, stream, staging):
+    """Issues the copy of a CPU chunk to device on stream, returns the device tensor and the event of the copy."""
+    chunk = chunk.contiguous()
+    flat = chunk.view(-1)
+    piece = STAGING_BYTES // chunk.element_size()
+    with torch.cuda.stream(stream):
+        out = torch.empty(chunk.shape, dtype=chunk.dtype, device=device)
+    out_flat = out.view(-1)
+    for start in range(0, flat.shape[0], piece):
+        n = min(piece, flat.shape[0] - start)
+        i, buffer = staging.take(chunk.dtype, n)
+        buffer.copy_(flat[start:start + n])
+        with torch.cuda.stream(stream):
+            out_flat[start:start + n].copy_(buffer, non_blocking=True)
+            staging.events[i] = stream.record_event()
+    return out, stream.record_event()
+
+
+def download(out, destination, stream, staging):
+    """Issues the copy of out to the CPU tensor destination on stream, finished by staging.flush_all()."""
+    flat = out.contiguous().view(-1)
+    stream.wait_stream(torch.cuda.current_stream(out.device))
+    flat.record_stream(stream)
+    destination_flat = destination.view(-1)
+    piece = STAGING_BYTES // flat.element_size()
+    for start in range(0, flat.shape[0], piece):
+        n = min(piece, flat.shape[0] - start)
+        i, buffer = staging.take(flat.dtype, n)
+        with torch.cuda.stream(stream):
+            buffer.copy_(flat[start:start + n], non_blocking=True)
+            staging.events[i] = stream.record_event()
+        staging.pending[i] = (destination_flat[start:start + n], buffer)
+
+
+class BatchRun:
+    """The output of a run_batches call and the number of items done, the chunks methods are for comfy.adaptive_chunks.run_chunks."""
+    def __init__(self, fn, inputs, device, input_dtype, output_device, output_dtype):
+        self.fn = fn
+        self.inputs = inputs
+        self.device = device
+        self.input_dtype = input_dtype
+        self.output_device = output_device
+        self.output_dtype = output_dtype
+        self.output = None
+        self.done = 0
+
+    def output_slice(self, start, out):
+        if self.output is None:
+            self.output = torch.empty((self.inputs.shape[0],) + tuple(out.shape[1:]), dtype=self.output_dtype, device=self.output_device)
+        return self.output[start:start + out.shape[0]]
+
+    def store(self, start, out):
+        self.output_slice(start, out).copy_(out)
+        self.done = start + out.shape[0]
+
+    def chunks(self, start, batch_number):
+        for x in range(start, self.inputs.shape[0], batch_number):
+            out = self.fn(self.inputs[x:x + batch_number].to(self.input_dtype).to(self.device))
+            self.store(x, out.to(self.output_device))
+            yield self.done
+
+    def chunks_cuda(self, start, batch_number):
+        inputs = self.inputs
+        device = self.device
+        compute_stream = torch.cuda.current_stream(device)
+        upload_stream = torch.cuda.Stream(device=device)
+        download_stream = torch.cuda.Stream(device=device)
+        upload_staging = get_staging("upload") if inputs.device.type == "cpu" else None
+        download_staging = get_staging("download") if self.output_device.type == "cpu" else None
+        starts = list(range(start, inputs.shape[0], batch_number))
+
+        def issue_upload(start):
+            chunk = inputs[start:start + batch_number]
+            if upload_staging is None:
+                return chunk.to(device), None
+            return upload(chunk, device, upload_stream, upload_staging)
+
+        try:
+            next_chunk = issue_upload(starts[0])
+            for i, start in enumerate(starts):
+                chunk, event = next_chunk
+                if event is not None:
+                    compute_stream.wait_event(event)
+                    chunk.record_stream(compute_stream)
+                out = self.fn(chunk.to(self.input_dtype)).to(self.output_dtype)
+                del chunk
+                if i + 1 < len(starts):
+                    # Issued after the compute of this chunk is queued, the host side of the copy can wait for the
+                    # staging buffers while the GPU computes
+                    next_chunk = issue_upload(starts[i + 1])
+                if download_staging is None:
+                    self.store(start, out)
+                else:
+                    # Done once the staging buffers are flushed, at the latest when this generator is closed
+                    download(out, self.output_slice(start, out), download_stream, download_staging)
+                    self.done = start + out.shape[0]
+                del out
+                yield self.done
+        finally:
+            # Waits for the last copies, the buffers can't be reused before
+            for staging in (upload_staging, download_staging):
+                if staging is not None:
+                    staging.flush_all()
+                    staging.lock.release()
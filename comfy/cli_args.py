@@ -33,6 +33,19 @@ class EnumAction(argparse.Action):
         setattr(namespace, self.dest, value)
 
 
+def parse_size(value: str) -> int:
+    """Parse a human readable size like 24GB, 512MB or 1073741824 into a number of bytes."""
+    units = {"": 1, "B": 1, "K": 1024, "KB": 1024, "M": 1024 ** 2, "MB": 1024 ** 2, "G": 1024 ** 3, "GB": 1024 ** 3, "T": 1024 ** 4, "TB": 1024 ** 4}
+    value = value.strip().upper()
+    number = value.rstrip("KMGTB")
+    unit = value[len(number):]
+    try:
+        size = float(number) * units[unit]
+    except (ValueError, KeyError):
+        raise argparse.ArgumentTypeError(f"Invalid size '{value}', expected something like 24GB or 512MB.")
+    return int(size)
+
+
 parser = argparse.ArgumentParser()
 
 parser.add_argument("--listen", type=str, default="127.0.0.1", metavar="IP", nargs="?", const="0.0.0.0,::", help="Specify the IP address to listen on (default: 127.0.0.1). You can give a list of ip addresses by separating them with a comma like: 127.2.2.2,127.3.3.3 If --listen is provided without an argument, it defaults to 0.0.0.0,:: (listens on all ipv4 and ipv6)")
@@ -50,6 +63,7 @@ parser.add_argument("--input-directory", type=str, default=None, help="Set the C
 parser.add_argument("--auto-launch", action="store_true", help="Automatically launch ComfyUI in the default browser.")
 parser.add_argument("--disable-auto-launch", action="store_true", help="Disable auto launching the browser.")
 parser.add_argument("--cuda-device", type=int, default=None, metavar="DEVICE_ID", help="Set the id of the cuda device this instance will use.")
+parser.add_argument("--worker-devices", type=str, default=None, metavar="DEVICE_IDS", help="Comma separated list of device ids (for example 0,1,2,3). Starts one prompt worker per device, all pulling from the same queue. Workers prefer prompts using models they already have loaded.")
 cm_group = parser.add_mutually_exclusive_group()
 cm_group.add_argument("--cuda-malloc", action="store_true", help="Enable cudaMallocAsync (enabled by default for torch 2.0 and up).")
 cm_group.add_argument("--disable-cuda-malloc", action="store_true", help="Disable cudaMallocAsync.")
@@ -96,10 +110,23 @@ class LatentPreviewMethod(enum.Enum):
 parser.add_argument("--preview-method", type=LatentPreviewMethod, default=LatentPreviewMethod.NoPreviews, help="Default preview method for sampler nodes.", action=EnumAction)
 
 parser.add_argument("--preview-size", type=int, default=512, help="Sets the maximum preview size for sampler nodes.")
+parser.add_argument("--preview-interval", type=int, default=1, metavar="N", help="Preview every N sampling steps.")
+parser.add_argument("--preview-max-fps", type=float, default=10.0, metavar="FPS", help="Maximum number of previews per second, previews are decoded in the background and skipped while the last one is still decoding. 0 for no limit.")
 
 cache_group = parser.add_mutually_exclusive_group()
 cache_group.add_argument("--cache-classic", action="store_true", help="Use the old style (aggressive) caching.")
 cache_group.add_argument("--cache-lru", type=int, default=0, help="Use LRU caching with a maximum of N node results cached. May use more RAM/VRAM.")
+cache_group.add_argument("--cache-ram-budget", type=parse_size, default=None, metavar="SIZE", help="Cache node results up to a total estimated size (for example 24GB). When full, results that are cheap to recompute relative to their size are evicted first.")
+parser.add_argument("--cache-disk", type=str, default=None, metavar="PATH", help="Also store node results made only of tensors (latents, images, conditioning) in this directory so they survive restarts. Several ComfyUI instances can share the same directory.")
+parser.add_argument("--cache-disk-size", type=parse_size, default=parse_size("20GB"), metavar="SIZE", help="Maximum total size of the --cache-disk directory, least recently used results are deleted past this (default 20GB).")
+parser.add_argument("--model-cache-size", type=parse_size, default=0, metavar="SIZE", help="Loader nodes always share models that are still in use, this also keeps up to SIZE (for example 16GB) of recently used but unreferenced models and LoRAs in RAM so loading them again is free.")
+
+parser.add_argument("--history-backend", type=str, default="sqlite", choices=["sqlite", "memory"], help="Where the history of finished prompts is kept. sqlite (the default) keeps it across restarts, memory loses it on exit.")
+parser.add_argument("--history-db", type=str, default=None, metavar="PATH", help="Path of the sqlite database used by --history-backend sqlite. Defaults to history.sqlite3 in the user directory.")
+parser.add_argument("--history-size", type=int, default=10000, metavar="N", help="Maximum number of finished prompts kept in the history.")
+
+parser.add_argument("--batch-prompts", type=int, default=0, metavar="N", help="Run up to N queued prompts that only differ in their seeds or prompt text (inputs marked BATCHABLE_INPUTS) together as a single batch.")
+parser.add_argument("--parallel-cpu-nodes", type=int, default=0, metavar="N", help="Run nodes marked THREAD_SAFE (image loading and other CPU work) on up to N background threads while the rest of the graph keeps executing.")
 
 attn_group = parser.add_mutually_exclusive_group()
 attn_group.add_argument("--use-split-cross-attention", action="store_true", help="Use the split cross attention optimization. Ignored when xformers is used.")
@@ -123,11 +150,14 @@ vram_group.add_argument("--novram", action="store_true", help="When lowvram isn'
 vram_group.add_argument("--cpu", action="store_true", help="To use the CPU for everything (slow).")
 
 parser.add_argument("--reserve-vram", type=float, default=None, help="Set the amount of vram in GB you want to reserve for use by your OS/other software. By default some amount is reserved depending on your OS.")
+parser.add_argument("--disable-weight-streaming", action="store_true", help="In lowvram mode, copy the weights of each offloaded layer to the GPU when it runs instead of pinning them in RAM and copying the next layers in advance on a separate CUDA stream.")
+parser.add_argument("--lowvram-patch-cache-size", type=parse_size, default=parse_size("1GB"), metavar="SIZE", help="In lowvram mode, keep up to SIZE (at most a quarter of the VRAM available to the model) of LoRA patched offloaded weights on the GPU between sampling steps instead of patching and copying them again (default 1GB).")
 
 
 parser.add_argument("--default-hashing-function", type=str, choices=['md5', 'sha1', 'sha256', 'sha512'], default='sha256', help="Allows you to choose the hash function to use for duplicate filename / contents comparison. Default is sha256.")
 
 parser.add_argument("--disable-smart-memory", action="store_true", help="Force ComfyUI to agressively offload to regular ram instead of keeping models in vram when it can.")
+parser.add_argument("--device-noise", action="store_true", help="Generate the initial noise on the GPU with a counter based generator that makes the noise of any batch index directly, it is returned on the device of the latent like the default noise. The same seed gives different noise than without this option.")
 parser.add_argument("--deterministic", action="store_true", help="Make pytorch use slower deterministic algorithms when it can. Note that this might not make images deterministic in all cases.")
 
 class PerformanceFeature(enum.Enum):
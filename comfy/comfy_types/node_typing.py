@@ -196,6 +196,31 @@ class ComfyNodeABC(ABC):
     """Flags a node as experimental, informing users that it may change or not work as expected."""
     DEPRECATED: bool
     """Flags a node as deprecated, indicating to users that they should find alternatives to this node."""
+    THREAD_SAFE: bool
+    """Flags a node as safe to run on a background thread while other nodes execute (``--parallel-cpu-nodes``).
+
+    Only set this on nodes that don't use the GPU or loaded models, don't depend on shared global state and don't expand into subgraphs, like image loaders.
+    """
+    BATCHABLE_INPUTS: tuple[str]
+    """Names of widget inputs that may differ between queued prompts which get coalesced into one batched run (``--batch-prompts``).
+
+    When prompts are coalesced, these inputs receive a ``PromptBatch`` (a list with one value per prompt) instead of a single value and the node must produce outputs where batch item ``j * len(values) + i`` belongs to prompt ``i``.
+    """
+    EXPANDS_PROMPT_BATCH: bool
+    """Flags a node that expands its latent with ``comfy.sample.expand_latent_for_prompt_batch`` when prompts are coalesced, like KSampler.
+
+    Prompts are only coalesced when every node using the outputs of a node with ``BATCHABLE_INPUTS`` has this flag (or has none of its outputs used), and when no node with this flag uses the outputs of another one, directly or through other nodes.
+    """
+    MODEL_FILE_INPUTS: dict[str, str]
+    """Maps the names of widget inputs selecting a model file to load to the ``folder_paths`` folder the file is in.
+
+    Used to look ahead at the models queued prompts will need so they are kept loaded, unloaded last or read from disk in advance.
+    """
+    CACHEABLE_INPUT_TYPES: bool
+    """Flags a custom node whose ``INPUT_TYPES`` only changes with the ``folder_paths`` folders and directories it looks up, so ``/object_info`` can keep its definition until one of them changes.
+
+    Built-in nodes and custom nodes that look up folders through ``folder_paths`` are kept without it. Custom nodes that look up nothing are otherwise asked again on every request, in case they read the filesystem some other way.
+    """
 
     @classmethod
     @abstractmethod
@@ -744,6 +744,8 @@ def load_controlnet(ckpt_path, model=None, model_options={}):
     cnet = load_controlnet_state_dict(comfy.utils.load_torch_file(ckpt_path, safe_load=True), model=model, model_options=model_options)
     if cnet is None:
         logging.error("error checkpoint does not contain controlnet or t2i adapter data {}".format(ckpt_path))
+    elif getattr(cnet, "control_model_wrapped", None) is not None:
+        comfy.model_management.set_model_source_file(cnet.control_model_wrapped, ckpt_path)
     return cnet
 
 class T2IAdapter(ControlBase):
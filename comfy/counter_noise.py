@@ -0,0 +1,70 @@
+"""
+Counter based noise.
+
+Every batch item gets its own stream keyed by the seed and its batch index, and every value in a stream is a hash of
+its position in it, so the noise of any batch index is generated directly without generating the ones before it
+and the whole batch is generated at once on any device. The integer hashing is exact everywhere, the conversion to
+a normal distribution is done in float64 (float32 on MPS) so the noise from the CPU and the GPU match to the precision
+of the latent.
+
+The noise is different from the torch.manual_seed CPU noise comfy.sample.prepare_noise makes by default for the same seed.
+"""
+import math
+
+import torch
+
+import comfy.model_management
+
+MASK32 = 0xffffffff
+
+
+def mix32(x):
+    """Bijective 32 bit integer hash (lowbias32) of int64 tensors holding 32 bit values."""
+    x = x ^ (x >> 16)
+    x = (x * 0x7feb352d) & MASK32
+    x = x ^ (x >> 15)
+    x = (x * 0x846ca68b) & MASK32
+    x = x ^ (x >> 16)
+    return x
+
+
+def stream_keys(seeds, batch_inds, device):
+    """The two 32 bit keys of the stream of each (seed, batch index) pair as [batch, 1] int64 tensors."""
+    seed_lo = torch.tensor([s & MASK32 for s in seeds], dtype=torch.int64, device=device)
+    seed_hi = torch.tensor([(s >> 32) & MASK32 for s in seeds], dtype=torch.int64, device=device)
+    index = torch.tensor([i & MASK32 for i in batch_inds], dtype=torch.int64, device=device)
+    key0 = mix32(seed_lo ^ mix32(seed_hi ^ mix32(index ^ 0x9e3779b9)))
+    key1 = mix32(key0 ^ 0x85ebca6b)
+    return key0.unsqueeze(1), key1.unsqueeze(1)
+
+
+def random_bits(counters, key0, key1):
+    return mix32((mix32(counters ^ key0) + key1) & MASK32)
+
+
+def randn(shape, seeds, batch_inds=None, dtype=torch.float32, device="cpu"):
+    """
+    Normally distributed noise of shape where batch item i comes from the stream of seeds[i] and batch_inds[i]
+    (its index in the batch if batch_inds is None).
+    """
+    device = torch.device(device)
+    batch = shape[0]
+    if batch_inds is None:
+        batch_inds = range(batch)
+    numel = math.prod(shape[1:])
+    if numel > 2 ** 31:
+        raise ValueError("Counter noise can't generate more than 2^31 values per batch item, got {}.".format(numel))
+
+    key0, key1 = stream_keys(seeds, batch_inds, device)
+    # A pair of uniforms gives a pair of normals (Box-Muller)
+    pairs = (numel + 1) // 2
+    counters = torch.arange(pairs, dtype=torch.int64, device=device).unsqueeze(0) * 2
+    compute_dtype = torch.float32 if comfy.model_management.is_device_mps(device) else torch.float64
+    # Top 24 bits, offset by half so neither uniform is 0 or 1
+    u1 = ((random_bits(counters, key0, key1) >> 8).to(compute_dtype) + 0.5) / 2 ** 24
+    u2 = ((random_bits(counters + 1, key0, key1) >> 8).to(compute_dtype) + 0.5) / 2 ** 24
+    del counters
+    radius = torch.sqrt(-2.0 * torch.log(u1))
+    angle = (2.0 * math.pi) * u2
+    noise = torch.stack((radius * torch.cos(angle), radius * torch.sin(angle)), dim=-1).reshape(batch, -1)[:, :numel]
+    return noise.to(dtype).reshape(shape)
@@ -527,6 +527,18 @@ class DismantledBlock(nn.Module):
             qkv = self.attn.pre_attention(modulate(self.norm1(x), shift_msa, scale_msa))
             return qkv, None
 
+    def modulated_input(self, x: torch.Tensor, c: torch.Tensor) -> torch.Tensor:
+        """The normalized input of the attention, shifted and scaled by the modulation of c."""
+        modulation = self.adaLN_modulation(c)
+        hidden_size = x.shape[-1]
+        if self.scale_mod_only:
+            shift_msa = None
+            scale_msa = modulation[:, :hidden_size]
+        else:
+            shift_msa = modulation[:, :hidden_size]
+            scale_msa = modulation[:, hidden_size:2 * hidden_size]
+        return modulate(self.norm1(x), shift_msa, scale_msa)
+
     def post_attention(self, attn, x, gate_msa, shift_mlp, scale_mlp, gate_mlp):
         assert not self.pre_only
         x = x + gate_msa.unsqueeze(1) * self.attn.post_attention(attn)
@@ -948,10 +960,20 @@ class MMDiT(nn.Module):
                 1,
             )
 
+        cache_entry = None
+        step_cache = transformer_options.get("step_cache", None)
+        if step_cache is not None:
+            # How much the modulated input of the first block changes tells how much the output does
+            cache_entry = step_cache.lookup(transformer_options, self.joint_blocks[0].x_block.modulated_input(x, c_mod))
+
         # context is B, L', D
         # x is B, L, D
         blocks_replace = patches_replace.get("dit", {})
         blocks = len(self.joint_blocks)
+        if cache_entry is not None and cache_entry.reuse:
+            x = x + cache_entry.value
+            blocks = 0
+        x_in = x
         for i in range(blocks):
             if ("double_block", i) in blocks_replace:
                 def block_wrap(args):
@@ -976,6 +998,9 @@ class MMDiT(nn.Module):
                     if add is not None:
                         x += add
 
+        if cache_entry is not None and not cache_entry.reuse:
+            cache_entry.value = x - x_in
+
         x = self.final_layer(x, c_mod)  # (N, T, patch_size ** 2 * out_channels)
         return x
 
@@ -827,6 +827,13 @@ class UNetModel(nn.Module):
             #nn.LogSoftmax(dim=1)  # change to cross_entropy and produce non-normalized logits
         )
 
+    def step_cache_depth(self):
+        """Number of input (and output) blocks at the full resolution, they still run when the step cache is reused."""
+        for id, module in enumerate(self.input_blocks):
+            if any(isinstance(layer, Downsample) for layer in module):
+                return id
+        return None
+
     def forward(self, x, timesteps=None, context=None, y=None, control=None, transformer_options={}, **kwargs):
         return comfy.patcher_extension.WrapperExecutor.new_class_executor(
             self._forward,
@@ -867,8 +874,17 @@ class UNetModel(nn.Module):
             assert y.shape[0] == x.shape[0]
             emb = emb + self.label_emb(y)
 
+        step_cache = transformer_options.get("step_cache", None)
+        cache_depth = self.step_cache_depth() if step_cache is not None else None
+        cache_entry = None
+
         h = x
         for id, module in enumerate(self.input_blocks):
+            if id == cache_depth:
+                # The full resolution features tell how much the step changed the input
+                cache_entry = step_cache.lookup(transformer_options, hs[-1].clone())
+                if cache_entry.reuse:
+                    break
             transformer_options["block"] = ("input", id)
             h = forward_timestep_embed(module, h, emb, context, transformer_options, time_context=time_context, num_video_frames=num_video_frames, image_only_indicator=image_only_indicator)
             h = apply_control(h, control, 'input')
@@ -883,13 +899,28 @@ class UNetModel(nn.Module):
                 for p in patch:
                     h = p(h, transformer_options)
 
-        transformer_options["block"] = ("middle", 0)
-        if self.middle_block is not None:
-            h = forward_timestep_embed(self.middle_block, h, emb, context, transformer_options, time_context=time_context, num_video_frames=num_video_frames, image_only_indicator=image_only_indicator)
-        h = apply_control(h, control, 'middle')
+        cached_block = None
+        if cache_entry is not None:
+            cached_block = len(self.output_blocks) - cache_depth
+
+        if cache_entry is not None and cache_entry.reuse:
+            # The deeper blocks output what they did on the last step that ran them
+            h = cache_entry.value
+            if control is not None and len(control.get('output', [])) > 0:
+                del control['output'][-cached_block:]
+        else:
+            transformer_options["block"] = ("middle", 0)
+            if self.middle_block is not None:
+                h = forward_timestep_embed(self.middle_block, h, emb, context, transformer_options, time_context=time_context, num_video_frames=num_video_frames, image_only_indicator=image_only_indicator)
+            h = apply_control(h, control, 'middle')
 
 
         for id, module in enumerate(self.output_blocks):
+            if cached_block is not None:
+                if id < cached_block and cache_entry.reuse:
+                    continue
+                if id == cached_block and not cache_entry.reuse:
+                    cache_entry.value = h
             transformer_options["block"] = ("output", id)
             hsp = hs.pop()
             hsp = apply_control(hsp, control, 'output')
@@ -384,6 +384,7 @@ class WanModel(torch.nn.Module):
         context,
         clip_fea=None,
         freqs=None,
+        transformer_options={},
     ):
         r"""
         Forward pass through the diffusion model
@@ -429,8 +430,20 @@ class WanModel(torch.nn.Module):
             freqs=freqs,
             context=context)
 
-        for block in self.blocks:
-            x = block(x, **kwargs)
+        cache_entry = None
+        step_cache = transformer_options.get("step_cache", None)
+        if step_cache is not None:
+            # The timestep modulation of the blocks tells how much their output changes
+            cache_entry = step_cache.lookup(transformer_options, e0)
+
+        if cache_entry is not None and cache_entry.reuse:
+            x = x + cache_entry.value
+        else:
+            x_in = x
+            for block in self.blocks:
+                x = block(x, **kwargs)
+            if cache_entry is not None:
+                cache_entry.value = x - x_in
 
         # head
         x = self.head(x, e)
@@ -439,7 +452,7 @@ class WanModel(torch.nn.Module):
         x = self.unpatchify(x, grid_sizes)
         return x
 
-    def forward(self, x, timestep, context, clip_fea=None, **kwargs):
+    def forward(self, x, timestep, context, clip_fea=None, transformer_options={}, **kwargs):
         bs, c, t, h, w = x.shape
         x = comfy.ldm.common_dit.pad_to_patch_size(x, self.patch_size)
         patch_size = self.patch_size
@@ -453,7 +466,7 @@ class WanModel(torch.nn.Module):
         img_ids = repeat(img_ids, "t h w c -> b (t h w) c", b=bs)
 
         freqs = self.rope_embedder(img_ids).movedim(1, 2)
-        return self.forward_orig(x, timestep, context, clip_fea=clip_fea, freqs=freqs)[:, :, :t, :h, :w]
+        return self.forward_orig(x, timestep, context, clip_fea=clip_fea, freqs=freqs, transformer_options=transformer_options)[:, :, :t, :h, :w]
 
     def unpatchify(self, x, grid_sizes):
         r"""
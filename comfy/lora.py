@@ -21,6 +21,7 @@ import comfy.utils
 import comfy.model_management
 import comfy.model_base
 import logging
+import math
 import torch
 
 LORA_CLIP_MAP = {
@@ -666,3 +667,52 @@ def calculate_weight(patches, weight, key, intermediate_dtype=torch.float32, ori
             weight = old_weight
 
     return weight
+
+def is_plain_lora_patch(p, weight_shape):
+    """True for unscaled, un-offset lora/locon patches without mid weights, DoRA or reshape that match weight_shape."""
+    strength, v, strength_model, offset, function = p
+    if offset is not None or function is not None or strength_model != 1.0:
+        return False
+    if not isinstance(v, tuple) or len(v) != 2 or not isinstance(v[0], str) or v[0] != "lora":
+        return False
+    v = v[1]
+    if v[3] is not None or v[4] is not None or v[5] is not None:
+        return False
+    if v[0].ndim < 2 or v[1].ndim < 2 or v[0].shape[0] != weight_shape[0] or v[0][0].numel() != v[0].shape[1]:
+        return False
+    return v[0].shape[1] == v[1].shape[0] and v[0].shape[0] * v[1][0].numel() == math.prod(weight_shape)
+
+def lora_patches_rank(patches):
+    return sum(p[1][1][1].shape[0] for p in patches)
+
+def calculate_lora_diffs_batched(patch_lists, weight_shape, device, out=None, intermediate_dtype=torch.float32):
+    """
+    Sum of the plain lora patches (see is_plain_lora_patch) of several weights with the same shape and total rank.
+    Stacked LoRAs of a weight are concatenated along the rank so every weight takes one matmul and all the
+    weights take a single batched one. Returns a tensor of shape [len(patch_lists), *weight_shape], in out if given.
+    """
+    ups = []
+    downs = []
+    for patches in patch_lists:
+        up = []
+        down = []
+        for p in patches:
+            strength = p[0]
+            v = p[1][1]
+            mat1 = comfy.model_management.cast_to_device(v[0], device, intermediate_dtype).flatten(start_dim=1)
+            mat2 = comfy.model_management.cast_to_device(v[1], device, intermediate_dtype).flatten(start_dim=1)
+            if v[2] is not None:
+                alpha = v[2] / mat2.shape[0]
+            else:
+                alpha = 1.0
+            up.append(mat1 * (strength * alpha))
+            down.append(mat2)
+        ups.append(torch.cat(up, dim=1))
+        downs.append(torch.cat(down, dim=0))
+
+    rows = weight_shape[0]
+    cols = math.prod(weight_shape) // rows
+    if out is not None:
+        out = out.view(len(patch_lists), rows, cols)
+    diffs = torch.bmm(torch.stack(ups), torch.stack(downs), out=out)
+    return diffs.view(len(patch_lists), *weight_shape)
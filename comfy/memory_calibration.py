@@ -0,0 +1,209 @@
+"""
+Measured activation memory of diffusion models.
+
+BaseModel.memory_required guesses the memory a model call takes from the size of its input with a fixed
+per model factor. Instead, the first time a model runs with an input of a given size on a CUDA device its
+actual peak memory use is measured. The measurements for each device, kind of model, dtype, attention function
+and set of patches and wrappers are fitted with a curve linear in the batch size and quadratic in the number of latent pixels (attention
+memory can grow with its square) which then gives the memory required for other input sizes. Measurements
+are kept in a json file so they only have to be taken once.
+"""
+import contextlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+import torch
+
+import comfy.model_management
+import comfy.ldm.modules.attention
+
+# Measurements kept per model, the oldest go first
+MAX_SAMPLES = 16
+
+
+def environment():
+    """Measurements are only valid for the torch version they were taken with, the GPU is part of their key."""
+    return torch.__version__
+
+
+def function_names(functions):
+    return [getattr(f, "__qualname__", type(f).__name__) for f in functions]
+
+
+def options_key(model_options):
+    """The patches and wrappers in model_options that run inside the model and change how much memory it uses."""
+    if model_options is None:
+        return ""
+    transformer_options = model_options.get("transformer_options", {})
+    parts = []
+    for name, patches in sorted(transformer_options.get("patches", {}).items()):
+        parts.append("{}={}".format(name, "+".join(function_names(patches))))
+    for name, replaced in sorted(transformer_options.get("patches_replace", {}).items()):
+        parts.append("{}={}".format(name, "+".join(sorted(function_names(replaced.values())))))
+    for wrapper_type, wrappers in sorted(transformer_options.get("wrappers", {}).items()):
+        names = sorted(n for w in wrappers.values() for n in function_names(w))
+        if len(names) > 0:
+            parts.append("{}={}".format(wrapper_type, "+".join(names)))
+    if "model_function_wrapper" in model_options:
+        parts.append("model_function_wrapper={}".format(function_names([model_options["model_function_wrapper"]])[0]))
+    return " ".join(parts)
+
+
+def model_key(model, model_options=None, device=None):
+    if device is None:
+        device = comfy.model_management.get_torch_device()
+    dtype = model.get_dtype()
+    if model.manual_cast_dtype is not None:
+        dtype = model.manual_cast_dtype
+    model_type = type(getattr(model, "model_config", model)).__name__
+    key = "{} | {} {} {}".format(comfy.model_management.get_torch_device_name(device), model_type, dtype, comfy.ldm.modules.attention.optimized_attention.__name__)
+    options = options_key(model_options)
+    if len(options) > 0:
+        key += " | " + options
+    return key
+
+
+def input_size(input_shape):
+    """Batch size and latent pixels (or voxels) per batch item."""
+    pixels = 1
+    for d in input_shape[2:]:
+        pixels *= d
+    return int(input_shape[0]), int(pixels)
+
+
+def features(batch, pixels):
+    return [1.0, batch * pixels, batch * pixels * pixels]
+
+
+def fit(samples):
+    """
+    Coefficients of memory = c0 + c1 * batch * pixels + c2 * batch * pixels^2 fitted to the (batch, pixels, memory)
+    samples, all of them positive.
+    """
+    x = np.array([features(b, p) for b, p, _ in samples], dtype=np.float64)
+    y = np.array([s[2] for s in samples], dtype=np.float64)
+    scale = x.max(axis=0)
+    x = x / scale
+    for terms in (3, 2):
+        if len(samples) < terms:
+            continue
+        coefficients = np.linalg.lstsq(x[:, :terms], y, rcond=None)[0]
+        if (coefficients >= 0).all():
+            return [float(c) for c in coefficients / scale[:terms]] + [0.0] * (3 - terms)
+    # Proportional to the pixels, fitted to the worst sample
+    return [0.0, float((y / (x[:, 1] * scale[1])).max()), 0.0]
+
+
+class MemoryCalibration:
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.curves = {}
+        self.environment = None
+        if path is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning("Could not load memory calibration {}: {}".format(self.path, e))
+            return
+        if data.get("environment", None) != self.get_environment():
+            logging.info("Ignoring memory calibration taken with {}".format(data.get("environment", None)))
+            return
+        self.samples = {k: [tuple(s) for s in v] for k, v in data.get("samples", {}).items()}
+
+    def save(self):
+        data = {"environment": self.get_environment(), "samples": self.samples}
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=1)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.warning("Could not save memory calibration {}: {}".format(self.path, e))
+
+    def get_environment(self):
+        if self.environment is None:
+            self.environment = environment()
+        return self.environment
+
+    def estimate(self, model, input_shape, model_options=None, device=None):
+        """
+        Memory in bytes the model is expected to need to run on an input of input_shape with the patches and wrappers
+        of model_options on device, None if it wasn't measured with enough input sizes to tell.
+        """
+        key = model_key(model, model_options, device)
+        batch, pixels = input_size(input_shape)
+        with self.lock:
+            samples = self.samples.get(key, None)
+            if samples is None:
+                return None
+            if pixels > max(s[1] for s in samples) and len(set(s[1] for s in samples)) < 3:
+                # Can't tell how fast it grows with the resolution yet
+                return None
+            curve = self.curves.get(key, None)
+            if curve is None:
+                curve = fit(samples)
+                self.curves[key] = curve
+            estimate = sum(c * f for c, f in zip(curve, features(batch, pixels)))
+            # Never less than what was measured for an input at least as large
+            for sample_batch, sample_pixels, peak in samples:
+                if sample_batch <= batch and sample_pixels <= pixels:
+                    estimate = max(estimate, peak)
+        return estimate
+
+    def needs_sample(self, key, batch, pixels):
+        with self.lock:
+            return not any(s[0] == batch and s[1] == pixels for s in self.samples.get(key, ()))
+
+    def add_sample(self, key, batch, pixels, peak):
+        with self.lock:
+            samples = [s for s in self.samples.get(key, []) if s[0] != batch or s[1] != pixels]
+            samples.append((batch, pixels, peak))
+            self.samples[key] = samples[-MAX_SAMPLES:]
+            self.curves.pop(key, None)
+            if self.path is not None:
+                self.save()
+        logging.debug("Memory calibration {}: batch of {} with {} latent pixels uses {:.0f}MB".format(key, batch, pixels, peak / (1024 * 1024)))
+
+    @contextlib.contextmanager
+    def measure(self, model, input_shape, device, model_options=None):
+        """Measures the peak memory used in the block if this model, options and input size were never measured."""
+        if device.type != "cuda" or getattr(model, "model_lowvram", False):
+            # Lowvram peaks include the weights cast during the call
+            yield
+            return
+        key = model_key(model, model_options, device)
+        batch, pixels = input_size(input_shape)
+        if not self.needs_sample(key, batch, pixels):
+            yield
+            return
+
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        before = torch.cuda.memory_allocated(device)
+        yield
+        torch.cuda.synchronize(device)
+        self.add_sample(key, batch, pixels, torch.cuda.max_memory_allocated(device) - before)
+
+
+calibration = MemoryCalibration()
+
+def set_path(path):
+    global calibration
+    calibration = MemoryCalibration(path)
+
+def estimate(model, input_shape, model_options=None, device=None):
+    return calibration.estimate(model, input_shape, model_options, device)
+
+def measure(model, input_shape, device, model_options=None):
+    return calibration.measure(model, input_shape, device, model_options)
@@ -25,6 +25,8 @@ import sys
 import platform
 import weakref
 import gc
+import threading
+import time
 
 class VRAMState(Enum):
     DISABLED = 0    #No vram present: no need to move models to vram
@@ -125,9 +127,22 @@ def is_mlu():
         return True
     return False
 
+thread_device = threading.local()
+
+def set_thread_torch_device(device):
+    """Pins the calling thread to device: get_torch_device() returns it and models loaded from this thread use it."""
+    thread_device.device = device
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
+    elif device.type == "xpu":
+        torch.xpu.set_device(device)
+
 def get_torch_device():
     global directml_enabled
     global cpu_state
+    device = getattr(thread_device, "device", None)
+    if device is not None:
+        return device
     if directml_enabled:
         global directml_device
         return directml_device
@@ -350,6 +365,8 @@ except:
 
 
 current_loaded_models = []
+# Guards current_loaded_models when several prompt workers load models at the same time
+model_management_lock = threading.RLock()
 
 def module_size(module):
     module_mem = 0
@@ -462,6 +479,46 @@ def offloaded_memory(loaded_models, device):
             offloaded_mem += m.model_offloaded_memory()
     return offloaded_mem
 
+# Model files used by the running and queued prompts, mapped to how many prompts ahead they are next needed.
+# Set by the residency planner in comfy_execution/residency.py.
+upcoming_model_files = {}
+
+def set_upcoming_model_files(files):
+    global upcoming_model_files
+    upcoming_model_files = files
+
+def next_model_use(loaded_model):
+    """How many prompts ahead the model is needed again, None if no running or queued prompt uses it."""
+    model = loaded_model.model
+    if model is None:
+        return None
+    uses = [upcoming_model_files[f] for f in getattr(model.model, "comfy_source_files", ()) if f in upcoming_model_files]
+    if len(uses) == 0:
+        return None
+    return min(uses)
+
+class TransferRate:
+    """Moving average of the throughput of some kind of transfer, used to tell how long the next one should take."""
+    def __init__(self, smoothing=0.3):
+        self.smoothing = smoothing
+        self.rate = None
+
+    def expected_time(self, size):
+        if self.rate is None:
+            return None
+        return size / self.rate
+
+    def update(self, size, seconds):
+        if size <= 0 or seconds <= 0:
+            return
+        rate = size / seconds
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate += (rate - self.rate) * self.smoothing
+
+load_rates = {}
+
 WINDOWS = any(platform.win32_ver())
 
 EXTRA_RESERVED_VRAM = 400 * 1024 * 1024
@@ -479,121 +536,170 @@ def minimum_inference_memory():
     return (1024 * 1024 * 1024) * 0.8 + extra_reserved_memory()
 
 def free_memory(memory_required, device, keep_loaded=[]):
-    cleanup_models_gc()
-    unloaded_model = []
-    can_unload = []
-    unloaded_models = []
-
-    for i in range(len(current_loaded_models) -1, -1, -1):
-        shift_model = current_loaded_models[i]
-        if shift_model.device == device:
-            if shift_model not in keep_loaded and not shift_model.is_dead():
-                can_unload.append((-shift_model.model_offloaded_memory(), sys.getrefcount(shift_model.model), shift_model.model_memory(), i))
-                shift_model.currently_used = False
-
-    for x in sorted(can_unload):
-        i = x[-1]
-        memory_to_free = None
-        if not DISABLE_SMART_MEMORY:
-            free_mem = get_free_memory(device)
-            if free_mem > memory_required:
-                break
-            memory_to_free = memory_required - free_mem
-        logging.debug(f"Unloading {current_loaded_models[i].model.model.__class__.__name__}")
-        if current_loaded_models[i].model_unload(memory_to_free):
-            unloaded_model.append(i)
-
-    for i in sorted(unloaded_model, reverse=True):
-        unloaded_models.append(current_loaded_models.pop(i))
-
-    if len(unloaded_model) > 0:
-        soft_empty_cache()
-    else:
-        if vram_state != VRAMState.HIGH_VRAM:
-            mem_free_total, mem_free_torch = get_free_memory(device, torch_free_too=True)
-            if mem_free_torch > mem_free_total * 0.25:
-                soft_empty_cache()
-    return unloaded_models
+    with model_management_lock:
+        cleanup_models_gc()
+        unloaded_model = []
+        can_unload = []
+        unloaded_models = []
+
+        for i in range(len(current_loaded_models) -1, -1, -1):
+            shift_model = current_loaded_models[i]
+            if shift_model.device == device:
+                if shift_model not in keep_loaded and not shift_model.is_dead():
+                    # Models no upcoming prompt needs go first, then the ones needed the furthest ahead
+                    next_use = next_model_use(shift_model)
+                    unload_order = float("-inf") if next_use is None else -next_use
+                    can_unload.append((unload_order, -shift_model.model_offloaded_memory(), sys.getrefcount(shift_model.model), shift_model.model_memory(), i))
+                    shift_model.currently_used = False
+
+        for x in sorted(can_unload):
+            i = x[-1]
+            memory_to_free = None
+            if not DISABLE_SMART_MEMORY:
+                free_mem = get_free_memory(device)
+                if free_mem > memory_required:
+                    break
+                memory_to_free = memory_required - free_mem
+            logging.debug(f"Unloading {current_loaded_models[i].model.model.__class__.__name__}")
+            if current_loaded_models[i].model_unload(memory_to_free):
+                unloaded_model.append(i)
+
+        for i in sorted(unloaded_model, reverse=True):
+            unloaded_models.append(current_loaded_models.pop(i))
+
+        if len(unloaded_model) > 0:
+            soft_empty_cache()
+        else:
+            if vram_state != VRAMState.HIGH_VRAM:
+                mem_free_total, mem_free_torch = get_free_memory(device, torch_free_too=True)
+                if mem_free_torch > mem_free_total * 0.25:
+                    soft_empty_cache()
+        return unloaded_models
 
 def load_models_gpu(models, memory_required=0, force_patch_weights=False, minimum_memory_required=None, force_full_load=False):
-    cleanup_models_gc()
-    global vram_state
-
-    inference_memory = minimum_inference_memory()
-    extra_mem = max(inference_memory, memory_required + extra_reserved_memory())
-    if minimum_memory_required is None:
-        minimum_memory_required = extra_mem
-    else:
-        minimum_memory_required = max(inference_memory, minimum_memory_required + extra_reserved_memory())
-
-    models = set(models)
-
-    models_to_load = []
-
-    for x in models:
-        loaded_model = LoadedModel(x)
-        try:
-            loaded_model_index = current_loaded_models.index(loaded_model)
-        except:
-            loaded_model_index = None
-
-        if loaded_model_index is not None:
-            loaded = current_loaded_models[loaded_model_index]
-            loaded.currently_used = True
-            models_to_load.append(loaded)
+    with model_management_lock:
+        cleanup_models_gc()
+        global vram_state
+
+        inference_memory = minimum_inference_memory()
+        extra_mem = max(inference_memory, memory_required + extra_reserved_memory())
+        if minimum_memory_required is None:
+            minimum_memory_required = extra_mem
         else:
-            if hasattr(x, "model"):
-                logging.info(f"Requested to load {x.model.__class__.__name__}")
-            models_to_load.append(loaded_model)
-
-    for loaded_model in models_to_load:
-        to_unload = []
-        for i in range(len(current_loaded_models)):
-            if loaded_model.model.is_clone(current_loaded_models[i].model):
-                to_unload = [i] + to_unload
-        for i in to_unload:
-            current_loaded_models.pop(i).model.detach(unpatch_all=False)
+            minimum_memory_required = max(inference_memory, minimum_memory_required + extra_reserved_memory())
 
-    total_memory_required = {}
-    for loaded_model in models_to_load:
-        total_memory_required[loaded_model.device] = total_memory_required.get(loaded_model.device, 0) + loaded_model.model_memory_required(loaded_model.device)
+        models = set(models)
 
-    for device in total_memory_required:
-        if device != torch.device("cpu"):
-            free_memory(total_memory_required[device] * 1.1 + extra_mem, device)
+        models_to_load = []
 
-    for device in total_memory_required:
-        if device != torch.device("cpu"):
-            free_mem = get_free_memory(device)
-            if free_mem < minimum_memory_required:
-                models_l = free_memory(minimum_memory_required, device)
-                logging.info("{} models unloaded.".format(len(models_l)))
+        for x in models:
+            loaded_model = LoadedModel(x)
+            try:
+                loaded_model_index = current_loaded_models.index(loaded_model)
+            except:
+                loaded_model_index = None
 
+            if loaded_model_index is not None:
+                loaded = current_loaded_models[loaded_model_index]
+                loaded.currently_used = True
+                models_to_load.append(loaded)
+            else:
+                if hasattr(x, "model"):
+                    logging.info(f"Requested to load {x.model.__class__.__name__}")
+                models_to_load.append(loaded_model)
+
+        for loaded_model in models_to_load:
+            to_unload = []
+            for i in range(len(current_loaded_models)):
+                if loaded_model.model.is_clone(current_loaded_models[i].model):
+                    to_unload = [i] + to_unload
+            for i in to_unload:
+                current_loaded_models.pop(i).model.detach(unpatch_all=False)
+
+        total_memory_required = {}
+        for loaded_model in models_to_load:
+            total_memory_required[loaded_model.device] = total_memory_required.get(loaded_model.device, 0) + loaded_model.model_memory_required(loaded_model.device)
+
+        for device in total_memory_required:
+            if device != torch.device("cpu"):
+                free_memory(total_memory_required[device] * 1.1 + extra_mem, device)
+
+        for device in total_memory_required:
+            if device != torch.device("cpu"):
+                free_mem = get_free_memory(device)
+                if free_mem < minimum_memory_required:
+                    models_l = free_memory(minimum_memory_required, device)
+                    logging.info("{} models unloaded.".format(len(models_l)))
+
+    # The weights are copied without the lock so workers on other devices can load at the same time, the models
+    # being loaded were taken out of current_loaded_models above so nothing else unloads them meanwhile
     for loaded_model in models_to_load:
         model = loaded_model.model
         torch_dev = model.load_device
-        if is_device_cpu(torch_dev):
-            vram_set_state = VRAMState.DISABLED
-        else:
-            vram_set_state = vram_state
-        lowvram_model_memory = 0
-        if lowvram_available and (vram_set_state == VRAMState.LOW_VRAM or vram_set_state == VRAMState.NORMAL_VRAM) and not force_full_load:
-            loaded_memory = loaded_model.model_loaded_memory()
-            current_free_mem = get_free_memory(torch_dev) + loaded_memory
+        with model_management_lock:
+            if is_device_cpu(torch_dev):
+                vram_set_state = VRAMState.DISABLED
+            else:
+                vram_set_state = vram_state
+            lowvram_model_memory = 0
+            if lowvram_available and (vram_set_state == VRAMState.LOW_VRAM or vram_set_state == VRAMState.NORMAL_VRAM) and not force_full_load:
+                loaded_memory = loaded_model.model_loaded_memory()
+                current_free_mem = get_free_memory(torch_dev) + loaded_memory
 
-            lowvram_model_memory = max(128 * 1024 * 1024, (current_free_mem - minimum_memory_required), min(current_free_mem * MIN_WEIGHT_MEMORY_RATIO, current_free_mem - minimum_inference_memory()))
-            lowvram_model_memory = max(0.1, lowvram_model_memory - loaded_memory)
+                lowvram_model_memory = max(128 * 1024 * 1024, (current_free_mem - minimum_memory_required), min(current_free_mem * MIN_WEIGHT_MEMORY_RATIO, current_free_mem - minimum_inference_memory()))
+                lowvram_model_memory = max(0.1, lowvram_model_memory - loaded_memory)
 
-        if vram_set_state == VRAMState.NO_VRAM:
-            lowvram_model_memory = 0.1
+            if vram_set_state == VRAMState.NO_VRAM:
+                lowvram_model_memory = 0.1
 
+        loaded_before = loaded_model.model_loaded_memory()
+        start = time.perf_counter()
         loaded_model.model_load(lowvram_model_memory, force_patch_weights=force_patch_weights)
-        current_loaded_models.insert(0, loaded_model)
+        loaded_size = loaded_model.model_loaded_memory() - loaded_before
+        if loaded_size >= LOG_LOAD_MIN_SIZE:
+            # Only wait for the copies to finish when there were any worth timing
+            if torch_dev.type == "cuda":
+                torch.cuda.synchronize(torch_dev)
+            log_load_time(loaded_model, loaded_size, time.perf_counter() - start)
+        with model_management_lock:
+            current_loaded_models.insert(0, loaded_model)
     return
 
+# Loads of less than this aren't timed
+LOG_LOAD_MIN_SIZE = 1024 * 1024
+
+def log_load_time(loaded_model, size, seconds):
+    rate = load_rates.setdefault(loaded_model.device, TransferRate())
+    expected = rate.expected_time(size)
+    name = loaded_model.model.model.__class__.__name__
+    if expected is None:
+        logging.info("Loaded {:.0f}MB of {} to {} in {:.2f}s".format(size / (1024 * 1024), name, loaded_model.device, seconds))
+    else:
+        logging.info("Loaded {:.0f}MB of {} to {} in {:.2f}s, expected {:.2f}s".format(size / (1024 * 1024), name, loaded_model.device, seconds, expected))
+    rate.update(size, seconds)
+
 def load_model_gpu(model):
     return load_models_gpu([model])
 
+def loaded_model_files(device=None):
+    """Paths of the model files that are currently loaded on device."""
+    if device is None:
+        device = get_torch_device()
+    out = set()
+    # Doesn't take model_management_lock, which other devices hold while they pick what to unload: a copy of the list is enough
+    for m in list(current_loaded_models):
+        model = m.model
+        if m.device == device and model is not None:
+            out.update(getattr(model.model, "comfy_source_files", ()))
+    return out
+
+def set_model_source_file(obj, path):
+    """Records which file a ModelPatcher, CLIP or VAE was loaded from."""
+    patcher = getattr(obj, "patcher", obj)
+    model = getattr(patcher, "model", None)
+    if model is not None:
+        model.comfy_source_files = getattr(model, "comfy_source_files", set()) | {path}
+
 def loaded_models(only_currently_used=False):
     output = []
     for m in current_loaded_models:
@@ -626,14 +732,15 @@ def cleanup_models_gc():
 
 
 def cleanup_models():
-    to_delete = []
-    for i in range(len(current_loaded_models)):
-        if current_loaded_models[i].real_model() is None:
-            to_delete = [i] + to_delete
+    with model_management_lock:
+        to_delete = []
+        for i in range(len(current_loaded_models)):
+            if current_loaded_models[i].real_model() is None:
+                to_delete = [i] + to_delete
 
-    for i in to_delete:
-        x = current_loaded_models.pop(i)
-        del x
+        for i in to_delete:
+            x = current_loaded_models.pop(i)
+            del x
 
 def dtype_size(dtype):
     dtype_size = 4
@@ -1211,29 +1318,50 @@ def soft_empty_cache(force=False):
         torch.cuda.ipc_collect()
 
 def unload_all_models():
-    free_memory(1e30, get_torch_device())
+    devices = set([get_torch_device()])
+    with model_management_lock:
+        for m in current_loaded_models:
+            if not is_device_cpu(m.device):
+                devices.add(m.device)
+        for device in devices:
+            free_memory(1e30, device)
 
 
 #TODO: might be cleaner to put this somewhere else
-import threading
-
 class InterruptProcessingException(Exception):
     pass
 
 interrupt_processing_mutex = threading.RLock()
 
 interrupt_processing = False
-def interrupt_current_processing(value=True):
+# Prompts that were interrupted. Each thread only sees the interrupts of the prompts it runs (see
+# set_interrupt_scope) so with several prompt workers interrupting one prompt leaves the others running.
+interrupted_prompts = set()
+interrupt_scope = threading.local()
+
+def set_interrupt_scope(prompt_ids):
+    """Sets the prompts the calling thread runs, interrupting any of them interrupts it."""
+    interrupt_scope.prompt_ids = frozenset(prompt_ids)
+
+def get_interrupt_scope():
+    return getattr(interrupt_scope, "prompt_ids", frozenset())
+
+def interrupt_current_processing(value=True, prompt_id=None):
     global interrupt_processing
     global interrupt_processing_mutex
     with interrupt_processing_mutex:
-        interrupt_processing = value
+        if prompt_id is None:
+            interrupt_processing = value
+        elif value:
+            interrupted_prompts.add(prompt_id)
+        else:
+            interrupted_prompts.discard(prompt_id)
 
 def processing_interrupted():
     global interrupt_processing
     global interrupt_processing_mutex
     with interrupt_processing_mutex:
-        return interrupt_processing
+        return interrupt_processing or not interrupted_prompts.isdisjoint(get_interrupt_scope())
 
 def throw_exception_if_processing_interrupted():
     global interrupt_processing
@@ -1242,3 +1370,7 @@ def throw_exception_if_processing_interrupted():
         if interrupt_processing:
             interrupt_processing = False
             raise InterruptProcessingException()
+        interrupted = interrupted_prompts.intersection(get_interrupt_scope())
+        if len(interrupted) > 0:
+            interrupted_prompts.difference_update(interrupted)
+            raise InterruptProcessingException()
@@ -25,6 +25,7 @@ import logging
 import uuid
 import collections
 import math
+import weakref
 
 import comfy.utils
 import comfy.float
@@ -32,6 +33,9 @@ import comfy.model_management
 import comfy.lora
 import comfy.hooks
 import comfy.patcher_extension
+import comfy.weight_streaming
+import comfy.memory_calibration
+from comfy.cli_args import args
 from comfy.patcher_extension import CallbacksMP, WrappersMP, PatcherInjection
 from comfy.comfy_types import UnetWrapperFunction
 
@@ -103,6 +107,9 @@ def wipe_lowvram_weight(m):
     if hasattr(m, "bias_function"):
         m.bias_function = []
 
+    if hasattr(m, "comfy_weight_streamer"):
+        m.comfy_weight_streamer = None
+
 def move_weight_functions(m, device):
     if device is None:
         return 0
@@ -120,6 +127,9 @@ def move_weight_functions(m, device):
     return memory
 
 class LowVramPatch:
+    # The result only depends on the weight and the patches so comfy.weight_streaming can cache it
+    comfy_cacheable = True
+
     def __init__(self, key, patches):
         self.key = key
         self.patches = patches
@@ -131,6 +141,58 @@ class LowVramPatch:
 
         return comfy.lora.calculate_weight(self.patches[self.key], weight, self.key, intermediate_dtype=intermediate_dtype)
 
+# Upper limit of the scratch memory used to compute LoRA patches in batches
+LORA_BATCH_MEMORY = 1024 * 1024 * 1024
+
+class WeightsSignature:
+    def __init__(self, patch_type, weights):
+        self.patch_type = patch_type
+        self.weights = weights
+
+def patch_signature(a):
+    """
+    What same_patch compares a patch with. Tensors and other objects are only weakly referenced so the
+    patches a model was last patched with don't keep old LoRA weights alive.
+    """
+    if isinstance(a, (tuple, list)):
+        return (type(a), tuple(patch_signature(x) for x in a))
+    if hasattr(a, "weights"):
+        return WeightsSignature(type(a), patch_signature(a.weights))
+    if a is None or isinstance(a, (str, int, float, bool)):
+        return a
+    try:
+        return weakref.ref(a)
+    except TypeError:
+        return a
+
+def same_patch(signature, b):
+    """Patches made again from the same loaded weights (like a LoRA node that re-executed) count as the same."""
+    if isinstance(signature, weakref.ref):
+        return signature() is b
+    if isinstance(signature, tuple):
+        seq_type, items = signature
+        return type(b) is seq_type and len(items) == len(b) and all(same_patch(x, y) for x, y in zip(items, b))
+    if isinstance(signature, WeightsSignature):
+        return type(b) is signature.patch_type and same_patch(signature.weights, b.weights)
+    if signature is None or isinstance(signature, (str, int, float, bool)):
+        return type(signature) is type(b) and signature == b
+    return signature is b
+
+def patch_list_signature(patches):
+    # (strength_patch, patch, strength_model, offset, function)
+    return [(x[0], patch_signature(x[1]), x[2], x[3], x[4]) for x in patches]
+
+def same_patch_list(signature, b):
+    """Compares the patch_list_signature of a patch list with another patch list."""
+    if signature is None or b is None:
+        return signature is None and b is None
+    if len(signature) != len(b):
+        return False
+    for x, y in zip(signature, b):
+        if x[0] != y[0] or not same_patch(x[1], y[1]) or x[2] != y[2] or x[3] != y[3] or x[4] is not y[4]:
+            return False
+    return True
+
 def get_key_weight(model, key):
     set_func = None
     convert_func = None
@@ -252,6 +314,12 @@ class ModelPatcher:
         if not hasattr(self.model, 'current_weight_patches_uuid'):
             self.model.current_weight_patches_uuid = None
 
+        if not hasattr(self.model, 'current_weight_patches'):
+            self.model.current_weight_patches = None
+
+        if not hasattr(self.model, 'weight_streamer'):
+            self.model.weight_streamer = None
+
     def model_size(self):
         if self.size > 0:
             return self.size
@@ -360,6 +428,9 @@ class ModelPatcher:
                 return True
 
     def memory_required(self, input_shape):
+        calibrated = comfy.memory_calibration.estimate(self.model, input_shape, self.model_options, self.load_device)
+        if calibrated is not None:
+            return calibrated
         return self.model.memory_required(input_shape=input_shape)
 
     def set_model_sampler_cfg_function(self, sampler_cfg_function, disable_cfg1_optimization=False):
@@ -541,6 +612,64 @@ class ModelPatcher:
                         sd.pop(k)
             return sd
 
+    def backup_weight(self, key, weight, inplace_update):
+        if key not in self.backup:
+            self.backup[key] = collections.namedtuple('Dimension', ['weight', 'inplace_update'])(weight.to(device=self.offload_device, copy=inplace_update), inplace_update)
+
+    def patch_weights_to_device(self, keys, device_to=None):
+        """
+        patch_weight_to_device for several keys. Weights with only plain LoRA patches are grouped by shape and
+        total rank and their patches computed in batched matmuls into one shared fp32 scratch buffer, sized to
+        stay within a fraction of the free memory of device_to.
+        """
+        groups = {}
+        for key in keys:
+            if key not in self.patches:
+                continue
+            weight, set_func, convert_func = get_key_weight(self.model, key)
+            patches = self.patches[key]
+            if device_to is None or set_func is not None or convert_func is not None or self.weight_inplace_update or \
+                    not all(comfy.lora.is_plain_lora_patch(p, weight.shape) for p in patches):
+                self.patch_weight_to_device(key, device_to=device_to)
+                continue
+            groups.setdefault((tuple(weight.shape), comfy.lora.lora_patches_rank(patches)), []).append(key)
+
+        if len(groups) == 0:
+            return
+
+        budget = min(comfy.model_management.get_free_memory(device_to) // 4, LORA_BATCH_MEMORY)
+        batches = []
+        scratch_size = 0
+        for (shape, rank), group in groups.items():
+            if len(group) == 1:
+                self.patch_weight_to_device(group[0], device_to=device_to)
+                continue
+            numel = math.prod(shape)
+            # The output plus the concatenated up and down matrices of every weight in the batch
+            per_key = (numel + rank * (shape[0] + numel // shape[0])) * 4
+            batch_size = max(1, min(len(group), budget // per_key))
+            scratch_size = max(scratch_size, batch_size * numel)
+            for i in range(0, len(group), batch_size):
+                batches.append((shape, group[i:i + batch_size]))
+
+        if len(batches) == 0:
+            return
+        scratch = torch.empty(scratch_size, dtype=torch.float32, device=device_to)
+        for shape, batch in batches:
+            out = scratch[:len(batch) * math.prod(shape)]
+            diffs = comfy.lora.calculate_lora_diffs_batched([self.patches[k] for k in batch], shape, device_to, out=out)
+            for i, key in enumerate(batch):
+                diff = diffs[i]
+                weight, _, _ = get_key_weight(self.model, key)
+                self.backup_weight(key, weight, False)
+                diff += comfy.model_management.cast_to_device(weight, device_to, torch.float32)
+                out_weight = comfy.float.stochastic_rounding(diff, weight.dtype, seed=string_to_seed(key))
+                if out_weight.data_ptr() == diff.data_ptr():
+                    # The scratch buffer gets reused
+                    out_weight = out_weight.clone()
+                comfy.utils.set_attr_param(self.model, key, out_weight)
+        del scratch
+
     def patch_weight_to_device(self, key, device_to=None, inplace_update=False):
         if key not in self.patches:
             return
@@ -548,8 +677,7 @@ class ModelPatcher:
         weight, set_func, convert_func = get_key_weight(self.model, key)
         inplace_update = self.weight_inplace_update or inplace_update
 
-        if key not in self.backup:
-            self.backup[key] = collections.namedtuple('Dimension', ['weight', 'inplace_update'])(weight.to(device=self.offload_device, copy=inplace_update), inplace_update)
+        self.backup_weight(key, weight, inplace_update)
 
         if device_to is not None:
             temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
@@ -568,6 +696,35 @@ class ModelPatcher:
         else:
             set_func(out_weight, inplace_update=inplace_update, seed=string_to_seed(key))
 
+    def patch_weights_incrementally(self, device_to):
+        """
+        Switches a fully loaded model from the weight patches of another clone to the patches of this one by
+        only recomputing the weights whose patch lists differ, from their backups. Returns False when the
+        model has to be unpatched and loaded again instead.
+        """
+        applied = self.model.current_weight_patches
+        if applied is None or self.model.model_lowvram or self.model.model_loaded_weight_memory == 0:
+            return False
+        if len(self.weight_wrapper_patches) > 0 or len(self.hook_backup) > 0 or self.force_cast_weights:
+            return False
+
+        changed = [k for k in applied.keys() | self.patches.keys() if not same_patch_list(applied.get(k, None), self.patches.get(k, None))]
+        for key in changed:
+            bk = self.backup.get(key, None)
+            if bk is not None:
+                if bk.inplace_update:
+                    comfy.utils.copy_to_param(self.model, key, bk.weight)
+                else:
+                    comfy.utils.set_attr_param(self.model, key, bk.weight.to(device_to))
+                if key not in self.patches:
+                    self.backup.pop(key)
+        self.patch_weights_to_device(changed, device_to=device_to)
+
+        logging.debug("patched {} of {} weights incrementally".format(len(changed), len(self.patches)))
+        self.model.current_weight_patches = {k: patch_list_signature(v) for k, v in self.patches.items()}
+        self.model.current_weight_patches_uuid = self.patches_uuid
+        return True
+
     def _load_list(self):
         loading = []
         for n, m in self.model.named_modules():
@@ -583,6 +740,21 @@ class ModelPatcher:
                 loading.append((comfy.model_management.module_size(m), n, m, params))
         return loading
 
+    def get_weight_streamer(self, device_to, cache_size=0):
+        if self.model.weight_streamer is None:
+            if args.disable_weight_streaming:
+                return None
+            self.model.weight_streamer = comfy.weight_streaming.WeightStreamer(comfy.weight_streaming.get_backend(device_to), cache_size=cache_size)
+        return self.model.weight_streamer
+
+    def stream_lowvram_weights(self, m, device_to, cache_size=0):
+        if getattr(m, "weight", None) is None:
+            return
+        streamer = self.get_weight_streamer(device_to, cache_size=cache_size)
+        if streamer is not None:
+            streamer.pin(m)
+            m.comfy_weight_streamer = streamer
+
     def load(self, device_to=None, lowvram_model_memory=0, force_patch_weights=False, full_load=False):
         with self.use_ejected():
             self.unpatch_hooks()
@@ -591,6 +763,16 @@ class ModelPatcher:
             lowvram_counter = 0
             loading = self._load_list()
 
+            # Patched lowvram weights cached on the device by the weight streamer come out of the same memory
+            patch_cache_size = 0
+            if not full_load and not force_patch_weights and len(self.patches) > 0 and self.model_size() > lowvram_model_memory:
+                patch_cache_size = min(args.lowvram_patch_cache_size, lowvram_model_memory // 4)
+                lowvram_model_memory -= patch_cache_size
+            if self.model.weight_streamer is not None:
+                # The patches or the modules it streams may have changed
+                self.model.weight_streamer.clear()
+                self.model.weight_streamer.cache.max_size = patch_cache_size
+
             load_completely = []
             loading.sort(reverse=True)
             for x in loading:
@@ -630,6 +812,8 @@ class ModelPatcher:
                             m.bias_function = [LowVramPatch(bias_key, self.patches)]
                             patch_counter += 1
 
+                    if hasattr(m, "comfy_cast_weights"):
+                        self.stream_lowvram_weights(m, device_to, cache_size=patch_cache_size)
                     cast_weight = True
                 else:
                     if hasattr(m, "comfy_cast_weights"):
@@ -652,6 +836,7 @@ class ModelPatcher:
                 mem_counter += move_weight_functions(m, device_to)
 
             load_completely.sort(reverse=True)
+            patch_keys = []
             for x in load_completely:
                 n = x[1]
                 m = x[2]
@@ -661,10 +846,11 @@ class ModelPatcher:
                         continue
 
                 for param in params:
-                    self.patch_weight_to_device("{}.{}".format(n, param), device_to=device_to)
+                    patch_keys.append("{}.{}".format(n, param))
 
                 logging.debug("lowvram: loaded module regularly {} {}".format(n, m))
                 m.comfy_patched_weights = True
+            self.patch_weights_to_device(patch_keys, device_to=device_to)
 
             for x in load_completely:
                 x[2].to(device_to)
@@ -683,6 +869,10 @@ class ModelPatcher:
             self.model.device = device_to
             self.model.model_loaded_weight_memory = mem_counter
             self.model.current_weight_patches_uuid = self.patches_uuid
+            if self.model.model_lowvram:
+                self.model.current_weight_patches = None
+            else:
+                self.model.current_weight_patches = {k: patch_list_signature(v) for k, v in self.patches.items()}
 
             for callback in self.get_all_callbacks(CallbacksMP.ON_LOAD):
                 callback(self, device_to, lowvram_model_memory, force_patch_weights, full_load)
@@ -717,6 +907,10 @@ class ModelPatcher:
 
                 self.model.model_lowvram = False
                 self.model.lowvram_patch_counter = 0
+                if self.model.weight_streamer is not None:
+                    self.model.weight_streamer.clear()
+                    self.model.weight_streamer.unpin()
+                    self.model.weight_streamer = None
 
             keys = list(self.backup.keys())
 
@@ -728,6 +922,7 @@ class ModelPatcher:
                     comfy.utils.set_attr_param(self.model, k, bk.weight)
 
             self.model.current_weight_patches_uuid = None
+            self.model.current_weight_patches = None
             self.backup.clear()
 
             if device_to is not None:
@@ -790,6 +985,7 @@ class ModelPatcher:
                             if bias_key in self.patches:
                                 m.bias_function.append(LowVramPatch(bias_key, self.patches))
                                 patch_counter += 1
+                            self.stream_lowvram_weights(m, self.model.device)
                             cast_weight = True
 
                         if cast_weight:
@@ -807,6 +1003,8 @@ class ModelPatcher:
     def partially_load(self, device_to, extra_memory=0, force_patch_weights=False):
         with self.use_ejected(skip_and_inject_on_exit_only=True):
             unpatch_weights = self.model.current_weight_patches_uuid is not None and (self.model.current_weight_patches_uuid != self.patches_uuid or force_patch_weights)
+            if unpatch_weights and not force_patch_weights and self.patch_weights_incrementally(device_to):
+                unpatch_weights = False
             # TODO: force_patch_weights should not unload + reload full model
             used = self.model.model_loaded_weight_memory
             self.unpatch_model(self.offload_device, unpatch_weights=unpatch_weights)
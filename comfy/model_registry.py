@@ -0,0 +1,164 @@
+"""
+Process wide registry of the models and weights loaded by loader nodes.
+
+Loader nodes with different node ids (or in different workflows) asking for the same file with the same
+options for the same device get the same objects back instead of loading the file again. An entry is shared
+for as long as anything (usually the output cache of some node) holds on to what was loaded. On top of that
+up to --model-cache-size bytes of recently used entries are kept alive by the registry itself, evicted least
+recently used first.
+"""
+import collections
+import collections.abc
+import os
+import logging
+import threading
+import time
+import weakref
+
+import torch
+
+import comfy.model_management
+from comfy.cli_args import args
+
+
+def file_key(paths):
+    """Identifies the current version of a set of files."""
+    out = []
+    for path in paths:
+        if path is None:
+            out.append(None)
+            continue
+        st = os.stat(path)
+        out.append((os.path.abspath(path), st.st_mtime_ns, st.st_size))
+    return tuple(out)
+
+def options_key(options):
+    if options is None:
+        return ()
+    return tuple(sorted((str(k), str(v)) for k, v in options.items()))
+
+def estimate_size(value):
+    if value is None:
+        return 0
+    if isinstance(value, torch.Tensor):
+        return value.nelement() * value.element_size()
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(v) for v in value)
+    if hasattr(value, "patcher"):
+        return estimate_size(value.patcher)
+    if hasattr(value, "model_size"):
+        return value.model_size()
+    if isinstance(value, collections.abc.Mapping):
+        return sum(estimate_size(v) for v in value.values())
+    return 0
+
+
+class ModelRegistry:
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.live = {}
+        self.retained = collections.OrderedDict()
+        self.retained_size = 0
+        self.load_locks = collections.defaultdict(threading.Lock)
+        self.read_rate = comfy.model_management.TransferRate()
+
+    def _get_live(self, key):
+        refs = self.live.get(key, None)
+        if refs is None:
+            return None
+        value = tuple(r() if r is not None else None for r in refs)
+        if any(r is not None and v is None for r, v in zip(refs, value)):
+            # Part of it was freed
+            del self.live[key]
+            return None
+        return value
+
+    def _set_live(self, key, value):
+        refs = []
+        for v in value:
+            if v is None:
+                refs.append(None)
+                continue
+            try:
+                refs.append(weakref.ref(v))
+            except TypeError:
+                # Can't tell when it gets freed, only the retained copy can be shared
+                return
+        self.live[key] = tuple(refs)
+
+    def _retain(self, key, value):
+        if self.max_size <= 0:
+            return
+        size = estimate_size(value)
+        if size > self.max_size:
+            return
+        old = self.retained.pop(key, None)
+        if old is not None:
+            self.retained_size -= old[1]
+        self.retained[key] = (value, size)
+        self.retained_size += size
+        while self.retained_size > self.max_size:
+            _, (_, evicted_size) = self.retained.popitem(last=False)
+            self.retained_size -= evicted_size
+
+    def _lookup(self, key):
+        with self.lock:
+            if key in self.retained:
+                self.retained.move_to_end(key)
+                return self.retained[key][0]
+            value = self._get_live(key)
+            if value is not None:
+                self._retain(key, value)
+            return value
+
+    def load(self, kind, paths, options, load_fn):
+        """
+        Returns the cached result of load_fn() for these files and options or calls it. kind tells apart loaders
+        that give different results for the same file, load_fn must return a tuple. Models are only shared
+        between loads for the same device (prompt workers each have their own, see --worker-devices).
+        """
+        key = (kind, file_key(paths), options_key(options), str(comfy.model_management.get_torch_device()))
+        value = self._lookup(key)
+        if value is not None:
+            return value
+
+        with self.lock:
+            load_lock = self.load_locks[key]
+        with load_lock:
+            # Another thread may have loaded it while we were waiting
+            value = self._lookup(key)
+            if value is None:
+                start = time.perf_counter()
+                value = tuple(load_fn())
+                self._log_load_time(key[1], time.perf_counter() - start)
+                with self.lock:
+                    self._set_live(key, value)
+                    self._retain(key, value)
+        with self.lock:
+            self.load_locks.pop(key, None)
+        return value
+
+    def _log_load_time(self, files, seconds):
+        files = [f for f in files if f is not None]
+        size = sum(f[2] for f in files)
+        names = ", ".join(os.path.basename(f[0]) for f in files)
+        expected = self.read_rate.expected_time(size)
+        if expected is None:
+            logging.info("Loaded {} ({:.0f}MB) in {:.2f}s".format(names, size / (1024 * 1024), seconds))
+        else:
+            logging.info("Loaded {} ({:.0f}MB) in {:.2f}s, expected {:.2f}s".format(names, size / (1024 * 1024), seconds, expected))
+        self.read_rate.update(size, seconds)
+
+    def clear(self):
+        with self.lock:
+            self.retained.clear()
+            self.retained_size = 0
+
+registry = ModelRegistry(args.model_cache_size)
+
+def load(kind, paths, options, load_fn):
+    return registry.load(kind, paths, options, load_fn)
+
+def clear():
+    registry.clear()
@@ -36,6 +36,9 @@ def cast_bias_weight(s, input=None, dtype=None, device=None, bias_dtype=None):
         if device is None:
             device = input.device
 
+    if s.comfy_weight_streamer is not None and s.comfy_cast_weights:
+        return s.comfy_weight_streamer.cast(s, dtype, bias_dtype, device)
+
     bias = None
     non_blocking = comfy.model_management.device_supports_non_blocking(device)
     if s.bias is not None:
@@ -54,6 +57,7 @@ def cast_bias_weight(s, input=None, dtype=None, device=None, bias_dtype=None):
 
 class CastWeightBiasOp:
     comfy_cast_weights = False
+    comfy_weight_streamer = None
     weight_function = []
     bias_function = []
 
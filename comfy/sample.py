@@ -1,15 +1,28 @@
 import torch
+import comfy.counter_noise
 import comfy.model_management
 import comfy.samplers
 import comfy.utils
 import numpy as np
 import logging
+from comfy.cli_args import args
+
+def prepare_device_noise(latent_image, seeds, noise_inds):
+    """Counter based noise for latent_image generated on the torch device, returned like the CPU noise on the device and layout of latent_image."""
+    noise = comfy.counter_noise.randn(latent_image.size(), seeds, noise_inds, dtype=latent_image.dtype, device=comfy.model_management.get_torch_device())
+    noise = noise.to(latent_image.device)
+    if latent_image.layout != torch.strided:
+        noise = noise.to_sparse(layout=latent_image.layout)
+    return noise
 
 def prepare_noise(latent_image, seed, noise_inds=None):
     """
     creates random noise given a latent image and a seed.
     optional arg skip can be used to skip and discard x number of noise generations for a given seed
     """
+    if args.device_noise:
+        return prepare_device_noise(latent_image, [seed] * latent_image.shape[0], noise_inds)
+
     generator = torch.manual_seed(seed)
     if noise_inds is None:
         return torch.randn(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, generator=generator, device="cpu")
@@ -24,6 +37,39 @@ def prepare_noise(latent_image, seed, noise_inds=None):
     noises = torch.cat(noises, axis=0)
     return noises
 
+def expand_latent_for_prompt_batch(latent, count):
+    """
+    Repeats every batch item of a latent once per coalesced prompt so that item j * count + i belongs to prompt i.
+    Latents that were already expanded are returned as is.
+    """
+    if latent.get("prompt_batch", 1) == count:
+        return latent
+    out = latent.copy()
+    out["samples"] = latent["samples"].repeat_interleave(count, dim=0)
+    if "noise_mask" in latent and latent["noise_mask"].shape[0] == latent["samples"].shape[0]:
+        out["noise_mask"] = latent["noise_mask"].repeat_interleave(count, dim=0)
+    if "batch_index" in latent:
+        out["batch_index"] = [i for i in latent["batch_index"] for _ in range(count)]
+    out["prompt_batch"] = count
+    return out
+
+def prepare_prompt_batch_noise(latent_image, seeds, noise_inds=None):
+    """
+    Noise for a latent expanded with expand_latent_for_prompt_batch, the noise of every prompt is the
+    same as prepare_noise would give for that prompt's seed on its own.
+    """
+    count = len(seeds)
+    if args.device_noise:
+        if noise_inds is None:
+            noise_inds = [i // count for i in range(latent_image.shape[0])]
+        item_seeds = [seeds[i % count] for i in range(latent_image.shape[0])]
+        return prepare_device_noise(latent_image, item_seeds, noise_inds)
+
+    if noise_inds is not None:
+        noise_inds = noise_inds[::count]
+    noises = [prepare_noise(latent_image[::count], seed, noise_inds) for seed in seeds]
+    return torch.stack(noises, dim=1).reshape(latent_image.shape)
+
 def fix_empty_latent_channels(model, latent_image):
     latent_format = model.get_model_object("latent_format") #Resize the empty latent image so it has the right number of channels
     if latent_format.latent_channels != latent_image.shape[1] and torch.count_nonzero(latent_image) == 0:
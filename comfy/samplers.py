@@ -16,6 +16,8 @@ import comfy.sampler_helpers
 import comfy.model_patcher
 import comfy.patcher_extension
 import comfy.hooks
+import comfy.adaptive_chunks
+import comfy.memory_calibration
 import scipy.stats
 import numpy
 
@@ -205,6 +207,77 @@ def calc_cond_batch(model: 'BaseModel', conds: list[list[dict]], x_in: torch.Ten
     )
     return executor.execute(model, conds, x_in, timestep, model_options)
 
+def group_conds(to_run):
+    """Splits the conds of a hook group in buckets of conds that can all be concatenated into one batch. Conds are first
+    split by area size, areas of different sizes are not padded together since a larger crop changes the output. Within an
+    area the conds that can_concat_cond with the most others start the buckets so conds of different conditioning lengths
+    share a pass whatever order they come in."""
+    areas = {}
+    for entry in to_run:
+        areas.setdefault(tuple(entry[0].input_x.shape), []).append(entry)
+
+    buckets = []
+    for entries in areas.values():
+        compatible = [{j for j, other in enumerate(entries) if can_concat_cond(entry[0], other[0])} for entry in entries]
+        remaining = sorted(range(len(entries)), key=lambda i: len(compatible[i]), reverse=True)
+        while len(remaining) > 0:
+            bucket = [i for i in remaining if i in compatible[remaining[0]]]
+            buckets.append([entries[i] for i in bucket])
+            remaining = [i for i in remaining if i not in bucket]
+    return buckets
+
+def max_cond_batch(model, bucket, free_memory, model_options={}):
+    """The largest number of conds of the bucket that fit in free_memory when run together, at least 1."""
+    first_shape = bucket[0][0].input_x.shape
+    device = bucket[0][0].input_x.device
+
+    def fits(count):
+        input_shape = [count * first_shape[0]] + list(first_shape)[1:]
+        memory_required = comfy.memory_calibration.estimate(model, input_shape, model_options, device)
+        if memory_required is None:
+            memory_required = model.memory_required(input_shape)
+        return memory_required * 1.5 < free_memory
+
+    if fits(len(bucket)):
+        return len(bucket)
+    low, high = 1, len(bucket)
+    while high - low > 1:
+        middle = (low + high) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle
+    return low
+
+def accumulate_cond_output(out_conds, out_counts, output, mult, area, cond_or_uncond):
+    """
+    Adds the chunks of output weighted by mult to out_conds, summing all the chunks for the same cond and area at once.
+    The sums are all computed before anything is added so running out of memory leaves out_conds as it was.
+    """
+    groups = {}
+    for o in range(len(cond_or_uncond)):
+        a = area[o]
+        groups.setdefault((cond_or_uncond[o], None if a is None else tuple(a)), []).append(o)
+
+    updates = []
+    for (cond_index, a), chunks in groups.items():
+        out_c = out_conds[cond_index]
+        out_cts = out_counts[cond_index]
+        if a is not None:
+            dims = len(a) // 2
+            for i in range(dims):
+                out_c = out_c.narrow(i + 2, a[i + dims], a[i])
+                out_cts = out_cts.narrow(i + 2, a[i + dims], a[i])
+        if len(chunks) == 1:
+            updates.append((out_c, output[chunks[0]] * mult[chunks[0]], out_cts, mult[chunks[0]]))
+        else:
+            m = torch.stack([mult[o] for o in chunks])
+            updates.append((out_c, (torch.stack([output[o] for o in chunks]) * m).sum(dim=0), out_cts, m.sum(dim=0)))
+
+    for out_c, delta, out_cts, count in updates:
+        out_c += delta
+        out_cts += count
+
 def _calc_cond_batch(model: 'BaseModel', conds: list[list[dict]], x_in: torch.Tensor, timestep, model_options):
     out_conds = []
     out_counts = []
@@ -239,26 +312,22 @@ def _calc_cond_batch(model: 'BaseModel', conds: list[list[dict]], x_in: torch.Te
 
     model.current_patcher.prepare_state(timestep)
 
-    # run every hooked_to_run separately
+    # run every hooked_to_run separately, the weights differ between hook groups
+    batches = []
     for hooks, to_run in hooked_to_run.items():
-        while len(to_run) > 0:
-            first = to_run[0]
-            first_shape = first[0][0].shape
-            to_batch_temp = []
-            for x in range(len(to_run)):
-                if can_concat_cond(to_run[x][0], first[0]):
-                    to_batch_temp += [x]
-
-            to_batch_temp.reverse()
-            to_batch = to_batch_temp[:1]
+        for bucket in group_conds(to_run):
+            batches.append((hooks, bucket))
 
+    def bucket_chunks(hooks, bucket, start, size):
+        """Runs the conds of bucket from start on, at most size of them at a time (see comfy.adaptive_chunks.run_chunks)."""
+        while start < len(bucket):
+            remaining = bucket[start:]
             free_memory = model_management.get_free_memory(x_in.device)
-            for i in range(1, len(to_batch_temp) + 1):
-                batch_amount = to_batch_temp[:len(to_batch_temp)//i]
-                input_shape = [len(batch_amount) * first_shape[0]] + list(first_shape)[1:]
-                if model.memory_required(input_shape) * 1.5 < free_memory:
-                    to_batch = batch_amount
-                    break
+            batch_size = min(size, max_cond_batch(model, remaining, free_memory, model_options))
+            # Same number of passes but evenly sized
+            batch_size = math.ceil(len(remaining) / math.ceil(len(remaining) / batch_size))
+            to_batch = remaining[:batch_size]
+            start += batch_size
 
             input_x = []
             mult = []
@@ -268,8 +337,7 @@ def _calc_cond_batch(model: 'BaseModel', conds: list[list[dict]], x_in: torch.Te
             area = []
             control = None
             patches = None
-            for x in to_batch:
-                o = to_run.pop(x)
+            for o in to_batch:
                 p = o[0]
                 input_x.append(p.input_x)
                 mult.append(p.mult)
@@ -313,26 +381,19 @@ def _calc_cond_batch(model: 'BaseModel', conds: list[list[dict]], x_in: torch.Te
             if control is not None:
                 c['control'] = control.get_control(input_x, timestep_, c, len(cond_or_uncond), transformer_options)
 
-            if 'model_function_wrapper' in model_options:
-                output = model_options['model_function_wrapper'](model.apply_model, {"input": input_x, "timestep": timestep_, "c": c, "cond_or_uncond": cond_or_uncond}).chunk(batch_chunks)
-            else:
-                output = model.apply_model(input_x, timestep_, **c).chunk(batch_chunks)
-
-            for o in range(batch_chunks):
-                cond_index = cond_or_uncond[o]
-                a = area[o]
-                if a is None:
-                    out_conds[cond_index] += output[o] * mult[o]
-                    out_counts[cond_index] += mult[o]
+            with comfy.memory_calibration.measure(model, input_x.shape, input_x.device, model_options):
+                if 'model_function_wrapper' in model_options:
+                    output = model_options['model_function_wrapper'](model.apply_model, {"input": input_x, "timestep": timestep_, "c": c, "cond_or_uncond": cond_or_uncond}).chunk(batch_chunks)
                 else:
-                    out_c = out_conds[cond_index]
-                    out_cts = out_counts[cond_index]
-                    dims = len(a) // 2
-                    for i in range(dims):
-                        out_c = out_c.narrow(i + 2, a[i + dims], a[i])
-                        out_cts = out_cts.narrow(i + 2, a[i + dims], a[i])
-                    out_c += output[o] * mult[o]
-                    out_cts += mult[o]
+                    output = model.apply_model(input_x, timestep_, **c).chunk(batch_chunks)
+
+            accumulate_cond_output(out_conds, out_counts, output, mult, area, cond_or_uncond)
+            yield start
+
+    for hooks, bucket in batches:
+        # Batches that run out of memory are split, keeping the outputs of the ones that ran
+        key = comfy.adaptive_chunks.size_key(model, bucket[0][0].input_x.shape, model.get_dtype(), x_in.device)
+        comfy.adaptive_chunks.run_chunks(partial(bucket_chunks, hooks, bucket), len(bucket), len(bucket), key)
 
     for i in range(len(out_conds)):
         out_conds[i] /= out_counts[i]
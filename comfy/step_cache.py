@@ -0,0 +1,103 @@
+"""
+Reuse of model features between sampling steps (DeepCache/TeaCache style).
+
+Consecutive sampling steps often produce nearly the same deep features. Models that support it hand a cheap
+probe tensor (the input of their first block modulated by the timestep, or their shallow features) to
+StepCache.lookup every call. The relative change of the probe since the previous step is accumulated and while it
+stays below the threshold the model skips its deep blocks and reuses what they produced on the last step that
+ran them: the residual they added to the hidden states for DiTs (Flux, MMDiT, Wan) or the deep feature map for
+the UNet, which then only runs its full resolution blocks.
+
+The cache lives in transformer_options["step_cache"] for the length of one sampling run, set up by an
+OUTER_SAMPLE wrapper that add_step_cache puts on a ModelPatcher.
+"""
+import logging
+
+import comfy.patcher_extension
+
+# Steps in a row that may reuse the cache before the blocks have to run again
+MAX_SKIPPED = 3
+WRAPPER_KEY = "step_cache"
+
+
+def relative_change(current, previous):
+    return ((current - previous).abs().mean() / previous.abs().mean().clamp(min=1e-8)).item()
+
+
+class CacheEntry:
+    """Cached features of one model call, cond and uncond batches (and differently sized inputs) each get one."""
+    def __init__(self):
+        self.probe = None
+        self.sigma = None
+        self.value = None
+        self.change = 0.0
+        self.skipped = 0
+        self.reuse = False
+
+
+class StepCache:
+    def __init__(self, threshold, start_sigma=float("inf"), end_sigma=0.0, max_skipped=MAX_SKIPPED):
+        self.threshold = threshold
+        self.start_sigma = start_sigma
+        self.end_sigma = end_sigma
+        self.max_skipped = max_skipped
+        self.entries = {}
+        self.calls = 0
+        self.reused = 0
+
+    def key(self, transformer_options, probe):
+        return (tuple(transformer_options.get("cond_or_uncond", ())), tuple(transformer_options.get("uuids", ())), tuple(probe.shape))
+
+    def lookup(self, transformer_options, probe):
+        """
+        The cache entry for this model call. If its reuse flag is set the model can skip the cached blocks and use
+        entry.value, otherwise it has to run them and store their result in entry.value.
+        """
+        key = self.key(transformer_options, probe)
+        sigmas = transformer_options.get("sigmas", None)
+        sigma = sigmas.max().item() if sigmas is not None else None
+
+        entry = self.entries.get(key, None)
+        if entry is None or (sigma is not None and entry.sigma is not None and sigma > entry.sigma):
+            # First step, or the sampler started over at a higher noise level
+            entry = CacheEntry()
+            self.entries[key] = entry
+        else:
+            entry.change += relative_change(probe, entry.probe)
+
+        in_range = sigma is None or self.end_sigma <= sigma <= self.start_sigma
+        entry.reuse = entry.value is not None and in_range and entry.change < self.threshold and entry.skipped < self.max_skipped
+        if entry.reuse:
+            entry.skipped += 1
+            self.reused += 1
+        else:
+            entry.change = 0.0
+            entry.skipped = 0
+        entry.probe = probe
+        entry.sigma = sigma
+        self.calls += 1
+        return entry
+
+
+def add_step_cache(model, threshold, start_percent=0.0, end_percent=1.0, max_skipped=MAX_SKIPPED):
+    """Enables the step cache on a ModelPatcher (clone it first), caching only between start_percent and end_percent of the sampling."""
+    model_sampling = model.get_model_object("model_sampling")
+    start_sigma = model_sampling.percent_to_sigma(start_percent)
+    end_sigma = model_sampling.percent_to_sigma(end_percent)
+
+    def outer_sample_wrapper(executor, *args, **kwargs):
+        transformer_options = executor.class_obj.model_options.setdefault("transformer_options", {})
+        cache = StepCache(threshold, start_sigma, end_sigma, max_skipped)
+        transformer_options["step_cache"] = cache
+        try:
+            return executor(*args, **kwargs)
+        finally:
+            transformer_options.pop("step_cache", None)
+            if cache.calls == 0:
+                logging.warning("The step cache is not supported by this model.")
+            else:
+                logging.info("Step cache: reused {} of {} model calls.".format(cache.reused, cache.calls))
+
+    model.remove_wrappers_with_key(comfy.patcher_extension.WrappersMP.OUTER_SAMPLE, WRAPPER_KEY)
+    model.add_wrapper_with_key(comfy.patcher_extension.WrappersMP.OUTER_SAMPLE, WRAPPER_KEY, outer_sample_wrapper)
+    return model
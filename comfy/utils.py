@@ -18,6 +18,10 @@
 
 
 import torch
+import os
+import json
+import collections
+import collections.abc
 import math
 import struct
 import comfy.checkpoint_pickle
@@ -30,6 +34,8 @@ from torch.nn.functional import interpolate
 from einops import rearrange
 
 ALWAYS_SAFE_LOAD = False
+# Memory map safetensors files and only create the tensors that are used, private file mappings aren't supported on Windows
+LAZY_SAFETENSORS_LOAD = os.name != "nt"
 if hasattr(torch.serialization, "add_safe_globals"):  # TODO: this was added in pytorch 2.4, the unsafe path should be removed once earlier versions are deprecated
     class ModelCheckpoint:
         pass
@@ -46,12 +52,113 @@ if hasattr(torch.serialization, "add_safe_globals"):  # TODO: this was added in
 else:
     logging.info("Warning, you are using an old pytorch version and some ckpt/pt files might be loaded unsafely. Upgrading to 2.4 or above is recommended.")
 
+SAFETENSORS_DTYPES = {
+    "BOOL": torch.bool,
+    "U8": torch.uint8,
+    "I8": torch.int8,
+    "I16": torch.int16,
+    "I32": torch.int32,
+    "I64": torch.int64,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "F32": torch.float32,
+    "F64": torch.float64,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    SAFETENSORS_DTYPES["F8_E4M3"] = torch.float8_e4m3fn
+    SAFETENSORS_DTYPES["F8_E5M2"] = torch.float8_e5m2
+
+LazyTensor = collections.namedtuple("LazyTensor", ["dtype", "shape", "start", "end"])
+
+class LazySafetensorsStateDict(collections.abc.MutableMapping):
+    """
+    State dict backed by a memory mapped safetensors file. Tensors are only created when accessed, as views
+    of the mapping (moved to device if it isn't the cpu) so nothing is read from disk until the weights are
+    actually used and nothing is copied to anonymous memory. Renaming keys with the state_dict_*_replace
+    functions doesn't create the tensors.
+    """
+    def __init__(self, data, entries, device):
+        self.data = data
+        self.entries = entries
+        self.device = device
+
+    def __getitem__(self, key):
+        value = self.entries[key]
+        if isinstance(value, LazyTensor):
+            value = self._materialize(*value)
+            self.entries[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+
+    def __delitem__(self, key):
+        del self.entries[key]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _materialize(self, dtype, shape, start, end):
+        if end == start:
+            t = torch.empty(shape, dtype=dtype)
+        else:
+            data = self.data[start:end]
+            if start % torch.empty((), dtype=dtype).element_size() != 0:
+                # Tensors after an odd sized one are misaligned, those need a copy
+                data = data.clone()
+            t = data.view(dtype).reshape(shape)
+        if self.device.type != "cpu":
+            t = t.to(self.device)
+        return t
+
+    def copy(self):
+        return LazySafetensorsStateDict(self.data, self.entries.copy(), self.device)
+
+    def empty_like(self):
+        return LazySafetensorsStateDict(self.data, {}, self.device)
+
+    def move_key(self, key, target, new_key):
+        """Moves key to new_key in target, another state dict of the same file, without creating the tensor."""
+        target.entries[new_key] = self.entries.pop(key)
+
+def load_safetensors_lazy(ckpt, device):
+    header_bytes = safetensors_header(ckpt)
+    if header_bytes is None:
+        raise ValueError("HeaderTooLarge")
+    try:
+        header = json.loads(header_bytes)
+    except ValueError:
+        raise ValueError("MetadataIncompleteBuffer")
+    file_size = os.path.getsize(ckpt)
+    data_start = 8 + len(header_bytes)
+    metadata = header.pop("__metadata__", None)
+    entries = {}
+    for k, info in header.items():
+        start, end = info["data_offsets"]
+        if data_start + end > file_size:
+            raise ValueError("MetadataIncompleteBuffer")
+        entries[k] = LazyTensor(SAFETENSORS_DTYPES[info["dtype"]], info["shape"], data_start + start, data_start + end)
+    data = torch.from_file(ckpt, shared=False, size=file_size, dtype=torch.uint8)
+    return LazySafetensorsStateDict(data, entries, device), metadata
+
 def load_torch_file(ckpt, safe_load=False, device=None, return_metadata=False):
     if device is None:
         device = torch.device("cpu")
     metadata = None
     if ckpt.lower().endswith(".safetensors") or ckpt.lower().endswith(".sft"):
         try:
+            if LAZY_SAFETENSORS_LOAD:
+                try:
+                    sd, metadata = load_safetensors_lazy(ckpt, device)
+                    return (sd, metadata) if return_metadata else sd
+                except KeyError as e:
+                    logging.debug("Can't load {} lazily, unsupported dtype {}".format(ckpt, e))
             with safetensors.safe_open(ckpt, framework="pt", device=device.type) as f:
                 sd = {}
                 for k in f.keys():
@@ -112,21 +219,29 @@ def weight_dtype(sd, prefix=""):
     return max(dtypes, key=dtypes.get)
 
 def state_dict_key_replace(state_dict, keys_to_replace):
+    lazy = isinstance(state_dict, LazySafetensorsStateDict)
     for x in keys_to_replace:
         if x in state_dict:
-            state_dict[keys_to_replace[x]] = state_dict.pop(x)
+            if lazy:
+                state_dict.move_key(x, state_dict, keys_to_replace[x])
+            else:
+                state_dict[keys_to_replace[x]] = state_dict.pop(x)
     return state_dict
 
 def state_dict_prefix_replace(state_dict, replace_prefix, filter_keys=False):
+    lazy = isinstance(state_dict, LazySafetensorsStateDict)
     if filter_keys:
-        out = {}
+        out = state_dict.empty_like() if lazy else {}
     else:
         out = state_dict
     for rp in replace_prefix:
         replace = list(map(lambda a: (a, "{}{}".format(replace_prefix[rp], a[len(rp):])), filter(lambda a: a.startswith(rp), state_dict.keys())))
         for x in replace:
-            w = state_dict.pop(x[0])
-            out[x[1]] = w
+            if lazy:
+                state_dict.move_key(x[0], out, x[1])
+            else:
+                w = state_dict.pop(x[0])
+                out[x[1]] = w
     return out
 
 
@@ -867,8 +982,47 @@ def get_tiled_scale_steps(width, height, tile_x, tile_y, overlap):
     cols = 1 if width <= tile_x else math.ceil((width - overlap) / (tile_x - overlap))
     return rows * cols
 
+# Blend masks of the tile shapes in use
+FEATHER_MASK_CACHE_SIZE = 16
+feather_masks = collections.OrderedDict()
+
+def get_feather_mask(shape, feathers, device):
+    """Mask of a tile of the given spatial shape that fades in over feathers[d] pixels at both ends of each dim."""
+    key = (tuple(shape), tuple(feathers), str(device))
+    mask = feather_masks.get(key, None)
+    if mask is not None:
+        feather_masks.move_to_end(key)
+        return mask
+
+    mask = torch.ones([1, 1] + list(shape), device=device)
+    for d in range(len(shape)):
+        length = shape[d]
+        feather = feathers[d]
+        if feather >= length:
+            continue
+        ramp = torch.ones(length)
+        for t in range(feather):
+            a = (t + 1) / feather
+            ramp[t] *= a
+            ramp[length - 1 - t] *= a
+        view = [1] * (len(shape) + 2)
+        view[d + 2] = length
+        mask = mask * ramp.to(device).view(view)
+
+    feather_masks[key] = mask
+    while len(feather_masks) > FEATHER_MASK_CACHE_SIZE:
+        feather_masks.popitem(last=False)
+    return mask
+
 @torch.inference_mode()
-def tiled_scale_multidim(samples, function, tile=(64, 64), overlap=8, upscale_amount=4, out_channels=3, output_device="cpu", downscale=False, index_formulas=None, pbar=None):
+def tiled_scale_multidim(samples, function, tile=(64, 64), overlap=8, upscale_amount=4, out_channels=3, output_device="cpu", downscale=False, index_formulas=None, pbar=None, max_batch=1, key=None):
+    """
+    Runs function on overlapping tiles of samples and blends the outputs together. Tiles of the same shape are run
+    max_batch items (tiles times batch items) at a time, fewer if they run out of memory (with the sizes learnt for
+    key, see comfy.adaptive_chunks).
+    """
+    # Not imported at the top, comfy.utils is used without initializing the devices
+    import comfy.adaptive_chunks
     dims = len(tile)
 
     if not (isinstance(upscale_amount, (tuple, list))):
@@ -924,62 +1078,90 @@ def tiled_scale_multidim(samples, function, tile=(64, 64), overlap=8, upscale_am
             out.append(round(get_scale(i, a[i])))
         return out
 
-    output = torch.empty([samples.shape[0], out_channels] + mult_list_upscale(samples.shape[2:]), device=output_device)
+    out_shape = [samples.shape[0], out_channels] + mult_list_upscale(samples.shape[2:])
+    max_batch = max(1, max_batch)
+
+    # handle entire input fitting in a single tile
+    if all(samples.shape[d+2] <= tile[d] for d in range(dims)):
+        output = torch.empty(out_shape, device=output_device)
+
+        def batch_chunks(start, size):
+            for b in range(start, samples.shape[0], size):
+                s = samples[b:b+size]
+                output[b:b+s.shape[0]] = function(s).to(output_device)
+                if pbar is not None:
+                    pbar.update(s.shape[0])
+                yield b + s.shape[0]
+
+        comfy.adaptive_chunks.run_chunks(batch_chunks, samples.shape[0], max_batch, key)
+        return output
+
+    out = torch.zeros(out_shape, device=output_device)
+    # The same for every batch item and channel
+    out_div = torch.zeros([1, 1] + out_shape[2:], device=output_device)
+    feathers = [round(get_scale(d, overlap[d])) for d in range(dims)]
+
+    positions = [range(0, samples.shape[d+2] - overlap[d], tile[d] - overlap[d]) if samples.shape[d+2] > tile[d] else [0] for d in range(dims)]
+    tiles = {}
+    for it in itertools.product(*positions):
+        pos = []
+        upscaled = []
+        for d in range(dims):
+            pos.append(max(0, min(samples.shape[d + 2] - overlap[d], it[d])))
+            upscaled.append(round(get_pos(d, pos[d])))
+        lengths = tuple(min(tile[d], samples.shape[d + 2] - pos[d]) for d in range(dims))
+        tiles.setdefault(lengths, []).append((pos, upscaled))
+
+    batch = samples.shape[0]
+
+    def tile_chunks(lengths, group, start, size):
+        # The work items are the (tile, batch item) pairs, tile after tile
+        total = len(group) * batch
+        for first in range(start, total, size):
+            last = min(first + size, total)
+            segments = []
+            for t in range(first // batch, (last - 1) // batch + 1):
+                segments.append((t, max(first - t * batch, 0), min(last - t * batch, batch)))
+
+            s_in = []
+            for t, b0, b1 in segments:
+                s = samples[b0:b1]
+                for d in range(dims):
+                    s = s.narrow(d + 2, group[t][0][d], lengths[d])
+                s_in.append(s)
+            ps = function(s_in[0] if len(s_in) == 1 else torch.cat(s_in)).to(output_device)
+
+            # Everything is computed before out is changed, a chunk that runs out of memory is run again
+            updates = []
+            offset = 0
+            for t, b0, b1 in segments:
+                p = ps[offset:offset + b1 - b0]
+                offset += b1 - b0
+                upscaled = group[t][1]
+                mask = get_feather_mask(p.shape[2:], feathers, output_device)
+                o = out[b0:b1]
+                o_d = out_div
+                for d in range(dims):
+                    o = o.narrow(d + 2, upscaled[d], mask.shape[d + 2])
+                    o_d = o_d.narrow(d + 2, upscaled[d], mask.shape[d + 2])
+                updates.append((o, p * mask, o_d if b0 == 0 else None, mask))
+
+            for o, p, o_d, mask in updates:
+                o.add_(p)
+                if o_d is not None:
+                    o_d.add_(mask)
 
-    for b in range(samples.shape[0]):
-        s = samples[b:b+1]
-
-        # handle entire input fitting in a single tile
-        if all(s.shape[d+2] <= tile[d] for d in range(dims)):
-            output[b:b+1] = function(s).to(output_device)
             if pbar is not None:
-                pbar.update(1)
-            continue
-
-        out = torch.zeros([s.shape[0], out_channels] + mult_list_upscale(s.shape[2:]), device=output_device)
-        out_div = torch.zeros([s.shape[0], out_channels] + mult_list_upscale(s.shape[2:]), device=output_device)
-
-        positions = [range(0, s.shape[d+2] - overlap[d], tile[d] - overlap[d]) if s.shape[d+2] > tile[d] else [0] for d in range(dims)]
+                pbar.update(last - first)
+            yield last
 
-        for it in itertools.product(*positions):
-            s_in = s
-            upscaled = []
+    for lengths, group in tiles.items():
+        comfy.adaptive_chunks.run_chunks(lambda start, size: tile_chunks(lengths, group, start, size), len(group) * batch, max_batch, key)
 
-            for d in range(dims):
-                pos = max(0, min(s.shape[d + 2] - overlap[d], it[d]))
-                l = min(tile[d], s.shape[d + 2] - pos)
-                s_in = s_in.narrow(d + 2, pos, l)
-                upscaled.append(round(get_pos(d, pos)))
-
-            ps = function(s_in).to(output_device)
-            mask = torch.ones_like(ps)
-
-            for d in range(2, dims + 2):
-                feather = round(get_scale(d - 2, overlap[d - 2]))
-                if feather >= mask.shape[d]:
-                    continue
-                for t in range(feather):
-                    a = (t + 1) / feather
-                    mask.narrow(d, t, 1).mul_(a)
-                    mask.narrow(d, mask.shape[d] - 1 - t, 1).mul_(a)
-
-            o = out
-            o_d = out_div
-            for d in range(dims):
-                o = o.narrow(d + 2, upscaled[d], mask.shape[d + 2])
-                o_d = o_d.narrow(d + 2, upscaled[d], mask.shape[d + 2])
-
-            o.add_(ps * mask)
-            o_d.add_(mask)
-
-            if pbar is not None:
-                pbar.update(1)
-
-        output[b:b+1] = out/out_div
-    return output
+    return out.div_(out_div)
 
-def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_amount = 4, out_channels = 3, output_device="cpu", pbar = None):
-    return tiled_scale_multidim(samples, function, (tile_y, tile_x), overlap=overlap, upscale_amount=upscale_amount, out_channels=out_channels, output_device=output_device, pbar=pbar)
+def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_amount = 4, out_channels = 3, output_device="cpu", pbar = None, max_batch=1, key=None):
+    return tiled_scale_multidim(samples, function, (tile_y, tile_x), overlap=overlap, upscale_amount=upscale_amount, out_channels=out_channels, output_device=output_device, pbar=pbar, max_batch=max_batch, key=key)
 
 PROGRESS_BAR_ENABLED = True
 def set_progress_bar_enabled(enabled):
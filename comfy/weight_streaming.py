@@ -0,0 +1,241 @@
+"""
+Streamed offload of lowvram weights.
+
+Modules that don't fit in VRAM keep their weights in (pinned) host memory and have them cast to the
+compute device every time they run. Without streaming that copy happens synchronously at the start of
+every module so the GPU sits idle while the weights cross the PCIe bus. The WeightStreamer records the
+order modules run in and, while one module computes, copies the weights of the next ones on a side
+stream. The patched weights of lowvram modules with LoRA patches are also kept on the compute device
+within a budget so the patches aren't recomputed and the weights aren't copied again every step.
+
+All device specific work goes through a StreamBackend: the base class does everything synchronously
+which is what happens on the CPU and other devices without streams, CudaStreamBackend does the copies
+on a CUDA side stream.
+"""
+import collections
+import weakref
+
+import torch
+
+import comfy.model_management
+
+# Modules ahead of the current one whose weights get copied in advance
+PREFETCH_DEPTH = 2
+
+
+class StreamBackend:
+    """Synchronous backend, every copy is done when it is issued."""
+    def pin(self, tensor):
+        return tensor
+
+    def unpin(self, tensor):
+        """Returns tensor in pageable memory if pin returned a pinned copy of it."""
+        return tensor
+
+    def copy(self, tensor, dtype, device, copy):
+        """Issues a copy of tensor to device on the side stream, returns the new tensor."""
+        return comfy.model_management.cast_to(tensor, dtype, device, copy=copy)
+
+    def record(self):
+        """Returns a handle to wait on for all the copies issued so far."""
+        return None
+
+    def wait(self, event, tensors):
+        """Makes the compute stream wait for event before using tensors."""
+        pass
+
+
+class CudaStreamBackend(StreamBackend):
+    def __init__(self, device):
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+
+    def pin(self, tensor):
+        if tensor.device.type != "cpu" or tensor.is_pinned():
+            return tensor
+        return tensor.pin_memory()
+
+    def unpin(self, tensor):
+        if tensor.device.type != "cpu" or not tensor.is_pinned():
+            return tensor
+        return torch.empty_like(tensor, pin_memory=False).copy_(tensor)
+
+    def copy(self, tensor, dtype, device, copy):
+        # The side stream must not start copying into memory the compute stream might still be using
+        self.stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(self.stream):
+            return comfy.model_management.cast_to(tensor, dtype, device, non_blocking=True, copy=copy)
+
+    def record(self):
+        event = torch.cuda.Event()
+        event.record(self.stream)
+        return event
+
+    def wait(self, event, tensors):
+        current = torch.cuda.current_stream(self.device)
+        current.wait_event(event)
+        for t in tensors:
+            if t is not None:
+                # Memory allocated on the side stream is now also used by the compute stream
+                t.record_stream(current)
+
+
+def get_backend(device):
+    if device is not None and device.type == "cuda" and torch.cuda.is_available():
+        return CudaStreamBackend(device)
+    return StreamBackend()
+
+
+def tensor_size(tensor):
+    if tensor is None:
+        return 0
+    return tensor.nelement() * tensor.element_size()
+
+
+class PatchedWeightCache:
+    """Least recently used patched (weight, bias) pairs of modules, up to max_size bytes."""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+
+    def get(self, module, dtype, bias_dtype, device):
+        entry = self.entries.get(module, None)
+        if entry is None or entry[0] != (dtype, bias_dtype, device):
+            return None
+        self.entries.move_to_end(module)
+        return entry[1]
+
+    def put(self, module, dtype, bias_dtype, device, weight, bias):
+        size = tensor_size(weight) + tensor_size(bias)
+        if size > self.max_size:
+            return
+        self.remove(module)
+        while self.size + size > self.max_size:
+            _, (_, _, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+        self.entries[module] = ((dtype, bias_dtype, device), (weight, bias), size)
+        self.size += size
+
+    def remove(self, module):
+        entry = self.entries.pop(module, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+def is_cacheable(module):
+    """Only the results of LowVramPatch functions depend on nothing but the weight and the patches."""
+    functions = module.weight_function + module.bias_function
+    return len(functions) > 0 and all(getattr(f, "comfy_cacheable", False) for f in functions)
+
+
+class WeightStreamer:
+    """
+    Casts the weights of the lowvram modules of one model, see the module docstring. Created when a model
+    is loaded in lowvram mode and attached to its modules as comfy_weight_streamer.
+    """
+    def __init__(self, backend, cache_size=0, prefetch_depth=PREFETCH_DEPTH):
+        self.backend = backend
+        self.prefetch_depth = prefetch_depth
+        self.cache = PatchedWeightCache(cache_size)
+        self.order = []
+        self.position = {}
+        self.last_cast = {}
+        self.pending = collections.OrderedDict()
+        self.repeated = False
+        # Weak references to the parameters pin moved to pinned memory
+        self.pinned = []
+
+    def pin(self, module):
+        for name in ("weight", "bias"):
+            param = getattr(module, name, None)
+            if param is not None:
+                pinned = self.backend.pin(param.data)
+                if pinned is not param.data:
+                    param.data = pinned
+                    self.pinned.append(weakref.ref(param))
+
+    def unpin(self):
+        """Moves the pinned weights back to pageable memory, pinned memory is scarce and only helps while streaming."""
+        for ref in self.pinned:
+            param = ref()
+            if param is not None:
+                param.data = self.backend.unpin(param.data)
+        self.pinned = []
+
+    def _copy(self, module, dtype, bias_dtype, device):
+        # The functions may modify the tensors they are given in place
+        bias = None
+        if module.bias is not None:
+            bias = self.backend.copy(module.bias, bias_dtype, device, len(module.bias_function) > 0)
+        weight = self.backend.copy(module.weight, dtype, device, len(module.weight_function) > 0)
+        return weight, bias
+
+    def _prefetch(self, index):
+        # Once a module ran twice the order is known and wraps around to the first modules of the next step
+        end = index + 1 + self.prefetch_depth
+        if not self.repeated:
+            end = min(end, len(self.order))
+        for i in range(index + 1, min(end, index + len(self.order))):
+            module = self.order[i % len(self.order)]
+            if module in self.pending:
+                continue
+            cast = self.last_cast[module]
+            if self.cache.get(module, *cast) is not None:
+                continue
+            weight, bias = self._copy(module, *cast)
+            self.pending[module] = (cast, weight, bias, self.backend.record())
+
+        # Prefetches of modules that didn't run when expected
+        while len(self.pending) > self.prefetch_depth * 2:
+            self.pending.popitem(last=False)
+
+    def cast(self, module, dtype, bias_dtype, device):
+        """Returns the weight and bias of module cast to dtype, bias_dtype and device with their functions applied."""
+        index = self.position.get(module, None)
+        if index is not None:
+            self.repeated = True
+        else:
+            index = len(self.order)
+            self.position[module] = index
+            self.order.append(module)
+        cast = (dtype, bias_dtype, device)
+        self.last_cast[module] = cast
+
+        cacheable = self.cache.max_size > 0 and is_cacheable(module)
+        if cacheable:
+            cached = self.cache.get(module, *cast)
+            if cached is not None:
+                self._prefetch(index)
+                return cached
+
+        pending = self.pending.pop(module, None)
+        if pending is not None and pending[0] == cast:
+            _, weight, bias, event = pending
+            self.backend.wait(event, (weight, bias))
+        else:
+            weight, bias = None, None
+
+        # Start the next copies before this module's patches are computed and it runs
+        self._prefetch(index)
+
+        if weight is None:
+            weight, bias = self._copy(module, *cast)
+            self.backend.wait(self.backend.record(), (weight, bias))
+
+        for f in module.bias_function:
+            bias = f(bias)
+        for f in module.weight_function:
+            weight = f(weight)
+
+        if cacheable:
+            self.cache.put(module, dtype, bias_dtype, device, weight, bias)
+        return weight, bias
+
+    def clear(self):
+        self.pending.clear()
+        self.cache.clear()
@@ -0,0 +1,98 @@
+import copy
+import json
+
+import nodes
+
+from comfy_execution.graph_utils import is_link, PromptBatch
+
+def get_batchable_inputs(class_type):
+    class_def = nodes.NODE_CLASS_MAPPINGS.get(class_type, None)
+    return getattr(class_def, "BATCHABLE_INPUTS", ())
+
+def expands_prompt_batch(class_type):
+    class_def = nodes.NODE_CLASS_MAPPINGS.get(class_type, None)
+    return getattr(class_def, "EXPANDS_PROMPT_BATCH", False)
+
+def expanding_node_after(prompt, consumers, node_id):
+    """Whether a node that uses the outputs of node_id, directly or through other nodes, expands the prompt batch."""
+    visited = set()
+    pending = list(consumers.get(node_id, ()))
+    while len(pending) > 0:
+        consumer = pending.pop()
+        if consumer in visited or consumer not in prompt:
+            continue
+        visited.add(consumer)
+        if expands_prompt_batch(prompt[consumer]["class_type"]):
+            return True
+        pending.extend(consumers.get(consumer, ()))
+    return False
+
+def prompt_batch_key(item):
+    """
+    Returns a key that is equal for queue items whose prompts only differ in the value of BATCHABLE_INPUTS
+    or None if the prompt has nothing that can be batched.
+    """
+    prompt, outputs_to_execute = item[2], item[4]
+    consumers = {}
+    for node_id, node in prompt.items():
+        for value in node["inputs"].values():
+            if is_link(value):
+                consumers.setdefault(value[0], []).append(node_id)
+
+    # A node expanding a latent that another one already expanded would expand it again: the expansion marker
+    # of the latent is lost on the way through the pixel space (VAEDecode -> VAEEncode)
+    for node_id, node in prompt.items():
+        if expands_prompt_batch(node["class_type"]) and expanding_node_after(prompt, consumers, node_id):
+            return None
+
+    masked = {}
+    has_batchable = False
+    for node_id, node in prompt.items():
+        batchable = get_batchable_inputs(node["class_type"])
+        inputs = {}
+        for name, value in node["inputs"].items():
+            if name in batchable:
+                if is_link(value):
+                    # The node would get a single value for all prompts and its outputs wouldn't line up with the rest of the batch
+                    return None
+                has_batchable = True
+                value = None
+            inputs[name] = value
+        if len(batchable) > 0 and not expands_prompt_batch(node["class_type"]):
+            # Outputs batched per prompt only line up with the latent if every node using them expands it
+            if not all(expands_prompt_batch(prompt[c]["class_type"]) for c in consumers.get(node_id, ()) if c in prompt):
+                return None
+        masked[node_id] = {"class_type": node["class_type"], "inputs": inputs}
+    if not has_batchable:
+        return None
+    try:
+        return json.dumps([masked, sorted(outputs_to_execute)], sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+
+def merge_prompts(prompts):
+    """Builds a single prompt where every BATCHABLE_INPUTS value is a PromptBatch of the values from each prompt."""
+    merged = copy.deepcopy(prompts[0])
+    for node_id, node in merged.items():
+        batchable = get_batchable_inputs(node["class_type"])
+        for name, value in node["inputs"].items():
+            if name in batchable and not is_link(value):
+                node["inputs"][name] = PromptBatch([p[node_id]["inputs"][name] for p in prompts])
+    return merged
+
+def split_history_result(history_result, count):
+    """
+    Splits the ui outputs of a merged prompt back into one history result per prompt. Batch item k of a
+    merged prompt belongs to prompt k % count, lists that can't be split that way are given to every prompt.
+    """
+    results = []
+    for i in range(count):
+        outputs = {}
+        for node_id, ui in history_result["outputs"].items():
+            outputs[node_id] = {}
+            for key, value in ui.items():
+                if isinstance(value, list) and len(value) > 0 and len(value) % count == 0:
+                    value = value[i::count]
+                outputs[node_id][key] = value
+        results.append({"outputs": outputs, "meta": copy.deepcopy(history_result["meta"])})
+    return results
@@ -1,7 +1,14 @@
-import itertools
+import hashlib
+import inspect
+import math
+import os
+import sys
+import time
 from typing import Sequence, Mapping, Dict
+import torch
 from comfy_execution.graph import DynamicPrompt
 
+import folder_paths
 import nodes
 
 from comfy_execution.graph_utils import is_link
@@ -43,18 +50,64 @@ class Unhashable:
     def __init__(self):
         self.value = float("NaN")
 
-def to_hashable(obj):
-    # So that we don't infinitely recurse since frozenset and tuples
-    # are Sequences.
-    if isinstance(obj, (int, float, str, bool, type(None))):
-        return obj
+class NotHashable(Exception):
+    pass
+
+def update_hash(h, obj):
+    """Feeds a node input value into the hash object h. Raises NotHashable for values that can't be keyed on."""
+    if isinstance(obj, float) and math.isnan(obj):
+        raise NotHashable()
+    elif isinstance(obj, (int, float, str, bool, type(None))):
+        h.update("{}:{!r}\0".format(type(obj).__name__, obj).encode("utf-8"))
+    elif isinstance(obj, (bytes, bytearray)):
+        h.update("bytes:{}\0".format(len(obj)).encode("utf-8"))
+        h.update(obj)
+    elif isinstance(obj, torch.Tensor):
+        t = obj.detach().cpu().contiguous()
+        h.update("tensor:{}:{}\0".format(t.dtype, tuple(t.shape)).encode("utf-8"))
+        h.update(t.reshape(-1).view(torch.uint8).numpy().tobytes())
     elif isinstance(obj, Mapping):
-        return frozenset([(to_hashable(k), to_hashable(v)) for k, v in sorted(obj.items())])
+        h.update("map:{}\0".format(len(obj)).encode("utf-8"))
+        for k, v in sorted(obj.items()):
+            update_hash(h, k)
+            update_hash(h, v)
     elif isinstance(obj, Sequence):
-        return frozenset(zip(itertools.count(), [to_hashable(i) for i in obj]))
+        h.update("seq:{}\0".format(len(obj)).encode("utf-8"))
+        for i in obj:
+            update_hash(h, i)
     else:
-        # TODO - Support other objects like tensors?
-        return Unhashable()
+        raise NotHashable()
+
+node_code_versions = {}
+
+def node_code_version(class_def):
+    """
+    Identifies the code of a node class by the file that defines it, so that results kept on disk aren't reused
+    once the node (or the custom node pack it's from) is updated.
+    """
+    version = node_code_versions.get(class_def, None)
+    if version is None:
+        try:
+            path = inspect.getsourcefile(class_def)
+            st = os.stat(path)
+            version = (os.path.basename(path), st.st_size, st.st_mtime_ns)
+        except (TypeError, OSError):
+            version = ()
+        node_code_versions[class_def] = version
+    return version
+
+def model_file_version(folder_name, filename):
+    """The size and modification time of a model file named by a MODEL_FILE_INPUTS input."""
+    if not isinstance(filename, str):
+        return None
+    try:
+        path = folder_paths.get_full_path(folder_name, filename)
+        if path is None:
+            return None
+        st = os.stat(path)
+    except (KeyError, OSError):
+        return None
+    return (st.st_size, st.st_mtime_ns)
 
 class CacheKeySetID(CacheKeySet):
     def __init__(self, dynprompt, node_ids, is_changed_cache):
@@ -73,10 +126,18 @@ class CacheKeySetID(CacheKeySet):
             self.subcache_keys[node_id] = (node_id, node["class_type"])
 
 class CacheKeySetInputSignature(CacheKeySet):
+    """
+    Keys every node by a Merkle style digest: a hash of the node's class and the version of its code, IS_CHANGED
+    result, constant inputs and the versions of the model files they name combined with the digests of the nodes
+    it is linked to. Each digest is computed once per prompt
+    and reused by all descendants. Nodes whose inputs can't be hashed get an Unhashable() key which only
+    matches itself, as do all their descendants.
+    """
     def __init__(self, dynprompt, node_ids, is_changed_cache):
         super().__init__(dynprompt, node_ids, is_changed_cache)
         self.dynprompt = dynprompt
         self.is_changed_cache = is_changed_cache
+        self.node_digests = {}
         self.add_keys(node_ids)
 
     def include_node_id_in_input(self) -> bool:
@@ -93,53 +154,63 @@ class CacheKeySetInputSignature(CacheKeySet):
             self.subcache_keys[node_id] = (node_id, node["class_type"])
 
     def get_node_signature(self, dynprompt, node_id):
-        signature = []
-        ancestors, order_mapping = self.get_ordered_ancestry(dynprompt, node_id)
-        signature.append(self.get_immediate_node_signature(dynprompt, node_id, order_mapping))
-        for ancestor_id in ancestors:
-            signature.append(self.get_immediate_node_signature(dynprompt, ancestor_id, order_mapping))
-        return to_hashable(signature)
-
-    def get_immediate_node_signature(self, dynprompt, node_id, ancestor_order_mapping):
-        if not dynprompt.has_node(node_id):
-            # This node doesn't exist -- we can't cache it.
-            return [float("NaN")]
+        # Iterative post-order walk so that long chains of nodes don't hit the recursion limit.
+        stack = [node_id]
+        visiting = set()
+        while len(stack) > 0:
+            current = stack[-1]
+            if current in self.node_digests:
+                stack.pop()
+                continue
+            if not dynprompt.has_node(current):
+                # This node doesn't exist -- we can't cache it.
+                self.node_digests[current] = Unhashable()
+                stack.pop()
+                continue
+            pending = [a for a in self.get_linked_node_ids(dynprompt, current) if a not in self.node_digests and a not in visiting]
+            if current not in visiting and len(pending) > 0:
+                visiting.add(current)
+                stack.extend(pending)
+                continue
+            stack.pop()
+            visiting.discard(current)
+            self.node_digests[current] = self.get_immediate_node_signature(dynprompt, current)
+        return self.node_digests[node_id]
+
+    def get_linked_node_ids(self, dynprompt, node_id):
+        inputs = dynprompt.get_node(node_id)["inputs"]
+        return [inputs[key][0] for key in sorted(inputs.keys()) if is_link(inputs[key])]
+
+    def get_immediate_node_signature(self, dynprompt, node_id):
         node = dynprompt.get_node(node_id)
         class_type = node["class_type"]
         class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
-        signature = [class_type, self.is_changed_cache.get(node_id)]
-        if self.include_node_id_in_input() or (hasattr(class_def, "NOT_IDEMPOTENT") and class_def.NOT_IDEMPOTENT) or include_unique_id_in_input(class_type):
-            signature.append(node_id)
-        inputs = node["inputs"]
-        for key in sorted(inputs.keys()):
-            if is_link(inputs[key]):
-                (ancestor_id, ancestor_socket) = inputs[key]
-                ancestor_index = ancestor_order_mapping[ancestor_id]
-                signature.append((key,("ANCESTOR", ancestor_index, ancestor_socket)))
-            else:
-                signature.append((key, inputs[key]))
-        return signature
-
-    # This function returns a list of all ancestors of the given node. The order of the list is
-    # deterministic based on which specific inputs the ancestor is connected by.
-    def get_ordered_ancestry(self, dynprompt, node_id):
-        ancestors = []
-        order_mapping = {}
-        self.get_ordered_ancestry_internal(dynprompt, node_id, ancestors, order_mapping)
-        return ancestors, order_mapping
-
-    def get_ordered_ancestry_internal(self, dynprompt, node_id, ancestors, order_mapping):
-        if not dynprompt.has_node(node_id):
-            return
-        inputs = dynprompt.get_node(node_id)["inputs"]
-        input_keys = sorted(inputs.keys())
-        for key in input_keys:
-            if is_link(inputs[key]):
-                ancestor_id = inputs[key][0]
-                if ancestor_id not in order_mapping:
-                    ancestors.append(ancestor_id)
-                    order_mapping[ancestor_id] = len(ancestors) - 1
-                    self.get_ordered_ancestry_internal(dynprompt, ancestor_id, ancestors, order_mapping)
+        h = hashlib.sha256()
+        try:
+            update_hash(h, class_type)
+            update_hash(h, node_code_version(class_def))
+            update_hash(h, self.is_changed_cache.get(node_id))
+            if self.include_node_id_in_input() or (hasattr(class_def, "NOT_IDEMPOTENT") and class_def.NOT_IDEMPOTENT) or include_unique_id_in_input(class_type):
+                update_hash(h, node_id)
+            inputs = node["inputs"]
+            for key in sorted(inputs.keys()):
+                update_hash(h, key)
+                if is_link(inputs[key]):
+                    (ancestor_id, ancestor_socket) = inputs[key]
+                    ancestor_digest = self.node_digests.get(ancestor_id, None)
+                    if not isinstance(ancestor_digest, str):
+                        raise NotHashable()
+                    h.update(b"ANCESTOR")
+                    update_hash(h, ancestor_digest)
+                    update_hash(h, ancestor_socket)
+                else:
+                    update_hash(h, inputs[key])
+            # A model file replaced under the same name gives different results
+            for key, folder_name in sorted(getattr(class_def, "MODEL_FILE_INPUTS", {}).items()):
+                update_hash(h, model_file_version(folder_name, inputs.get(key, None)))
+        except NotHashable:
+            return Unhashable()
+        return h.hexdigest()
 
 class BasicCache:
     def __init__(self, key_class):
@@ -149,6 +220,10 @@ class BasicCache:
         self.cache_key_set: CacheKeySet
         self.cache = {}
         self.subcaches = {}
+        self.disk_cache = None
+
+    def set_disk_cache(self, disk_cache):
+        self.disk_cache = disk_cache
 
     def set_prompt(self, dynprompt, node_ids, is_changed_cache):
         self.dynprompt = dynprompt
@@ -187,10 +262,21 @@ class BasicCache:
         self._clean_cache()
         self._clean_subcaches()
 
+    def _is_disk_cacheable(self, node_id):
+        if self.disk_cache is None or not self.dynprompt.has_node(node_id):
+            return False
+        class_def = nodes.NODE_CLASS_MAPPINGS[self.dynprompt.get_node(node_id)["class_type"]]
+        # Output nodes have side effects and non idempotent ones shouldn't outlive the process.
+        if getattr(class_def, "OUTPUT_NODE", False) or getattr(class_def, "NOT_IDEMPOTENT", False):
+            return False
+        return True
+
     def _set_immediate(self, node_id, value):
         assert self.initialized
         cache_key = self.cache_key_set.get_data_key(node_id)
         self.cache[cache_key] = value
+        if self._is_disk_cacheable(node_id):
+            self.disk_cache.set(cache_key, value)
 
     def _get_immediate(self, node_id):
         if not self.initialized:
@@ -198,6 +284,11 @@ class BasicCache:
         cache_key = self.cache_key_set.get_data_key(node_id)
         if cache_key in self.cache:
             return self.cache[cache_key]
+        elif cache_key is not None and self._is_disk_cacheable(node_id):
+            value = self.disk_cache.get(cache_key)
+            if value is not None:
+                self._set_immediate(node_id, value)
+            return value
         else:
             return None
 
@@ -206,6 +297,7 @@ class BasicCache:
         subcache = self.subcaches.get(subcache_key, None)
         if subcache is None:
             subcache = BasicCache(self.key_class)
+            subcache.set_disk_cache(self.disk_cache)
             self.subcaches[subcache_key] = subcache
         subcache.set_prompt(self.dynprompt, children_ids, self.is_changed_cache)
         return subcache
@@ -316,3 +408,161 @@ class LRUCache(BasicCache):
             self.children[cache_key].append(self.cache_key_set.get_data_key(child_id))
         return self
 
+
+def estimate_size(obj, seen=None):
+    """Best effort estimate of the number of bytes kept alive by a cached output."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, torch.Tensor):
+        storage_key = ("storage", obj.device, obj.untyped_storage().data_ptr())
+        if storage_key in seen:
+            return 0
+        seen.add(storage_key)
+        return obj.nelement() * obj.element_size()
+    elif isinstance(obj, (int, float, str, bool, bytes, type(None))):
+        return sys.getsizeof(obj)
+    elif isinstance(obj, Mapping):
+        return sys.getsizeof(obj) + sum(estimate_size(k, seen) + estimate_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(estimate_size(i, seen) for i in obj)
+    elif hasattr(obj, "model_size") and hasattr(obj, "model"):
+        # ModelPatcher: clones share the same underlying model
+        model_key = ("model", id(obj.model))
+        if model_key in seen:
+            return 0
+        seen.add(model_key)
+        return obj.model_size()
+    elif hasattr(obj, "patcher"):
+        # CLIP, VAE
+        return estimate_size(obj.patcher, seen)
+    return sys.getsizeof(obj)
+
+class RAMBudget:
+    """
+    Byte budget shared by RAMBudgetCaches, eviction picks the entry with the lowest priority across all of them.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.inflation = 0.0
+        self.caches = []
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes:
+            victim = None
+            for cache in self.caches:
+                for key in cache.cache:
+                    if cache.used_generation.get(key, 0) >= cache.generation:
+                        continue
+                    priority = cache.priorities.get(key, 0.0)
+                    if victim is None or priority < victim[0]:
+                        victim = (priority, cache, key)
+            if victim is None:
+                break
+            priority, cache, key = victim
+            self.inflation = priority
+            cache._remove(key)
+
+
+class RAMBudgetCache(LRUCache):
+    """
+    Cache bounded by the estimated size of its values instead of the number of entries.
+    Eviction uses the GreedyDual-Size policy: every entry gets a priority of
+    inflation + (time it took to compute) / (size), the entry with the lowest priority is
+    evicted first and its priority becomes the new inflation value so that entries which
+    haven't been used for a while eventually age out.
+    Entries used by the prompt currently executing are never evicted. Caches that share a
+    RAMBudget are bounded by it together.
+    """
+    def __init__(self, key_class, max_bytes=None, budget=None):
+        super().__init__(key_class, max_size=0)
+        if budget is None:
+            budget = RAMBudget(max_bytes)
+        self.budget = budget
+        budget.caches.append(self)
+        self.total_bytes = 0
+        self.sizes = {}
+        self.costs = {}
+        self.priorities = {}
+        self.miss_time = {}
+        self.counted = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def set_prompt(self, dynprompt, node_ids, is_changed_cache):
+        self.counted = set()
+        super().set_prompt(dynprompt, node_ids, is_changed_cache)
+
+    def _priority(self, cache_key):
+        size = max(self.sizes.get(cache_key, 0), 1)
+        return self.budget.inflation + self.costs.get(cache_key, 0.0) * (1024 * 1024 * 1024) / size
+
+    def get(self, node_id):
+        value = super().get(node_id)
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        if cache_key is None:
+            return value
+        if value is None:
+            # The last lookup before a set is the one done right before the node executes,
+            # the time in between is how long the output takes to recompute.
+            self.miss_time[cache_key] = time.perf_counter()
+        else:
+            self.priorities[cache_key] = self._priority(cache_key)
+        if cache_key not in self.counted:
+            self.counted.add(cache_key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, node_id, value):
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        start = self.miss_time.pop(cache_key, None)
+        if start is not None:
+            self.costs[cache_key] = time.perf_counter() - start
+        return super().set(node_id, value)
+
+    def _set_immediate(self, node_id, value):
+        super()._set_immediate(node_id, value)
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        size = estimate_size(value)
+        change = size - self.sizes.get(cache_key, 0)
+        self.total_bytes += change
+        self.budget.total_bytes += change
+        self.sizes[cache_key] = size
+        self.priorities[cache_key] = self._priority(cache_key)
+        self.budget.evict()
+
+    def _remove(self, cache_key):
+        size = self.sizes.pop(cache_key, 0)
+        self.total_bytes -= size
+        self.budget.total_bytes -= size
+        self.evictions += 1
+        self.evicted_bytes += size
+        del self.cache[cache_key]
+        self.used_generation.pop(cache_key, None)
+        self.children.pop(cache_key, None)
+        self.costs.pop(cache_key, None)
+        self.priorities.pop(cache_key, None)
+
+    def clean_unused(self):
+        self.budget.evict()
+        self._clean_subcaches()
+
+    def get_stats(self):
+        return {
+            "entries": len(self.cache),
+            "bytes": self.total_bytes,
+            "budget_bytes": self.budget.total_bytes,
+            "max_bytes": self.budget.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "evicted_bytes": self.evicted_bytes,
+        }
@@ -0,0 +1,259 @@
+import os
+import json
+import logging
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import safetensors
+import safetensors.torch
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+CACHE_FILE_EXTENSION = ".safetensors"
+METADATA_KEY = "comfy_cache"
+
+
+class NotSerializable(Exception):
+    pass
+
+
+def class_path(cls):
+    return "{}:{}".format(cls.__module__, cls.__qualname__)
+
+def resolve_class(path):
+    module, _, qualname = path.partition(":")
+    obj = importlib.import_module(module)
+    for name in qualname.split("."):
+        obj = getattr(obj, name)
+    return obj
+
+def serialize_value(value):
+    """
+    Splits a node output into a json skeleton and a dict of CPU tensors. Raises NotSerializable for anything
+    that wouldn't come back as the same type, like subclasses of dict or list.
+    """
+    tensors = {}
+    storages = set()
+
+    def walk(obj):
+        if isinstance(obj, torch.Tensor):
+            t = obj.detach().cpu()
+            storage = t.untyped_storage().data_ptr()
+            if storage in storages:
+                # safetensors refuses to save tensors sharing memory
+                t = t.clone()
+            else:
+                storages.add(storage)
+            name = str(len(tensors))
+            tensors[name] = t.contiguous()
+            return {"__tensor__": name}
+        elif type(obj) in (int, float, str, bool, type(None)):
+            return obj
+        elif type(obj) is tuple:
+            return {"__tuple__": [walk(i) for i in obj]}
+        elif isinstance(obj, tuple) and hasattr(obj, "_fields"):
+            path = class_path(type(obj))
+            try:
+                if resolve_class(path) is not type(obj):
+                    raise NotSerializable()
+            except (ImportError, AttributeError):
+                raise NotSerializable()
+            return {"__namedtuple__": path, "fields": [walk(i) for i in obj]}
+        elif type(obj) is list:
+            return [walk(i) for i in obj]
+        elif type(obj) is dict:
+            if not all(isinstance(k, str) for k in obj):
+                raise NotSerializable()
+            if "__tensor__" in obj or "__tuple__" in obj or "__namedtuple__" in obj:
+                raise NotSerializable()
+            return {k: walk(v) for k, v in obj.items()}
+        raise NotSerializable()
+
+    return walk(value), tensors
+
+def deserialize_value(skeleton, tensors):
+    def walk(obj):
+        if isinstance(obj, list):
+            return [walk(i) for i in obj]
+        elif isinstance(obj, dict):
+            if "__tensor__" in obj:
+                return tensors[obj["__tensor__"]]
+            if "__tuple__" in obj:
+                return tuple(walk(i) for i in obj["__tuple__"])
+            if "__namedtuple__" in obj:
+                return resolve_class(obj["__namedtuple__"])(*[walk(i) for i in obj["fields"]])
+            return {k: walk(v) for k, v in obj.items()}
+        return obj
+
+    return walk(skeleton)
+
+
+class FileLock:
+    """Exclusive advisory lock on a file, shared by every process using the same cache directory."""
+    def __init__(self, path):
+        self.path = path
+        self.thread_lock = threading.Lock()
+        self.file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        self.file = open(self.path, "a+b")
+        if os.name == "nt":
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if os.name == "nt":
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+        finally:
+            self.file = None
+            self.thread_lock.release()
+
+
+class DiskCache:
+    """
+    Persistent tier for node outputs, keyed by the input signature digest of the node.
+    Outputs made only of tensors and json compatible values are stored as safetensors files so
+    they survive restarts and can be shared by several ComfyUI instances using the same directory.
+    Outputs are copied to the CPU and written in the background and files are evicted least
+    recently used first once the total size of the directory goes over max_size.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock = FileLock(os.path.join(self.directory, ".lock"))
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="disk_cache")
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        # total_size is updated by the writer thread
+        self.size_lock = threading.Lock()
+        self.total_size = sum(size for _, size, _ in self._scan())
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + CACHE_FILE_EXTENSION)
+
+    def _scan(self):
+        out = []
+        for root, _, files in os.walk(self.directory):
+            for f in files:
+                if not f.endswith(CACHE_FILE_EXTENSION):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                out.append((path, st.st_size, st.st_mtime))
+        return out
+
+    def get(self, cache_key):
+        # Only digests from CacheKeySetInputSignature are stable across processes
+        if not isinstance(cache_key, str):
+            return None
+        path = self._path(cache_key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        try:
+            with safetensors.safe_open(path, framework="pt", device="cpu") as f:
+                skeleton = json.loads(f.metadata()[METADATA_KEY])
+                tensors = {k: f.get_tensor(k) for k in f.keys()}
+            value = deserialize_value(skeleton, tensors)
+            os.utime(path)
+        except Exception as e:
+            # Most likely evicted by another process while we were reading it, or a class that's gone
+            logging.debug("Failed to read disk cache entry {}: {}".format(path, e))
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def set(self, cache_key, value):
+        if not isinstance(cache_key, str):
+            return
+        digest = cache_key
+        path = self._path(digest)
+        if os.path.exists(path):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return
+        with self.pending_lock:
+            if digest in self.pending:
+                return
+            self.pending.add(digest)
+        # Serialized on the writer thread so the copies of GPU outputs don't hold up the execution
+        self.writer.submit(self._write, digest, path, value)
+
+    def flush(self):
+        """Waits for the writes already submitted."""
+        self.writer.submit(lambda: None).result()
+
+    def _write(self, digest, path, value):
+        try:
+            try:
+                skeleton, tensors = serialize_value(value)
+            except NotSerializable:
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = "{}.{}.tmp".format(path, os.getpid())
+            safetensors.torch.save_file(tensors, temp_path, metadata={METADATA_KEY: json.dumps(skeleton)})
+            size = os.path.getsize(temp_path)
+            with self.lock:
+                os.replace(temp_path, path)
+            with self.size_lock:
+                self.total_size += size
+                self.writes += 1
+                over = self.total_size > self.max_size
+            if over:
+                self.evict()
+        except Exception as e:
+            logging.warning("Failed to write disk cache entry {}: {}".format(path, e))
+        finally:
+            with self.pending_lock:
+                self.pending.discard(digest)
+
+    def evict(self):
+        with self.lock:
+            # Other processes write to the same directory, recount before deleting anything.
+            entries = self._scan()
+            total_size = sum(size for _, size, _ in entries)
+            for path, size, _ in sorted(entries, key=lambda x: x[2]):
+                if total_size <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                    total_size -= size
+                except OSError:
+                    pass
+            with self.size_lock:
+                self.total_size = total_size
+
+    def get_stats(self):
+        with self.size_lock:
+            total_size = self.total_size
+        return {
+            "bytes": total_size,
+            "max_bytes": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+        }
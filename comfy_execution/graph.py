@@ -1,3 +1,5 @@
+import queue
+
 import nodes
 
 from comfy_execution.graph_utils import is_link
@@ -159,15 +161,44 @@ class ExecutionList(TopologicalSort):
         super().__init__(dynprompt)
         self.output_cache = output_cache
         self.staged_node_id = None
+        self.external_blocks = 0
+        self.unblocked = queue.Queue()
 
     def is_cached(self, node_id):
         return self.output_cache.get(node_id) is not None
 
+    def add_external_block(self, node_id):
+        """
+        Keeps node_id from being staged until the returned function is called. The function may be
+        called from any thread, the block is only released the next time a node is staged.
+        """
+        assert node_id in self.blockCount
+        self.external_blocks += 1
+        self.blockCount[node_id] += 1
+        def unblock():
+            self.unblocked.put(node_id)
+        return unblock
+
+    def _release_external_blocks(self, wait=False):
+        while self.external_blocks > 0:
+            try:
+                node_id = self.unblocked.get(block=wait)
+            except queue.Empty:
+                return
+            wait = False
+            self.external_blocks -= 1
+            self.blockCount[node_id] -= 1
+
     def stage_node_execution(self):
         assert self.staged_node_id is None
         if self.is_empty():
             return None, None, None
+        self._release_external_blocks()
         available = self.get_ready_nodes()
+        while len(available) == 0 and self.external_blocks > 0:
+            # Everything left depends on nodes running in the background
+            self._release_external_blocks(wait=True)
+            available = self.get_ready_nodes()
         if len(available) == 0:
             cycled_nodes = self.get_nodes_in_cycle()
             # Because cycles composed entirely of static nodes are caught during initial validation,
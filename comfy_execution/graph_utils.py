@@ -1,5 +1,15 @@
+import threading
+
+class PromptBatch(list):
+    """
+    The values one input had in each of several queued prompts that are executed together as a
+    single batched prompt (see comfy_execution.batching). Only nodes listing the input in
+    BATCHABLE_INPUTS ever receive one.
+    """
+    pass
+
 def is_link(obj):
-    if not isinstance(obj, list):
+    if not isinstance(obj, list) or isinstance(obj, PromptBatch):
         return False
     if len(obj) != 2:
         return False
@@ -11,9 +21,8 @@ def is_link(obj):
 
 # The GraphBuilder is just a utility class that outputs graphs in the form expected by the ComfyUI back-end
 class GraphBuilder:
-    _default_prefix_root = ""
-    _default_prefix_call_index = 0
-    _default_prefix_graph_index = 0
+    # Per thread, THREAD_SAFE nodes run on the node worker threads
+    _default_prefix = threading.local()
 
     def __init__(self, prefix = None):
         if prefix is None:
@@ -25,20 +34,21 @@ class GraphBuilder:
 
     @classmethod
     def set_default_prefix(cls, prefix_root, call_index, graph_index = 0):
-        cls._default_prefix_root = prefix_root
-        cls._default_prefix_call_index = call_index
-        cls._default_prefix_graph_index = graph_index
+        cls._default_prefix.root = prefix_root
+        cls._default_prefix.call_index = call_index
+        cls._default_prefix.graph_index = graph_index
 
     @classmethod
     def alloc_prefix(cls, root=None, call_index=None, graph_index=None):
+        default = GraphBuilder._default_prefix
         if root is None:
-            root = GraphBuilder._default_prefix_root
+            root = getattr(default, "root", "")
         if call_index is None:
-            call_index = GraphBuilder._default_prefix_call_index
+            call_index = getattr(default, "call_index", 0)
         if graph_index is None:
-            graph_index = GraphBuilder._default_prefix_graph_index
+            graph_index = getattr(default, "graph_index", 0)
         result = f"{root}.{call_index}.{graph_index}."
-        GraphBuilder._default_prefix_graph_index += 1
+        default.graph_index = getattr(default, "graph_index", 0) + 1
         return result
 
     def node(self, class_type, id=None, **kwargs):
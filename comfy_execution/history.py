@@ -0,0 +1,203 @@
+import json
+import logging
+import sqlite3
+import threading
+
+
+class HistoryStore:
+    """
+    Storage for finished prompts. Entries are json compatible dicts keyed by prompt_id and returned
+    oldest first. Every entry gets an increasing sequence number that can be used as a pagination cursor.
+    Implementations do their own locking so reading the history never blocks the prompt queue.
+    """
+    def put(self, prompt_id, entry, completed_at, status):
+        raise NotImplementedError()
+
+    def get(self, prompt_id):
+        raise NotImplementedError()
+
+    def query(self, max_items=None, offset=-1, before=None, status=None, since=None, until=None):
+        """
+        Returns (entries, next_cursor). entries is a dict of prompt_id -> entry, next_cursor is the value
+        to pass as before to get the page of older entries or None if there are none.
+        Without offset the newest max_items matching entries are returned, with it max_items entries
+        are returned starting at that position.
+        """
+        raise NotImplementedError()
+
+    def delete(self, prompt_id):
+        raise NotImplementedError()
+
+    def wipe(self):
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+
+class MemoryHistoryStore(HistoryStore):
+    """Keeps the history in memory, it is lost on restart."""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.seq = 0
+
+    def put(self, prompt_id, entry, completed_at, status):
+        with self.lock:
+            self.entries.pop(prompt_id, None)
+            self.seq += 1
+            self.entries[prompt_id] = (self.seq, completed_at, status, entry)
+            while len(self.entries) > self.max_size:
+                self.entries.pop(next(iter(self.entries)))
+
+    def get(self, prompt_id):
+        with self.lock:
+            if prompt_id in self.entries:
+                return self.entries[prompt_id][3]
+            return None
+
+    def query(self, max_items=None, offset=-1, before=None, status=None, since=None, until=None):
+        with self.lock:
+            items = list(self.entries.items())
+        matches = []
+        for prompt_id, (seq, completed_at, entry_status, entry) in items:
+            if before is not None and seq >= before:
+                continue
+            if status is not None and entry_status != status:
+                continue
+            if since is not None and completed_at < since:
+                continue
+            if until is not None and completed_at > until:
+                continue
+            matches.append((seq, prompt_id, entry))
+        if offset is not None and offset >= 0:
+            matches = matches[offset:]
+            if max_items is not None:
+                matches = matches[:max_items]
+            next_cursor = None
+        else:
+            start = 0
+            if max_items is not None:
+                start = max(len(matches) - max_items, 0)
+            next_cursor = matches[start][0] if start > 0 else None
+            matches = matches[start:]
+        return {prompt_id: entry for _, prompt_id, entry in matches}, next_cursor
+
+    def delete(self, prompt_id):
+        with self.lock:
+            self.entries.pop(prompt_id, None)
+
+    def wipe(self):
+        with self.lock:
+            self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """
+    Keeps the history in a sqlite database so it survives restarts. Lookups by prompt_id, pages and
+    filters on status or completion time all go through indexes.
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS history (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            prompt_id TEXT NOT NULL UNIQUE,
+            completed_at REAL NOT NULL,
+            status TEXT,
+            data TEXT NOT NULL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS history_completed_at ON history (completed_at)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS history_status ON history (status, seq)")
+        self.count = self.connection.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    @staticmethod
+    def serialize(entry):
+        try:
+            return json.dumps(entry)
+        except (TypeError, ValueError):
+            logging.warning("History entry isn't json serializable, storing the values that aren't as strings.", exc_info=True)
+        try:
+            return json.dumps(entry, default=str)
+        except (TypeError, ValueError):
+            # Circular references, only the status is kept
+            return json.dumps({"outputs": {}, "status": entry.get("status", None)}, default=str)
+
+    def put(self, prompt_id, entry, completed_at, status):
+        # Called from the prompt worker, a history entry that can't be stored must not stop it
+        data = self.serialize(entry)
+        with self.lock:
+            try:
+                cursor = self.connection.execute("DELETE FROM history WHERE prompt_id = ?", (prompt_id,))
+                self.count -= cursor.rowcount
+                self.connection.execute("INSERT INTO history (prompt_id, completed_at, status, data) VALUES (?, ?, ?, ?)",
+                                        (prompt_id, completed_at, status, data))
+                self.count += 1
+                if self.count > self.max_size:
+                    cursor = self.connection.execute("DELETE FROM history WHERE seq IN (SELECT seq FROM history ORDER BY seq LIMIT ?)",
+                                                     (self.count - self.max_size,))
+                    self.count -= cursor.rowcount
+            except sqlite3.Error:
+                logging.error("Failed to store the history of prompt {}.".format(prompt_id), exc_info=True)
+
+    def get(self, prompt_id):
+        with self.lock:
+            row = self.connection.execute("SELECT data FROM history WHERE prompt_id = ?", (prompt_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def query(self, max_items=None, offset=-1, before=None, status=None, since=None, until=None):
+        conditions = []
+        params = []
+        if before is not None:
+            conditions.append("seq < ?")
+            params.append(before)
+        if status is not None:
+            conditions.append("status = ?")
+            params.append(status)
+        if since is not None:
+            conditions.append("completed_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("completed_at <= ?")
+            params.append(until)
+        where = ""
+        if len(conditions) > 0:
+            where = "WHERE " + " AND ".join(conditions)
+
+        next_cursor = None
+        with self.lock:
+            if offset is not None and offset >= 0:
+                rows = self.connection.execute("SELECT seq, prompt_id, data FROM history {} ORDER BY seq LIMIT ? OFFSET ?".format(where),
+                                               params + [-1 if max_items is None else max_items, offset]).fetchall()
+            else:
+                # One extra row tells if there is an older page
+                limit = -1 if max_items is None else max_items + 1
+                rows = self.connection.execute("SELECT seq, prompt_id, data FROM history {} ORDER BY seq DESC LIMIT ?".format(where),
+                                               params + [limit]).fetchall()
+                if max_items is not None and len(rows) > max_items:
+                    rows = rows[:max_items]
+                    next_cursor = rows[-1][0]
+                rows.reverse()
+        return {prompt_id: json.loads(data) for _, prompt_id, data in rows}, next_cursor
+
+    def delete(self, prompt_id):
+        with self.lock:
+            cursor = self.connection.execute("DELETE FROM history WHERE prompt_id = ?", (prompt_id,))
+            self.count -= cursor.rowcount
+
+    def wipe(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM history")
+            self.count = 0
+
+    def __len__(self):
+        return self.count
@@ -0,0 +1,95 @@
+"""
+Plans which models stay loaded based on the prompts in the queue.
+
+The model files a prompt uses are found through the MODEL_FILE_INPUTS of its loader nodes. Before a
+prompt runs, the files it and the next queued prompts use are handed to comfy.model_management so that
+when memory has to be freed, the models no upcoming prompt needs are unloaded first and the ones needed
+next are unloaded last (and only partially if that frees enough). Files of upcoming prompts that aren't
+loaded are read ahead into the OS page cache so loading them from disk is faster.
+"""
+import heapq
+import logging
+import os
+import threading
+
+import folder_paths
+import nodes
+import comfy.model_management
+
+# Queued prompts looked at after the one about to run
+LOOKAHEAD = 4
+
+
+def prompt_model_files(prompt):
+    """Full paths of the model files the loader nodes of prompt will load."""
+    out = []
+    for node in prompt.values():
+        class_def = nodes.NODE_CLASS_MAPPINGS.get(node.get("class_type", None), None)
+        model_inputs = getattr(class_def, "MODEL_FILE_INPUTS", None)
+        if model_inputs is None:
+            continue
+        inputs = node.get("inputs", {})
+        for name, folder in model_inputs.items():
+            value = inputs.get(name, None)
+            if not isinstance(value, str):
+                continue
+            path = folder_paths.get_full_path(folder, value)
+            if path is not None and path not in out:
+                out.append(path)
+    return out
+
+
+def read_ahead(path):
+    """Asks the OS to get a file into the page cache, only supported where posix_fadvise is."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logging.debug("Could not read ahead {}: {}".format(path, e))
+
+
+class ResidencyPlanner:
+    def __init__(self, lookahead=LOOKAHEAD):
+        self.lookahead = lookahead
+        self.prompt_files = {}
+        self.read_ahead_files = set()
+        self.lock = threading.Lock()
+
+    def files(self, prompt_id, prompt):
+        files = self.prompt_files.get(prompt_id, None)
+        if files is None:
+            files = prompt_model_files(prompt)
+            self.prompt_files[prompt_id] = files
+        return files
+
+    def plan(self, queue):
+        """Called by the prompt workers with the PromptQueue once they have taken the prompts they are about to run."""
+        running, pending = queue.get_current_queue()
+        pending = heapq.nsmallest(self.lookahead, pending)
+        # Everything running (on any device) needs its models now
+        upcoming = [(0, item) for item in running] + [(i + 1, item) for i, item in enumerate(pending)]
+
+        with self.lock:
+            next_use = {}
+            for rank, item in upcoming:
+                for f in self.files(item[1], item[2]):
+                    next_use.setdefault(f, rank)
+            live = set(item[1] for _, item in upcoming)
+            for prompt_id in list(self.prompt_files):
+                if prompt_id not in live:
+                    del self.prompt_files[prompt_id]
+
+            loaded = comfy.model_management.loaded_model_files(None)
+            to_read = [f for f, rank in next_use.items() if rank > 0 and f not in loaded and f not in self.read_ahead_files]
+            # Only read ahead again once a file has dropped out of the plan
+            self.read_ahead_files = set(f for f in self.read_ahead_files if f in next_use) | set(to_read)
+
+        comfy.model_management.set_upcoming_model_files(next_use)
+        for path in to_read:
+            read_ahead(path)
+        return next_use
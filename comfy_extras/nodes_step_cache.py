@@ -0,0 +1,32 @@
+import comfy.step_cache
+
+
+class StepCache:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"model": ("MODEL",),
+                             "threshold": ("FLOAT", {"default": 0.2, "min": 0.0, "max": 5.0, "step": 0.01, "tooltip": "How much the input may change over the reused steps. Higher is faster and less accurate, 0 disables the cache."}),
+                             "start_percent": ("FLOAT", {"default": 0.1, "min": 0.0, "max": 1.0, "step": 0.001}),
+                             "end_percent": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.001}),
+                             "max_skipped_steps": ("INT", {"default": comfy.step_cache.MAX_SKIPPED, "min": 1, "max": 100, "tooltip": "Steps in a row that may reuse the cache."}),
+                             }}
+    RETURN_TYPES = ("MODEL",)
+    FUNCTION = "patch"
+    EXPERIMENTAL = True
+
+    CATEGORY = "advanced/model"
+    DESCRIPTION = "Speeds up sampling by reusing the deep features of the model from the previous step when its input barely changed. Supported by UNet models (SD1.x, SDXL...), Flux, SD3 and Wan."
+
+    def patch(self, model, threshold, start_percent, end_percent, max_skipped_steps):
+        m = model.clone()
+        comfy.step_cache.add_step_cache(m, threshold, start_percent, end_percent, max_skipped_steps)
+        return (m, )
+
+
+NODE_CLASS_MAPPINGS = {
+    "StepCache": StepCache,
+}
+
+NODE_DISPLAY_NAME_MAPPINGS = {
+    "StepCache": "Step Cache",
+}
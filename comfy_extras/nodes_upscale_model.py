@@ -2,6 +2,7 @@ import logging
 from spandrel import ModelLoader, ImageModelDescriptor
 from comfy import model_management
 import torch
+import comfy.adaptive_chunks
 import comfy.utils
 import folder_paths
 
@@ -60,13 +61,18 @@ class ImageUpscaleWithModel:
 
         tile = 512
         overlap = 32
+        #Tiles of the same size run together as long as they fit in the free memory
+        tile_memory = (tile * tile * 3) * image.element_size() * max(upscale_model.scale, 1.0) * 384.0
+        max_batch = max(1, int(model_management.get_free_memory(device) // tile_memory))
 
         oom = True
         while oom:
             try:
                 steps = in_img.shape[0] * comfy.utils.get_tiled_scale_steps(in_img.shape[3], in_img.shape[2], tile_x=tile, tile_y=tile, overlap=overlap)
                 pbar = comfy.utils.ProgressBar(steps)
-                s = comfy.utils.tiled_scale(in_img, lambda a: upscale_model(a), tile_x=tile, tile_y=tile, overlap=overlap, upscale_amount=upscale_model.scale, pbar=pbar)
+                #Batches of tiles that run out of memory are halved, the tile only when a single one doesn't fit
+                key = comfy.adaptive_chunks.size_key(upscale_model.model, (in_img.shape[1], tile, tile), in_img.dtype, device)
+                s = comfy.utils.tiled_scale(in_img, lambda a: upscale_model(a), tile_x=tile, tile_y=tile, overlap=overlap, upscale_amount=upscale_model.scale, pbar=pbar, max_batch=max_batch, key=key)
                 oom = False
             except model_management.OOM_EXCEPTION as e:
                 tile //= 2
@@ -1,5 +1,7 @@
 import sys
 import copy
+import collections
+import concurrent.futures
 import logging
 import threading
 import heapq
@@ -15,8 +17,10 @@ import nodes
 import comfy.model_management
 from comfy_execution.graph import get_input_info, ExecutionList, DynamicPrompt, ExecutionBlocker
 from comfy_execution.graph_utils import is_link, GraphBuilder
-from comfy_execution.caching import HierarchicalCache, LRUCache, CacheKeySetInputSignature, CacheKeySetID
+from comfy_execution.caching import HierarchicalCache, LRUCache, RAMBudget, RAMBudgetCache, CacheKeySetInputSignature, CacheKeySetID
 from comfy_execution.validation import validate_node_input
+from comfy_execution.batching import merge_prompts, split_history_result
+from comfy_execution.history import MemoryHistoryStore
 
 class ExecutionResult(Enum):
     SUCCESS = 0
@@ -60,11 +64,16 @@ class IsChangedCache:
         return self.is_changed[node_id]
 
 class CacheSet:
-    def __init__(self, lru_size=None):
-        if lru_size is None or lru_size == 0:
+    def __init__(self, lru_size=None, ram_budget=None, disk_cache=None):
+        if ram_budget is not None and ram_budget > 0:
+            self.init_ram_budget_cache(ram_budget)
+        elif lru_size is None or lru_size == 0:
             self.init_classic_cache()
         else:
             self.init_lru_cache(lru_size)
+        if disk_cache is not None:
+            self.outputs.set_disk_cache(disk_cache)
+        self.disk_cache = disk_cache
         self.all = [self.outputs, self.ui, self.objects]
 
     # Useful for those with ample RAM/VRAM -- allows experimenting without
@@ -74,6 +83,13 @@ class CacheSet:
         self.ui = LRUCache(CacheKeySetInputSignature, max_size=cache_size)
         self.objects = HierarchicalCache(CacheKeySetID)
 
+    # Like the LRU cache but bounded by the estimated size of the cached outputs, outputs and ui share the budget
+    def init_ram_budget_cache(self, max_bytes):
+        budget = RAMBudget(max_bytes)
+        self.outputs = RAMBudgetCache(CacheKeySetInputSignature, budget=budget)
+        self.ui = RAMBudgetCache(CacheKeySetInputSignature, budget=budget)
+        self.objects = HierarchicalCache(CacheKeySetID)
+
     # Performs like the old cache -- dump data ASAP
     def init_classic_cache(self):
         self.outputs = HierarchicalCache(CacheKeySetInputSignature)
@@ -87,6 +103,16 @@ class CacheSet:
         }
         return result
 
+    def get_stats(self):
+        stats = {}
+        if hasattr(self.outputs, "get_stats"):
+            stats["memory"] = self.outputs.get_stats()
+        if self.disk_cache is not None:
+            stats["disk"] = self.disk_cache.get_stats()
+        if len(stats) == 0:
+            return None
+        return stats
+
 def get_input_data(inputs, class_def, unique_id, outputs=None, dynprompt=None, extra_data={}):
     valid_inputs = class_def.INPUT_TYPES()
     input_data_all = {}
@@ -245,7 +271,7 @@ def format_value(x):
     else:
         return str(x)
 
-def execute(server, dynprompt, caches, current_item, extra_data, executed, prompt_id, execution_list, pending_subgraph_results):
+def execute(server, dynprompt, caches, current_item, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, pending_async_results=None, thread_pool=None):
     unique_id = current_item
     real_node_id = dynprompt.get_real_node_id(unique_id)
     display_node_id = dynprompt.get_display_node_id(unique_id)
@@ -282,6 +308,8 @@ def execute(server, dynprompt, caches, current_item, extra_data, executed, promp
             output_data = merge_result_data(resolved_outputs, class_def)
             output_ui = []
             has_subgraph = False
+        elif pending_async_results is not None and unique_id in pending_async_results:
+            output_data, output_ui, has_subgraph = pending_async_results.pop(unique_id).result()
         else:
             input_data_all, missing_keys = get_input_data(inputs, class_def, unique_id, caches.outputs, dynprompt, extra_data)
             if server.client_id is not None:
@@ -324,6 +352,23 @@ def execute(server, dynprompt, caches, current_item, extra_data, executed, promp
                     return block
             def pre_execute_cb(call_index):
                 GraphBuilder.set_default_prefix(unique_id, call_index, 0)
+            if thread_pool is not None and getattr(class_def, "THREAD_SAFE", False):
+                # Run the node in the background and come back to it once it's done. Everything
+                # other than the node function itself (caches, execution list) stays on this thread.
+                # The worker thread gets its own execution context so the progress it reports goes
+                # to this node while the main loop moves on to other nodes.
+                context = (server.client_id, server.last_prompt_id, display_node_id)
+                interrupt_scope = comfy.model_management.get_interrupt_scope()
+                def run_node():
+                    server.set_thread_execution_context(*context)
+                    comfy.model_management.set_interrupt_scope(interrupt_scope)
+                    with torch.inference_mode():
+                        return get_output_data(obj, input_data_all, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb)
+                unblock = execution_list.add_external_block(unique_id)
+                future = thread_pool.submit(run_node)
+                pending_async_results[unique_id] = future
+                future.add_done_callback(lambda _: unblock())
+                return (ExecutionResult.PENDING, None, None)
             output_data, output_ui, has_subgraph = get_output_data(obj, input_data_all, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb)
         if len(output_ui) > 0:
             caches.ui.set(unique_id, {
@@ -414,13 +459,18 @@ def execute(server, dynprompt, caches, current_item, extra_data, executed, promp
     return (ExecutionResult.SUCCESS, None, None)
 
 class PromptExecutor:
-    def __init__(self, server, lru_size=None):
+    def __init__(self, server, lru_size=None, ram_budget=None, disk_cache=None, parallel_workers=0):
         self.lru_size = lru_size
+        self.ram_budget = ram_budget
+        self.disk_cache = disk_cache
         self.server = server
+        self.thread_pool = None
+        if parallel_workers > 0:
+            self.thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=parallel_workers, thread_name_prefix="node_worker")
         self.reset()
 
     def reset(self):
-        self.caches = CacheSet(self.lru_size)
+        self.caches = CacheSet(self.lru_size, self.ram_budget, self.disk_cache)
         self.status_messages = []
         self.success = True
 
@@ -463,6 +513,9 @@ class PromptExecutor:
 
     def execute(self, prompt, prompt_id, extra_data={}, execute_outputs=[]):
         nodes.interrupt_processing(False)
+        # execute_batch already set the ids of all the batched prompts
+        if prompt_id not in comfy.model_management.get_interrupt_scope():
+            comfy.model_management.set_interrupt_scope([prompt_id])
 
         if "client_id" in extra_data:
             self.server.client_id = extra_data["client_id"]
@@ -473,7 +526,8 @@ class PromptExecutor:
         self.add_message("execution_start", { "prompt_id": prompt_id}, broadcast=False)
 
         with torch.inference_mode():
-            dynamic_prompt = DynamicPrompt(prompt)
+            # Queue items are shared with queue snapshots and the history, nodes get their own copy
+            dynamic_prompt = DynamicPrompt(copy.deepcopy(prompt))
             is_changed_cache = IsChangedCache(dynamic_prompt, self.caches.outputs)
             for cache in self.caches.all:
                 cache.set_prompt(dynamic_prompt, prompt.keys(), is_changed_cache)
@@ -489,6 +543,7 @@ class PromptExecutor:
                           { "nodes": cached_nodes, "prompt_id": prompt_id},
                           broadcast=False)
             pending_subgraph_results = {}
+            pending_async_results = {}
             executed = set()
             execution_list = ExecutionList(dynamic_prompt, self.caches.outputs)
             current_outputs = self.caches.outputs.all_node_ids()
@@ -501,7 +556,7 @@ class PromptExecutor:
                     self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
                     break
 
-                result, error, ex = execute(self.server, dynamic_prompt, self.caches, node_id, extra_data, executed, prompt_id, execution_list, pending_subgraph_results)
+                result, error, ex = execute(self.server, dynamic_prompt, self.caches, node_id, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, pending_async_results, self.thread_pool)
                 self.success = result != ExecutionResult.FAILURE
                 if result == ExecutionResult.FAILURE:
                     self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
@@ -514,6 +569,9 @@ class PromptExecutor:
                 # Only execute when the while-loop ends without break
                 self.add_message("execution_success", { "prompt_id": prompt_id }, broadcast=False)
 
+            # Don't let nodes from a failed prompt keep running into the next one
+            concurrent.futures.wait(pending_async_results.values())
+
             ui_outputs = {}
             meta_outputs = {}
             all_node_ids = self.caches.ui.all_node_ids()
@@ -527,10 +585,38 @@ class PromptExecutor:
                 "meta": meta_outputs,
             }
             self.server.last_node_id = None
+            for interrupted_id in comfy.model_management.get_interrupt_scope():
+                nodes.interrupt_processing(False, interrupted_id)
+            comfy.model_management.set_interrupt_scope([])
             if comfy.model_management.DISABLE_SMART_MEMORY:
                 comfy.model_management.unload_all_models()
 
 
+    def execute_batch(self, items):
+        """
+        Executes queue items with the same prompt_batch_key as a single batched prompt.
+        Returns a (history_result, status_messages) tuple for each item.
+        """
+        prompt_id = items[0][1]
+        # Progress of the merged prompt isn't sent to anyone, each client gets its own results once it's done
+        extra_data = {k: v for k, v in items[0][3].items() if k != "client_id"}
+        comfy.model_management.set_interrupt_scope([item[1] for item in items])
+        self.execute(merge_prompts([item[2] for item in items]), prompt_id, extra_data, items[0][4])
+
+        results = []
+        for item, history_result in zip(items, split_history_result(self.history_result, len(items))):
+            messages = [(event, {**data, "prompt_id": item[1]}) for event, data in self.status_messages]
+            client_id = item[3].get("client_id", None)
+            if client_id is not None:
+                for event, data in messages:
+                    if event == "execution_success":
+                        for node_id, output_ui in history_result["outputs"].items():
+                            self.server.send_sync("executed", { "node": node_id, "display_node": node_id, "output": output_ui, "prompt_id": item[1] }, client_id)
+                    self.server.send_sync(event, data, client_id)
+            results.append((history_result, messages))
+        return results
+
+
 def validate_inputs(prompt, item, validated):
     unique_id = item
     if unique_id in validated:
@@ -867,38 +953,105 @@ def validate_prompt(prompt):
     return (True, None, list(good_outputs), node_errors)
 
 MAXIMUM_HISTORY_SIZE = 10000
+# Number of queue changes kept for get_queue_changes
+QUEUE_CHANGE_LOG_SIZE = 1000
+# How far past the front of the queue a worker may look for a prompt it has the models loaded for
+AFFINITY_LOOKAHEAD = 8
 
 class PromptQueue:
-    def __init__(self, server):
+    def __init__(self, server, history=None):
         self.server = server
         self.mutex = threading.RLock()
         self.not_empty = threading.Condition(self.mutex)
         self.task_counter = 0
         self.queue = []
         self.currently_running = {}
-        self.history = {}
+        if history is None:
+            history = MemoryHistoryStore(MAXIMUM_HISTORY_SIZE)
+        self.history = history
         self.flags = {}
+        # A copy of the flags for every prompt worker, so each one sees every flag
+        self.worker_flags = []
+        self.version = 0
+        self.changes = collections.deque(maxlen=QUEUE_CHANGE_LOG_SIZE)
         server.prompt_queue = self
 
+    @staticmethod
+    def item_info(item):
+        return {
+            "number": item[0],
+            "prompt_id": item[1],
+            "client_id": item[3].get("client_id", None),
+            "outputs_to_execute": item[4],
+        }
+
+    def _changed(self, action, item=None, item_id=None):
+        # Must be called with the mutex held
+        self.version += 1
+        change = {"version": self.version, "action": action}
+        if item is not None:
+            change.update(self.item_info(item))
+        if item_id is not None:
+            change["task_id"] = item_id
+        self.changes.append(change)
+        self.server.queue_updated()
+
     def put(self, item):
+        """Queue items are never modified once queued, they are shared with snapshots and the history."""
         with self.mutex:
             heapq.heappush(self.queue, item)
-            self.server.queue_updated()
+            self._changed("added", item)
             self.not_empty.notify()
 
-    def get(self, timeout=None):
+    def _pop_item(self, affinity=None):
+        if affinity is not None:
+            for item in heapq.nsmallest(AFFINITY_LOOKAHEAD, self.queue):
+                if affinity(item):
+                    self.queue.remove(item)
+                    heapq.heapify(self.queue)
+                    return item
+        return heapq.heappop(self.queue)
+
+    def get(self, timeout=None, affinity=None):
         with self.not_empty:
             while len(self.queue) == 0:
                 self.not_empty.wait(timeout=timeout)
                 if timeout is not None and len(self.queue) == 0:
                     return None
-            item = heapq.heappop(self.queue)
+            item = self._pop_item(affinity)
             i = self.task_counter
-            self.currently_running[i] = copy.deepcopy(item)
+            self.currently_running[i] = item
             self.task_counter += 1
-            self.server.queue_updated()
+            self._changed("started", item, i)
             return (item, i)
 
+    def get_batch(self, batch_key, max_batch_size, timeout=None, affinity=None):
+        """
+        Like get but also takes up to max_batch_size - 1 other queued items for which batch_key returns
+        the same key as for the first one. Returns a list of (item, item_id).
+        """
+        with self.not_empty:
+            first = self.get(timeout=timeout, affinity=affinity)
+            if first is None:
+                return None
+            batch = [first]
+            key = batch_key(first[0])
+            if key is None:
+                return batch
+            for item in heapq.nsmallest(AFFINITY_LOOKAHEAD * max_batch_size, self.queue):
+                if len(batch) >= max_batch_size:
+                    break
+                if batch_key(item) == key:
+                    self.queue.remove(item)
+                    i = self.task_counter
+                    self.currently_running[i] = item
+                    self.task_counter += 1
+                    batch.append((item, i))
+                    self._changed("started", item, i)
+            if len(batch) > 1:
+                heapq.heapify(self.queue)
+            return batch
+
     class ExecutionStatus(NamedTuple):
         status_str: Literal['success', 'error']
         completed: bool
@@ -907,28 +1060,59 @@ class PromptQueue:
     def task_done(self, item_id, history_result,
                   status: Optional['PromptQueue.ExecutionStatus']):
         with self.mutex:
-            prompt = self.currently_running.pop(item_id)
-            if len(self.history) > MAXIMUM_HISTORY_SIZE:
-                self.history.pop(next(iter(self.history)))
-
-            status_dict: Optional[dict] = None
-            if status is not None:
-                status_dict = copy.deepcopy(status._asdict())
-
-            self.history[prompt[1]] = {
-                "prompt": prompt,
-                "outputs": {},
-                'status': status_dict,
-            }
-            self.history[prompt[1]].update(history_result)
-            self.server.queue_updated()
+            prompt = self.currently_running[item_id]
+
+        status_dict: Optional[dict] = None
+        if status is not None:
+            status_dict = copy.deepcopy(status._asdict())
+
+        entry = {
+            "prompt": prompt,
+            "outputs": {},
+            'status': status_dict,
+        }
+        entry.update(history_result)
+        self.history.put(prompt[1], entry, time.time(), status.status_str if status is not None else None)
+        # Only announce the change once the history entry can be fetched
+        with self.mutex:
+            self.currently_running.pop(item_id)
+            self._changed("finished", prompt, item_id)
 
     def get_current_queue(self):
         with self.mutex:
-            out = []
-            for x in self.currently_running.values():
-                out += [x]
-            return (out, copy.deepcopy(self.queue))
+            return (list(self.currently_running.values()), list(self.queue))
+
+    def get_queue_snapshot(self, include_prompts=False):
+        """
+        Returns the running and pending items along with the version of the queue they were taken at.
+        Items are only described by item_info unless include_prompts is set.
+        """
+        with self.mutex:
+            version = self.version
+            running = list(self.currently_running.items())
+            pending = list(self.queue)
+        pending.sort()
+        if include_prompts:
+            return {"version": version, "queue_running": [item for _, item in running], "queue_pending": pending}
+        return {
+            "version": version,
+            "queue_running": [{**self.item_info(item), "task_id": i} for i, item in running],
+            "queue_pending": [self.item_info(item) for item in pending],
+        }
+
+    def get_queue_changes(self, since_version):
+        """
+        Returns the changes made to the queue after since_version, oldest first, or None if they are no
+        longer all known and a new snapshot has to be taken.
+        """
+        with self.mutex:
+            if since_version > self.version:
+                return None
+            if since_version == self.version:
+                return []
+            if len(self.changes) == 0 or self.changes[0]["version"] > since_version + 1:
+                return None
+            return [c for c in self.changes if c["version"] > since_version]
 
     def get_tasks_remaining(self):
         with self.mutex:
@@ -937,58 +1121,57 @@ class PromptQueue:
     def wipe_queue(self):
         with self.mutex:
             self.queue = []
-            self.server.queue_updated()
+            self._changed("cleared")
 
     def delete_queue_item(self, function):
         with self.mutex:
             for x in range(len(self.queue)):
                 if function(self.queue[x]):
-                    if len(self.queue) == 1:
-                        self.wipe_queue()
-                    else:
-                        self.queue.pop(x)
-                        heapq.heapify(self.queue)
-                    self.server.queue_updated()
+                    item = self.queue.pop(x)
+                    heapq.heapify(self.queue)
+                    self._changed("removed", item)
                     return True
         return False
 
     def get_history(self, prompt_id=None, max_items=None, offset=-1):
-        with self.mutex:
-            if prompt_id is None:
-                out = {}
-                i = 0
-                if offset < 0 and max_items is not None:
-                    offset = len(self.history) - max_items
-                for k in self.history:
-                    if i >= offset:
-                        out[k] = self.history[k]
-                        if max_items is not None and len(out) >= max_items:
-                            break
-                    i += 1
-                return out
-            elif prompt_id in self.history:
-                return {prompt_id: copy.deepcopy(self.history[prompt_id])}
-            else:
-                return {}
+        if prompt_id is None:
+            return self.history.query(max_items=max_items, offset=offset)[0]
+        entry = self.history.get(prompt_id)
+        if entry is not None:
+            return {prompt_id: copy.deepcopy(entry)}
+        return {}
+
+    def query_history(self, max_items=None, offset=-1, before=None, status=None, since=None, until=None):
+        """Returns (history, next_cursor), see HistoryStore.query."""
+        return self.history.query(max_items=max_items, offset=offset, before=before, status=status, since=since, until=until)
 
     def wipe_history(self):
-        with self.mutex:
-            self.history = {}
+        self.history.wipe()
 
     def delete_history_item(self, id_to_delete):
+        self.history.delete(id_to_delete)
+
+    def register_worker(self):
+        """Returns the id a prompt worker gets its own copy of the flags with from get_flags."""
         with self.mutex:
-            self.history.pop(id_to_delete, None)
+            self.worker_flags.append({})
+            return len(self.worker_flags) - 1
 
     def set_flag(self, name, data):
         with self.mutex:
             self.flags[name] = data
-            self.not_empty.notify()
+            for flags in self.worker_flags:
+                flags[name] = data
+            self.not_empty.notify_all()
 
-    def get_flags(self, reset=True):
+    def get_flags(self, reset=True, worker=None):
         with self.mutex:
+            flags = self.flags if worker is None else self.worker_flags[worker]
             if reset:
-                ret = self.flags
-                self.flags = {}
-                return ret
+                if worker is None:
+                    self.flags = {}
+                else:
+                    self.worker_flags[worker] = {}
+                return flags
             else:
-                return self.flags.copy()
+                return flags.copy()
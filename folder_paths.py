@@ -4,6 +4,8 @@ import os
 import time
 import mimetypes
 import logging
+import threading
+import contextlib
 from typing import Literal
 from collections.abc import Collection
 
@@ -83,6 +85,30 @@ class CacheHelper:
 
 cache_helper = CacheHelper()
 
+class DependencyRecorder:
+    """
+    Records the model folders and directories looked up while recording, so what is computed from them (like the
+    node definitions of /object_info) can be kept until one of them changes, see dependency_version.
+    """
+    def __init__(self):
+        self.local = threading.local()
+
+    def add(self, dependency: tuple[str, str]) -> None:
+        recorded = getattr(self.local, "recorded", None)
+        if recorded is not None:
+            recorded.add(dependency)
+
+    @contextlib.contextmanager
+    def record(self):
+        previous = getattr(self.local, "recorded", None)
+        self.local.recorded = set()
+        try:
+            yield self.local.recorded
+        finally:
+            self.local.recorded = previous
+
+dependency_recorder = DependencyRecorder()
+
 extension_mimetypes_cache = {
     "webp" : "image",
 }
@@ -112,14 +138,17 @@ def set_input_directory(input_dir: str) -> None:
 
 def get_output_directory() -> str:
     global output_directory
+    dependency_recorder.add(("directory", "output"))
     return output_directory
 
 def get_temp_directory() -> str:
     global temp_directory
+    dependency_recorder.add(("directory", "temp"))
     return temp_directory
 
 def get_input_directory() -> str:
     global input_directory
+    dependency_recorder.add(("directory", "input"))
     return input_directory
 
 def get_user_directory() -> str:
@@ -223,6 +252,7 @@ def add_model_folder_path(folder_name: str, full_folder_path: str, is_default: b
 
 def get_folder_paths(folder_name: str) -> list[str]:
     folder_name = map_legacy(folder_name)
+    dependency_recorder.add(("paths", folder_name))
     return folder_names_and_paths[folder_name][0][:]
 
 def recursive_search(directory: str, excluded_dir_names: list[str] | None=None) -> tuple[list[str], dict[str, float]]:
@@ -336,6 +366,7 @@ def cached_filename_list_(folder_name: str) -> tuple[list[str], dict[str, float]
 
 def get_filename_list(folder_name: str) -> list[str]:
     folder_name = map_legacy(folder_name)
+    dependency_recorder.add(("folder", folder_name))
     out = cached_filename_list_(folder_name)
     if out is None:
         out = get_filename_list_(folder_name)
@@ -344,6 +375,38 @@ def get_filename_list(folder_name: str) -> list[str]:
     cache_helper.set(folder_name, out)
     return list(out[0])
 
+def directory_version(path: str) -> tuple | None:
+    """Changes when files are added to or removed from the directory or its direct subdirectories."""
+    try:
+        version = [path, os.stat(path).st_mtime_ns]
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    version.append((entry.name, entry.stat().st_mtime_ns))
+    except OSError:
+        return None
+    return tuple(version)
+
+def dependency_version(dependency: tuple[str, str]):
+    """A value that changes when the folder or directory a DependencyRecorder recorded changes."""
+    kind, name = dependency
+    if kind == "paths":
+        # The paths of a folder are scanned by the caller, any files under them can matter
+        try:
+            paths = folder_names_and_paths[name][0]
+        except KeyError:
+            return None
+        return tuple(directory_version(path) for path in paths)
+    if kind == "folder":
+        try:
+            get_filename_list(name)
+        except KeyError:
+            return None
+        # The time of the last scan, only rescanned when the folder changed
+        return filename_list_cache[name][2]
+    directories = {"input": input_directory, "output": output_directory, "temp": temp_directory}
+    return directory_version(directories[name])
+
 def get_save_image_path(filename_prefix: str, output_dir: str, image_width=0, image_height=0) -> tuple[str, str, int, str, str]:
     def map_filename(filename: str) -> tuple[int, str]:
         prefix_len = len(os.path.basename(filename_prefix))
@@ -1,3 +1,7 @@
+import concurrent.futures
+import threading
+import time
+
 import torch
 from PIL import Image
 from comfy.cli_args import args, LatentPreviewMethod
@@ -59,7 +63,22 @@ class Latent2RGBPreviewer(LatentPreviewer):
         return preview_to_image(latent_image)
 
 
+# Previewers are kept for the life of the process so TAESD is only loaded once per latent format and device
+previewers = {}
+previewers_lock = threading.Lock()
+preview_executor = None
+
 def get_previewer(device, latent_format):
+    method = args.preview_method
+    if method == LatentPreviewMethod.NoPreviews:
+        return None
+    key = (method, type(latent_format).__name__, str(device))
+    with previewers_lock:
+        if key not in previewers:
+            previewers[key] = load_previewer(device, latent_format)
+        return previewers[key]
+
+def load_previewer(device, latent_format):
     previewer = None
     method = args.preview_method
     if method != LatentPreviewMethod.NoPreviews:
@@ -88,12 +107,88 @@ def get_previewer(device, latent_format):
                 previewer = Latent2RGBPreviewer(latent_format.latent_rgb_factors, latent_format.latent_rgb_factors_bias)
     return previewer
 
+def get_preview_executor():
+    global preview_executor
+    with previewers_lock:
+        if preview_executor is None:
+            preview_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="preview")
+        return preview_executor
+
+class PreviewPipeline:
+    """
+    Decodes the previews of one sampling run on the preview thread so the sampler never waits for them. Only the
+    latest latent is kept while a preview is decoding, a finished preview is sent with the next progress update.
+    The preview of the last step is waited for with finish so the final preview isn't lost.
+    """
+    def __init__(self, previewer, preview_format, interval=1, max_fps=0):
+        self.previewer = previewer
+        self.preview_format = preview_format
+        self.interval = max(interval, 1)
+        self.min_time = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.last_submit = None
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.pending = None
+        self.decoding = False
+        self.preview = None
+
+    def ready(self, step):
+        if step % self.interval != 0:
+            return False
+        return self.last_submit is None or time.perf_counter() - self.last_submit >= self.min_time
+
+    def submit(self, step, x0, force=False):
+        if not force and not self.ready(step):
+            return
+        self.last_submit = time.perf_counter()
+        # Copied in the order of the sampler's work, before it can change x0
+        x0 = x0[:1].detach().clone()
+        with self.lock:
+            self.pending = x0
+            if self.decoding:
+                return
+            self.decoding = True
+        get_preview_executor().submit(self.decode)
+
+    def decode(self):
+        while True:
+            with self.lock:
+                x0 = self.pending
+                self.pending = None
+                if x0 is None:
+                    self.decoding = False
+                    self.idle.notify_all()
+                    return
+            try:
+                preview = self.previewer.decode_latent_to_preview_image(self.preview_format, x0)
+            except Exception as e:
+                logging.warning("Could not decode preview: {}".format(e))
+                continue
+            with self.lock:
+                self.preview = preview
+
+    def finish(self, x0):
+        """Decodes x0 as the last preview and waits for it, returns the preview to send."""
+        self.submit(None, x0, force=True)
+        with self.idle:
+            self.idle.wait_for(lambda: not self.decoding)
+        return self.take_preview()
+
+    def take_preview(self):
+        with self.lock:
+            preview = self.preview
+            self.preview = None
+        return preview
+
 def prepare_callback(model, steps, x0_output_dict=None):
     preview_format = "JPEG"
     if preview_format not in ["JPEG", "PNG"]:
         preview_format = "JPEG"
 
     previewer = get_previewer(model.load_device, model.model.latent_format)
+    pipeline = None
+    if previewer:
+        pipeline = PreviewPipeline(previewer, preview_format, args.preview_interval, args.preview_max_fps)
 
     pbar = comfy.utils.ProgressBar(steps)
     def callback(step, x0, x, total_steps):
@@ -101,8 +196,12 @@ def prepare_callback(model, steps, x0_output_dict=None):
             x0_output_dict["x0"] = x0
 
         preview_bytes = None
-        if previewer:
-            preview_bytes = previewer.decode_latent_to_preview_image(preview_format, x0)
+        if pipeline:
+            if step + 1 >= total_steps:
+                preview_bytes = pipeline.finish(x0)
+            else:
+                preview_bytes = pipeline.take_preview()
+                pipeline.submit(step, x0)
         pbar.update_absolute(step + 1, total_steps, preview_bytes)
     return callback
 
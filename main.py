@@ -134,10 +134,16 @@ if args.windows_standalone_build:
 import comfy.utils
 
 import execution
+from comfy_execution.batching import prompt_batch_key
 import server
+from comfy_execution.disk_cache import DiskCache
+from comfy_execution.history import MemoryHistoryStore, SQLiteHistoryStore
+from comfy_execution.residency import ResidencyPlanner
 from server import BinaryEventTypes
 import nodes
 import comfy.model_management
+import comfy.model_registry
+import comfy.memory_calibration
 import comfyui_version
 
 
@@ -153,9 +159,36 @@ def cuda_malloc_warning():
             logging.warning("\nWARNING: this card most likely does not support cuda-malloc, if you get \"CUDA error\" please run ComfyUI with: --disable-cuda-malloc\n")
 
 
-def prompt_worker(q, server_instance):
+def prompt_model_affinity(loaded_files):
+    """Returns a function telling if a queued prompt uses one of the model files loaded_files."""
+    loaded_files = set(f.replace("\\", "/") for f in loaded_files)
+    def affinity(item):
+        if len(loaded_files) == 0:
+            return False
+        for node in item[2].values():
+            for value in node.get("inputs", {}).values():
+                if not isinstance(value, str) or "." not in value:
+                    continue
+                value = value.replace("\\", "/")
+                for f in loaded_files:
+                    if f == value or f.endswith("/" + value):
+                        return True
+        return False
+    return affinity
+
+
+residency_planner = ResidencyPlanner()
+
+def prompt_worker(q, server_instance, device=None, disk_cache=None):
     current_time: float = 0.0
-    e = execution.PromptExecutor(server_instance, lru_size=args.cache_lru)
+    affinity = None
+    if device is not None:
+        comfy.model_management.set_thread_torch_device(device)
+    e = execution.PromptExecutor(server_instance, lru_size=args.cache_lru, ram_budget=args.cache_ram_budget, disk_cache=disk_cache, parallel_workers=args.parallel_cpu_nodes)
+    server_instance.prompt_executors.append(e)
+    if server_instance.prompt_executor is None:
+        server_instance.prompt_executor = e
+    worker = q.register_worker()
     last_gc_collect = 0
     need_gc = False
     gc_collect_interval = 10.0
@@ -165,9 +198,42 @@ def prompt_worker(q, server_instance):
         if need_gc:
             timeout = max(gc_collect_interval - (current_time - last_gc_collect), 0.0)
 
-        queue_item = q.get(timeout=timeout)
-        if queue_item is not None:
-            item, item_id = queue_item
+        if device is not None:
+            # Taken before the queue mutex: affinity runs under it. Only this worker loads models on
+            # its device so the snapshot stays valid while it waits for a prompt.
+            affinity = prompt_model_affinity(comfy.model_management.loaded_model_files(device))
+
+        if args.batch_prompts > 1:
+            batch = q.get_batch(prompt_batch_key, args.batch_prompts, timeout=timeout, affinity=affinity)
+        else:
+            queue_item = q.get(timeout=timeout, affinity=affinity)
+            batch = [queue_item] if queue_item is not None else None
+
+        if batch is not None:
+            residency_planner.plan(q)
+
+        if batch is not None and len(batch) > 1:
+            execution_start_time = time.perf_counter()
+            server_instance.last_prompt_id = batch[0][0][1]
+
+            results = e.execute_batch([item for item, _ in batch])
+            need_gc = True
+            for (item, item_id), (history_result, messages) in zip(batch, results):
+                q.task_done(item_id,
+                            history_result,
+                            status=execution.PromptQueue.ExecutionStatus(
+                                status_str='success' if e.success else 'error',
+                                completed=e.success,
+                                messages=messages))
+                client_id = item[3].get("client_id", None)
+                if client_id is not None:
+                    server_instance.send_sync("executing", {"node": None, "prompt_id": item[1]}, client_id)
+
+            current_time = time.perf_counter()
+            execution_time = current_time - execution_start_time
+            logging.info("{} batched prompts executed in {:.2f} seconds".format(len(batch), execution_time))
+        elif batch is not None:
+            item, item_id = batch[0]
             execution_start_time = time.perf_counter()
             prompt_id = item[1]
             server_instance.last_prompt_id = prompt_id
@@ -186,8 +252,11 @@ def prompt_worker(q, server_instance):
             current_time = time.perf_counter()
             execution_time = current_time - execution_start_time
             logging.info("Prompt executed in {:.2f} seconds".format(execution_time))
+            cache_stats = e.caches.get_stats()
+            if cache_stats is not None:
+                logging.debug("Output cache: {}".format(cache_stats))
 
-        flags = q.get_flags()
+        flags = q.get_flags(worker=worker)
         free_memory = flags.get("free_memory", False)
 
         if flags.get("unload_models", free_memory):
@@ -197,6 +266,7 @@ def prompt_worker(q, server_instance):
 
         if free_memory:
             e.reset()
+            comfy.model_registry.clear()
             need_gc = True
             last_gc_collect = 0
 
@@ -258,7 +328,18 @@ def start_comfyui(asyncio_loop=None):
         asyncio_loop = asyncio.new_event_loop()
         asyncio.set_event_loop(asyncio_loop)
     prompt_server = server.PromptServer(asyncio_loop)
-    q = execution.PromptQueue(prompt_server)
+    if args.history_backend == "sqlite":
+        history_db = args.history_db
+        if history_db is None:
+            os.makedirs(folder_paths.get_user_directory(), exist_ok=True)
+            history_db = os.path.join(folder_paths.get_user_directory(), "history.sqlite3")
+        history = SQLiteHistoryStore(history_db, args.history_size)
+    else:
+        history = MemoryHistoryStore(args.history_size)
+    q = execution.PromptQueue(prompt_server, history=history)
+
+    os.makedirs(folder_paths.get_user_directory(), exist_ok=True)
+    comfy.memory_calibration.set_path(os.path.join(folder_paths.get_user_directory(), "memory_calibration.json"))
 
     nodes.init_extra_nodes(init_custom_nodes=not args.disable_all_custom_nodes)
 
@@ -267,7 +348,18 @@ def start_comfyui(asyncio_loop=None):
     prompt_server.add_routes()
     hijack_progress(prompt_server)
 
-    threading.Thread(target=prompt_worker, daemon=True, args=(q, prompt_server,)).start()
+    disk_cache = None
+    if args.cache_disk is not None:
+        disk_cache = DiskCache(os.path.abspath(args.cache_disk), args.cache_disk_size)
+
+    if args.worker_devices is not None:
+        device_type = comfy.model_management.get_torch_device().type
+        for device_id in args.worker_devices.split(","):
+            device = comfy.model_management.torch.device(device_type, int(device_id))
+            logging.info("Starting prompt worker on device: {}".format(device))
+            threading.Thread(target=prompt_worker, daemon=True, args=(q, prompt_server, device, disk_cache)).start()
+    else:
+        threading.Thread(target=prompt_worker, daemon=True, args=(q, prompt_server, None, disk_cache)).start()
 
     if args.quick_test_for_ci:
         exit(0)
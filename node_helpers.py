@@ -1,4 +1,5 @@
 import hashlib
+import math
 import torch
 
 from comfy.cli_args import args
@@ -15,6 +16,35 @@ def conditioning_set_values(conditioning, values={}):
 
     return c
 
+def batch_conditioning(conditionings):
+    """
+    Merges the conditioning of several prompts into one where batch item i belongs to prompt i.
+    Raises ValueError if the conditionings are not compatible.
+    """
+    if any(len(c) != len(conditionings[0]) for c in conditionings):
+        raise ValueError("Can't batch conditionings with a different number of entries.")
+    out = []
+    for entries in zip(*conditionings):
+        tensors = [t[0] for t in entries]
+        if any(t.shape[0] != 1 for t in tensors):
+            raise ValueError("Can't batch conditionings that are already batched.")
+        # padding with repeat doesn't change the result, same as CONDCrossAttn.concat
+        length = math.lcm(*[t.shape[1] for t in tensors])
+        tensors = [t.repeat(1, length // t.shape[1], 1) for t in tensors]
+        options = {}
+        for k, v in entries[0][1].items():
+            values = [t[1].get(k, None) for t in entries]
+            if torch.is_tensor(v):
+                if any(not torch.is_tensor(x) or x.shape != v.shape for x in values) or v.shape[0] != 1:
+                    raise ValueError("Can't batch conditioning option {}.".format(k))
+                options[k] = torch.cat(values)
+            elif any(x is not v and x != v for x in values):
+                raise ValueError("Can't batch conditioning option {}.".format(k))
+            else:
+                options[k] = v
+        out.append([torch.cat(tensors), options])
+    return out
+
 def pillow(fn, arg):
     prev_value = None
     try:
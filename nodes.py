@@ -26,10 +26,12 @@ import comfy.sd
 import comfy.utils
 import comfy.controlnet
 from comfy.comfy_types import IO, ComfyNodeABC, InputTypeDict, FileLocator
+from comfy_execution.graph_utils import PromptBatch
 
 import comfy.clip_vision
 
 import comfy.model_management
+import comfy.model_registry
 from comfy.cli_args import args
 
 import importlib
@@ -41,8 +43,8 @@ import node_helpers
 def before_node_execution():
     comfy.model_management.throw_exception_if_processing_interrupted()
 
-def interrupt_processing(value=True):
-    comfy.model_management.interrupt_current_processing(value)
+def interrupt_processing(value=True, prompt_id=None):
+    comfy.model_management.interrupt_current_processing(value, prompt_id)
 
 MAX_RESOLUTION=16384
 
@@ -61,10 +63,15 @@ class CLIPTextEncode(ComfyNodeABC):
 
     CATEGORY = "conditioning"
     DESCRIPTION = "Encodes a text prompt using a CLIP model into an embedding that can be used to guide the diffusion model towards generating specific images."
+    BATCHABLE_INPUTS = ("text",)
 
     def encode(self, clip, text):
         if clip is None:
             raise RuntimeError("ERROR: clip input is invalid: None\n\nIf the clip is from a checkpoint loader node your checkpoint does not contain a valid clip or text encoder model.")
+        if isinstance(text, PromptBatch):
+            if len(set(text)) > 1:
+                return (node_helpers.batch_conditioning([clip.encode_from_tokens_scheduled(clip.tokenize(t)) for t in text]), )
+            text = text[0]
         tokens = clip.tokenize(text)
         return (clip.encode_from_tokens_scheduled(tokens), )
 
@@ -542,11 +549,13 @@ class CheckpointLoader:
 
     CATEGORY = "advanced/loaders"
     DEPRECATED = True
+    MODEL_FILE_INPUTS = {"ckpt_name": "checkpoints"}
 
     def load_checkpoint(self, config_name, ckpt_name):
         config_path = folder_paths.get_full_path("configs", config_name)
         ckpt_path = folder_paths.get_full_path_or_raise("checkpoints", ckpt_name)
-        return comfy.sd.load_checkpoint(config_path, ckpt_path, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
+        return comfy.model_registry.load("checkpoint_config", [config_path, ckpt_path], None,
+                                         lambda: comfy.sd.load_checkpoint(config_path, ckpt_path, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings")))
 
 class CheckpointLoaderSimple:
     @classmethod
@@ -564,10 +573,12 @@ class CheckpointLoaderSimple:
 
     CATEGORY = "loaders"
     DESCRIPTION = "Loads a diffusion model checkpoint, diffusion models are used to denoise latents."
+    MODEL_FILE_INPUTS = {"ckpt_name": "checkpoints"}
 
     def load_checkpoint(self, ckpt_name):
         ckpt_path = folder_paths.get_full_path_or_raise("checkpoints", ckpt_name)
-        out = comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
+        out = comfy.model_registry.load("checkpoint", [ckpt_path], None,
+                                        lambda: comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))[:3])
         return out[:3]
 
 class DiffusersLoader:
@@ -606,6 +617,7 @@ class unCLIPCheckpointLoader:
     FUNCTION = "load_checkpoint"
 
     CATEGORY = "loaders"
+    MODEL_FILE_INPUTS = {"ckpt_name": "checkpoints"}
 
     def load_checkpoint(self, ckpt_name, output_vae=True, output_clip=True):
         ckpt_path = folder_paths.get_full_path_or_raise("checkpoints", ckpt_name)
@@ -664,7 +676,7 @@ class LoraLoader:
                 self.loaded_lora = None
 
         if lora is None:
-            lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
+            lora = comfy.model_registry.load("lora", [lora_path], None, lambda: (comfy.utils.load_torch_file(lora_path, safe_load=True),))[0]
             self.loaded_lora = (lora_path, lora)
 
         model_lora, clip_lora = comfy.sd.load_lora_for_models(model, clip, lora, strength_model, strength_clip)
@@ -761,6 +773,7 @@ class VAELoader:
     FUNCTION = "load_vae"
 
     CATEGORY = "loaders"
+    MODEL_FILE_INPUTS = {"vae_name": "vae"}
 
     #TODO: scale factor?
     def load_vae(self, vae_name):
@@ -768,10 +781,16 @@ class VAELoader:
             sd = self.load_taesd(vae_name)
         else:
             vae_path = folder_paths.get_full_path_or_raise("vae", vae_name)
-            sd = comfy.utils.load_torch_file(vae_path)
+            return comfy.model_registry.load("vae", [vae_path], None, lambda: self.load_vae_file(vae_path))
         vae = comfy.sd.VAE(sd=sd)
         return (vae,)
 
+    def load_vae_file(self, vae_path):
+        sd = comfy.utils.load_torch_file(vae_path)
+        vae = comfy.sd.VAE(sd=sd)
+        comfy.model_management.set_model_source_file(vae, vae_path)
+        return (vae,)
+
 class ControlNetLoader:
     @classmethod
     def INPUT_TYPES(s):
@@ -781,6 +800,7 @@ class ControlNetLoader:
     FUNCTION = "load_controlnet"
 
     CATEGORY = "loaders"
+    MODEL_FILE_INPUTS = {"control_net_name": "controlnet"}
 
     def load_controlnet(self, control_net_name):
         controlnet_path = folder_paths.get_full_path_or_raise("controlnet", control_net_name)
@@ -797,6 +817,7 @@ class DiffControlNetLoader:
     FUNCTION = "load_controlnet"
 
     CATEGORY = "loaders"
+    MODEL_FILE_INPUTS = {"control_net_name": "controlnet"}
 
     def load_controlnet(self, model, control_net_name):
         controlnet_path = folder_paths.get_full_path_or_raise("controlnet", control_net_name)
@@ -895,6 +916,7 @@ class UNETLoader:
     FUNCTION = "load_unet"
 
     CATEGORY = "advanced/loaders"
+    MODEL_FILE_INPUTS = {"unet_name": "diffusion_models"}
 
     def load_unet(self, unet_name, weight_dtype):
         model_options = {}
@@ -907,8 +929,8 @@ class UNETLoader:
             model_options["dtype"] = torch.float8_e5m2
 
         unet_path = folder_paths.get_full_path_or_raise("diffusion_models", unet_name)
-        model = comfy.sd.load_diffusion_model(unet_path, model_options=model_options)
-        return (model,)
+        return comfy.model_registry.load("diffusion_model", [unet_path], model_options,
+                                         lambda: (comfy.sd.load_diffusion_model(unet_path, model_options=model_options),))
 
 class CLIPLoader:
     @classmethod
@@ -925,6 +947,7 @@ class CLIPLoader:
     CATEGORY = "advanced/loaders"
 
     DESCRIPTION = "[Recipes]\n\nstable_diffusion: clip-l\nstable_cascade: clip-g\nsd3: t5 xxl/ clip-g / clip-l\nstable_audio: t5 base\nmochi: t5 xxl\ncosmos: old t5 xxl\nlumina2: gemma 2 2B\nwan: umt5 xxl"
+    MODEL_FILE_INPUTS = {"clip_name": "text_encoders"}
 
     def load_clip(self, clip_name, type="stable_diffusion", device="default"):
         if type == "stable_cascade":
@@ -953,8 +976,8 @@ class CLIPLoader:
             model_options["load_device"] = model_options["offload_device"] = torch.device("cpu")
 
         clip_path = folder_paths.get_full_path_or_raise("text_encoders", clip_name)
-        clip = comfy.sd.load_clip(ckpt_paths=[clip_path], embedding_directory=folder_paths.get_folder_paths("embeddings"), clip_type=clip_type, model_options=model_options)
-        return (clip,)
+        return comfy.model_registry.load("clip_{}".format(clip_type.name), [clip_path], model_options,
+                                         lambda: (comfy.sd.load_clip(ckpt_paths=[clip_path], embedding_directory=folder_paths.get_folder_paths("embeddings"), clip_type=clip_type, model_options=model_options),))
 
 class DualCLIPLoader:
     @classmethod
@@ -972,6 +995,7 @@ class DualCLIPLoader:
     CATEGORY = "advanced/loaders"
 
     DESCRIPTION = "[Recipes]\n\nsdxl: clip-l, clip-g\nsd3: clip-l, clip-g / clip-l, t5 / clip-g, t5\nflux: clip-l, t5"
+    MODEL_FILE_INPUTS = {"clip_name1": "text_encoders", "clip_name2": "text_encoders"}
 
     def load_clip(self, clip_name1, clip_name2, type, device="default"):
         clip_path1 = folder_paths.get_full_path_or_raise("text_encoders", clip_name1)
@@ -989,8 +1013,8 @@ class DualCLIPLoader:
         if device == "cpu":
             model_options["load_device"] = model_options["offload_device"] = torch.device("cpu")
 
-        clip = comfy.sd.load_clip(ckpt_paths=[clip_path1, clip_path2], embedding_directory=folder_paths.get_folder_paths("embeddings"), clip_type=clip_type, model_options=model_options)
-        return (clip,)
+        return comfy.model_registry.load("clip_{}".format(clip_type.name), [clip_path1, clip_path2], model_options,
+                                         lambda: (comfy.sd.load_clip(ckpt_paths=[clip_path1, clip_path2], embedding_directory=folder_paths.get_folder_paths("embeddings"), clip_type=clip_type, model_options=model_options),))
 
 class CLIPVisionLoader:
     @classmethod
@@ -1491,6 +1515,12 @@ class SetLatentNoiseMask:
         return (s,)
 
 def common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent, denoise=1.0, disable_noise=False, start_step=None, last_step=None, force_full_denoise=False):
+    seeds = None
+    if isinstance(seed, PromptBatch):
+        seeds = seed
+        seed = seeds[0]
+        latent = comfy.sample.expand_latent_for_prompt_batch(latent, len(seeds))
+
     latent_image = latent["samples"]
     latent_image = comfy.sample.fix_empty_latent_channels(model, latent_image)
 
@@ -1498,7 +1528,10 @@ def common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive,
         noise = torch.zeros(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, device="cpu")
     else:
         batch_inds = latent["batch_index"] if "batch_index" in latent else None
-        noise = comfy.sample.prepare_noise(latent_image, seed, batch_inds)
+        if seeds is not None:
+            noise = comfy.sample.prepare_prompt_batch_noise(latent_image, seeds, batch_inds)
+        else:
+            noise = comfy.sample.prepare_noise(latent_image, seed, batch_inds)
 
     noise_mask = None
     if "noise_mask" in latent:
@@ -1537,6 +1570,8 @@ class KSampler:
 
     CATEGORY = "sampling"
     DESCRIPTION = "Uses the provided model, positive and negative conditioning to denoise the latent image."
+    BATCHABLE_INPUTS = ("seed",)
+    EXPANDS_PROMPT_BATCH = True
 
     def sample(self, model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=1.0):
         return common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise)
@@ -1565,6 +1600,8 @@ class KSamplerAdvanced:
     FUNCTION = "sample"
 
     CATEGORY = "sampling"
+    BATCHABLE_INPUTS = ("noise_seed",)
+    EXPANDS_PROMPT_BATCH = True
 
     def sample(self, model, add_noise, noise_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, start_at_step, end_at_step, return_with_leftover_noise, denoise=1.0):
         force_full_denoise = True
@@ -1656,6 +1693,7 @@ class LoadImage:
     CATEGORY = "image"
 
     RETURN_TYPES = ("IMAGE", "MASK")
+    THREAD_SAFE = True
     FUNCTION = "load_image"
     def load_image(self, image):
         image_path = folder_paths.get_annotated_filepath(image)
@@ -1730,6 +1768,7 @@ class LoadImageMask:
     CATEGORY = "mask"
 
     RETURN_TYPES = ("MASK",)
+    THREAD_SAFE = True
     FUNCTION = "load_image"
     def load_image(self, image, channel):
         image_path = folder_paths.get_annotated_filepath(image)
@@ -2263,6 +2302,7 @@ def init_builtin_extra_nodes():
         "nodes_video.py",
         "nodes_lumina2.py",
         "nodes_wan.py",
+        "nodes_step_cache.py",
     ]
 
     import_failed = []
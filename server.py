@@ -1,6 +1,7 @@
 import os
 import sys
 import asyncio
+import threading
 import traceback
 
 import nodes
@@ -11,6 +12,8 @@ import urllib
 import json
 import glob
 import struct
+import shutil
+import tempfile
 import ssl
 import socket
 import ipaddress
@@ -34,17 +37,17 @@ from app.model_manager import ModelFileManager
 from app.custom_node_manager import CustomNodeManager
 from typing import Optional
 from api_server.routes.internal.internal_routes import InternalRoutes
+from app.websocket_outbox import WebSocketOutbox
+from app.file_hash_index import FileHashIndex
+from app.object_info_cache import ObjectInfoCache
+
+# Size of the chunks uploads are streamed to disk in
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
 class BinaryEventTypes:
     PREVIEW_IMAGE = 1
     UNENCODED_PREVIEW_IMAGE = 2
 
-async def send_socket_catch_exception(function, message):
-    try:
-        await function(message)
-    except (aiohttp.ClientError, aiohttp.ClientPayloadError, ConnectionResetError, BrokenPipeError, ConnectionError) as err:
-        logging.warning("send error: {}".format(err))
-
 @web.middleware
 async def cache_control(request: web.Request, handler):
     response: web.Response = await handler(request)
@@ -159,6 +162,9 @@ class PromptServer():
         self.internal_routes = InternalRoutes(self)
         self.supports = ["custom_nodes_from_web"]
         self.prompt_queue = None
+        # The executor of the first prompt worker, and the executors of all of them (one per device with --worker-devices)
+        self.prompt_executor = None
+        self.prompt_executors = []
         self.loop = loop
         self.messages = asyncio.Queue()
         self.client_session:Optional[aiohttp.ClientSession] = None
@@ -174,8 +180,11 @@ class PromptServer():
             middlewares.append(create_origin_only_middleware())
 
         max_upload_size = round(args.max_upload_size * 1024 * 1024)
+        os.makedirs(folder_paths.get_user_directory(), exist_ok=True)
+        self.file_hash_index = FileHashIndex(os.path.join(folder_paths.get_user_directory(), "file_hashes.sqlite3"), node_helpers.hasher(), args.default_hashing_function)
         self.app = web.Application(client_max_size=max_upload_size, middlewares=middlewares)
         self.sockets = dict()
+        self.outboxes = dict()
         self.web_root = (
             FrontendManager.init_frontend(args.front_end_version)
             if args.front_end_root is None
@@ -184,6 +193,8 @@ class PromptServer():
         logging.info(f"[Prompt Server] web root: {self.web_root}")
         routes = web.RouteTableDef()
         self.routes = routes
+        self._execution_context = threading.local()
+        self._shared_execution_context = {}
         self.last_node_id = None
         self.client_id = None
 
@@ -197,10 +208,16 @@ class PromptServer():
             if sid:
                 # Reusing existing session, remove old
                 self.sockets.pop(sid, None)
+                old_outbox = self.outboxes.pop(sid, None)
+                if old_outbox is not None:
+                    old_outbox.stop()
             else:
                 sid = uuid.uuid4().hex
 
             self.sockets[sid] = ws
+            outbox = WebSocketOutbox(ws)
+            self.outboxes[sid] = outbox
+            outbox.start()
 
             try:
                 # Send initial state to the new client
@@ -213,7 +230,11 @@ class PromptServer():
                     if msg.type == aiohttp.WSMsgType.ERROR:
                         logging.warning('ws connection closed with exception %s' % ws.exception())
             finally:
-                self.sockets.pop(sid, None)
+                if self.sockets.get(sid, None) is ws:
+                    self.sockets.pop(sid, None)
+                if self.outboxes.get(sid, None) is outbox:
+                    self.outboxes.pop(sid, None)
+                outbox.stop()
             return ws
 
         @routes.get("/")
@@ -275,72 +296,163 @@ class PromptServer():
 
             # function to compare hashes of two images to see if it already exists, fix to #3465
             if os.path.exists(filepath):
-                a = hasher()
                 b = hasher()
-                with open(filepath, "rb") as f:
-                    a.update(f.read())
-                    b.update(image.file.read())
-                    image.file.seek(0)
-                    f.close()
-                return a.hexdigest() == b.hexdigest()
+                b.update(image.file.read())
+                image.file.seek(0)
+                return self.file_hash_index.digest(filepath) == b.hexdigest()
             return False
 
+        def get_upload_path(post, filename):
+            image_upload_type = post.get("type")
+            upload_dir, image_upload_type = get_dir_by_type(image_upload_type)
+
+            subfolder = post.get("subfolder", "")
+            full_output_folder = os.path.join(upload_dir, os.path.normpath(subfolder))
+            filepath = os.path.abspath(os.path.join(full_output_folder, filename))
+
+            if os.path.commonpath((upload_dir, filepath)) != upload_dir:
+                return None
+
+            if not os.path.exists(full_output_folder):
+                os.makedirs(full_output_folder)
+            return full_output_folder, filepath, subfolder, image_upload_type
+
+        # Uploads are stored on executor threads, a name is picked and the file written under this lock so two uploads
+        # with the same name can't both take the same free name
+        upload_name_lock = threading.Lock()
+
         def image_upload(post, image_save_function=None):
             image = post.get("image")
             overwrite = post.get("overwrite")
             image_is_duplicate = False
 
-            image_upload_type = post.get("type")
-            upload_dir, image_upload_type = get_dir_by_type(image_upload_type)
-
             if image and image.file:
                 filename = image.filename
                 if not filename:
                     return web.Response(status=400)
 
-                subfolder = post.get("subfolder", "")
-                full_output_folder = os.path.join(upload_dir, os.path.normpath(subfolder))
-                filepath = os.path.abspath(os.path.join(full_output_folder, filename))
-
-                if os.path.commonpath((upload_dir, filepath)) != upload_dir:
+                upload_path = get_upload_path(post, filename)
+                if upload_path is None:
                     return web.Response(status=400)
-
-                if not os.path.exists(full_output_folder):
-                    os.makedirs(full_output_folder)
+                full_output_folder, filepath, subfolder, image_upload_type = upload_path
 
                 split = os.path.splitext(filename)
 
-                if overwrite is not None and (overwrite == "true" or overwrite == "1"):
-                    pass
-                else:
-                    i = 1
-                    while os.path.exists(filepath):
-                        if compare_image_hash(filepath, image): #compare hash to prevent saving of duplicates with same name, fix for #3465
-                            image_is_duplicate = True
-                            break
-                        filename = f"{split[0]} ({i}){split[1]}"
-                        filepath = os.path.join(full_output_folder, filename)
-                        i += 1
-
-                if not image_is_duplicate:
-                    if image_save_function is not None:
-                        image_save_function(image, post, filepath)
+                with upload_name_lock:
+                    if overwrite is not None and (overwrite == "true" or overwrite == "1"):
+                        pass
                     else:
-                        with open(filepath, "wb") as f:
-                            f.write(image.file.read())
+                        i = 1
+                        while os.path.exists(filepath):
+                            if compare_image_hash(filepath, image): #compare hash to prevent saving of duplicates with same name, fix for #3465
+                                image_is_duplicate = True
+                                break
+                            filename = f"{split[0]} ({i}){split[1]}"
+                            filepath = os.path.join(full_output_folder, filename)
+                            i += 1
+
+                    if not image_is_duplicate:
+                        if image_save_function is not None:
+                            image_save_function(image, post, filepath)
+                        else:
+                            with open(filepath, "wb") as f:
+                                f.write(image.file.read())
 
                 return web.json_response({"name" : filename, "subfolder": subfolder, "type": image_upload_type})
             else:
                 return web.Response(status=400)
 
+        def write_upload_chunk(f, hasher, chunk):
+            f.write(chunk)
+            hasher.update(chunk)
+
+        async def read_streamed_upload(request):
+            """
+            Reads a multipart upload, streaming the image to a temporary file and hashing it off the event loop.
+            Returns the other form fields and (filename, temp_path, size, digest) for the image or None.
+            """
+            loop = asyncio.get_running_loop()
+            reader = await request.multipart()
+            fields = {}
+            image = None
+            while True:
+                part = await reader.next()
+                if part is None:
+                    break
+                if part.name != "image" or part.filename is None:
+                    fields[part.name] = await part.text()
+                    continue
+                if image is not None:
+                    os.remove(image[1])
+                temp_dir = folder_paths.get_temp_directory()
+                os.makedirs(temp_dir, exist_ok=True)
+                f = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=".upload", delete=False)
+                hasher = node_helpers.hasher()()
+                size = 0
+                try:
+                    while True:
+                        chunk = await part.read_chunk(UPLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        size += len(chunk)
+                        if size > max_upload_size:
+                            raise web.HTTPRequestEntityTooLarge(max_size=max_upload_size, actual_size=size)
+                        await loop.run_in_executor(None, write_upload_chunk, f, hasher, chunk)
+                except BaseException:
+                    f.close()
+                    os.remove(f.name)
+                    raise
+                f.close()
+                image = (part.filename, f.name, size, hasher.hexdigest())
+            return fields, image
+
+        def store_streamed_upload(fields, image):
+            filename, temp_path, size, digest = image
+            try:
+                if not filename:
+                    return web.Response(status=400)
+
+                upload_path = get_upload_path(fields, filename)
+                if upload_path is None:
+                    return web.Response(status=400)
+                full_output_folder, filepath, subfolder, image_upload_type = upload_path
+
+                overwrite = fields.get("overwrite")
+                image_is_duplicate = False
+                split = os.path.splitext(filename)
+                with upload_name_lock:
+                    if overwrite is not None and (overwrite == "true" or overwrite == "1"):
+                        pass
+                    else:
+                        i = 1
+                        while os.path.exists(filepath):
+                            #compare hash to prevent saving of duplicates with same name, fix for #3465
+                            if os.path.getsize(filepath) == size and self.file_hash_index.digest(filepath) == digest:
+                                image_is_duplicate = True
+                                break
+                            filename = f"{split[0]} ({i}){split[1]}"
+                            filepath = os.path.join(full_output_folder, filename)
+                            i += 1
+
+                    if not image_is_duplicate:
+                        shutil.move(temp_path, filepath)
+                        self.file_hash_index.set(filepath, digest)
+
+                return web.json_response({"name" : filename, "subfolder": subfolder, "type": image_upload_type})
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
         @routes.get("/health")
         async def health(request):
             return web.Response(status=200, text="Healthy")
 
         @routes.post("/upload/image")
         async def upload_image(request):
-            post = await request.post()
-            return image_upload(post)
+            fields, image = await read_streamed_upload(request)
+            if image is None:
+                return web.Response(status=400)
+            return await asyncio.get_running_loop().run_in_executor(None, store_streamed_upload, fields, image)
 
 
         @routes.post("/upload/mask")
@@ -387,7 +499,7 @@ class PromptServer():
                         original_pil.putalpha(new_alpha)
                         original_pil.save(filepath, compress_level=4, pnginfo=metadata)
 
-            return image_upload(post, image_save_function)
+            return await asyncio.get_running_loop().run_in_executor(None, image_upload, post, image_save_function)
 
         @routes.get("/view")
         async def view_image(request):
@@ -550,6 +662,10 @@ class PromptServer():
                     }
                 ]
             }
+            if self.prompt_executor is not None:
+                cache_stats = self.prompt_executor.caches.get_stats()
+                if cache_stats is not None:
+                    system_stats["cache"] = cache_stats
             return web.json_response(system_stats)
 
         @routes.get("/prompt")
@@ -560,7 +676,7 @@ class PromptServer():
             obj_class = nodes.NODE_CLASS_MAPPINGS[node_class]
             info = {}
             info['input'] = obj_class.INPUT_TYPES()
-            info['input_order'] = {key: list(value.keys()) for (key, value) in obj_class.INPUT_TYPES().items()}
+            info['input_order'] = {key: list(value.keys()) for (key, value) in info['input'].items()}
             info['output'] = obj_class.RETURN_TYPES
             info['output_is_list'] = obj_class.OUTPUT_IS_LIST if hasattr(obj_class, 'OUTPUT_IS_LIST') else [False] * len(obj_class.RETURN_TYPES)
             info['output_name'] = obj_class.RETURN_NAMES if hasattr(obj_class, 'RETURN_NAMES') else info['output']
@@ -586,32 +702,48 @@ class PromptServer():
                 info['experimental'] = True
             return info
 
+        self.object_info_cache = ObjectInfoCache(node_info)
+
         @routes.get("/object_info")
         async def get_object_info(request):
-            with folder_paths.cache_helper:
-                out = {}
-                for x in nodes.NODE_CLASS_MAPPINGS:
-                    try:
-                        out[x] = node_info(x)
-                    except Exception:
-                        logging.error(f"[ERROR] An error occurred while retrieving information for the '{x}' node.")
-                        logging.error(traceback.format_exc())
-                return web.json_response(out)
+            since = request.rel_url.query.get("since", None)
+            if since is not None:
+                changes = self.object_info_cache.get_changes(nodes.NODE_CLASS_MAPPINGS, since)
+                if changes is not None:
+                    return web.Response(body=changes, content_type="application/json")
+
+            document, etag, version = self.object_info_cache.get(nodes.NODE_CLASS_MAPPINGS)
+            headers = {"ETag": etag, "Comfy-Object-Info-Version": version}
+            if_none_match = request.headers.get("If-None-Match", None)
+            if if_none_match is not None and etag in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]:
+                return web.Response(status=304, headers=headers)
+            return web.Response(body=document, content_type="application/json", headers=headers)
 
         @routes.get("/object_info/{node_class}")
         async def get_object_info_node(request):
             node_class = request.match_info.get("node_class", None)
-            out = {}
             if (node_class is not None) and (node_class in nodes.NODE_CLASS_MAPPINGS):
-                out[node_class] = node_info(node_class)
-            return web.json_response(out)
+                return web.Response(body=self.object_info_cache.get_node(nodes.NODE_CLASS_MAPPINGS, node_class), content_type="application/json")
+            return web.json_response({})
 
         @routes.get("/history")
         async def get_history(request):
-            max_items = request.rel_url.query.get("max_items", None)
-            if max_items is not None:
-                max_items = int(max_items)
-            return web.json_response(self.prompt_queue.get_history(max_items=max_items))
+            query = request.rel_url.query
+            try:
+                max_items = int(query["max_items"]) if "max_items" in query else None
+                offset = int(query["offset"]) if "offset" in query else -1
+                before = int(query["before"]) if "before" in query else None
+                since = float(query["since"]) if "since" in query else None
+                until = float(query["until"]) if "until" in query else None
+            except ValueError:
+                return web.Response(status=400)
+            status = query.get("status", None)
+            history, next_cursor = self.prompt_queue.query_history(max_items=max_items, offset=offset, before=before, status=status, since=since, until=until)
+            headers = {}
+            if next_cursor is not None:
+                # Pass as before= to get the next (older) page
+                headers["Comfy-History-Next-Cursor"] = str(next_cursor)
+            return web.json_response(history, headers=headers)
 
         @routes.get("/history/{prompt_id}")
         async def get_history_prompt_id(request):
@@ -626,6 +758,24 @@ class PromptServer():
             queue_info['queue_pending'] = current_queue[1]
             return web.json_response(queue_info)
 
+        @routes.get("/queue/snapshot")
+        async def get_queue_snapshot(request):
+            include_prompts = request.rel_url.query.get("include_prompts", "false").lower() in ("1", "true")
+            return web.json_response(self.prompt_queue.get_queue_snapshot(include_prompts=include_prompts))
+
+        @routes.get("/queue/changes")
+        async def get_queue_changes(request):
+            try:
+                since = int(request.rel_url.query.get("since", ""))
+            except ValueError:
+                return web.Response(status=400)
+            changes = self.prompt_queue.get_queue_changes(since)
+            if changes is None:
+                # Too far behind, start over from a snapshot
+                return web.json_response({"reset": True, **self.prompt_queue.get_queue_snapshot()})
+            version = changes[-1]["version"] if len(changes) > 0 else since
+            return web.json_response({"reset": False, "version": version, "changes": changes})
+
         @routes.post("/prompt")
         async def post_prompt(request):
             logging.info("got prompt")
@@ -679,7 +829,18 @@ class PromptServer():
 
         @routes.post("/interrupt")
         async def post_interrupt(request):
-            nodes.interrupt_processing()
+            # Only interrupts the given prompt if there is one, otherwise whatever is running
+            prompt_id = None
+            if request.can_read_body:
+                json_data = await request.json()
+                prompt_id = json_data.get("prompt_id", None)
+            if prompt_id is None:
+                nodes.interrupt_processing()
+            else:
+                running, _ = self.prompt_queue.get_current_queue()
+                for item in running:
+                    if item[1] == prompt_id:
+                        nodes.interrupt_processing(prompt_id=prompt_id)
             return web.Response(status=200)
 
         @routes.post("/free")
@@ -706,6 +867,27 @@ class PromptServer():
 
             return web.Response(status=200)
 
+    # With several prompt workers each worker thread has its own client_id, last_node_id and
+    # last_prompt_id. Other threads (the event loop) see whatever a worker set last.
+    def _get_execution_context(self, name):
+        if hasattr(self._execution_context, name):
+            return getattr(self._execution_context, name)
+        return self._shared_execution_context.get(name, None)
+
+    def _set_execution_context(self, name, value):
+        setattr(self._execution_context, name, value)
+        self._shared_execution_context[name] = value
+
+    def set_thread_execution_context(self, client_id, last_prompt_id, last_node_id):
+        """Sets the execution context of the current thread only, for the threads that run nodes for a worker."""
+        self._execution_context.client_id = client_id
+        self._execution_context.last_prompt_id = last_prompt_id
+        self._execution_context.last_node_id = last_node_id
+
+    client_id = property(lambda self: self._get_execution_context("client_id"), lambda self, value: self._set_execution_context("client_id", value))
+    last_node_id = property(lambda self: self._get_execution_context("last_node_id"), lambda self, value: self._set_execution_context("last_node_id", value))
+    last_prompt_id = property(lambda self: self._get_execution_context("last_prompt_id"), lambda self, value: self._set_execution_context("last_prompt_id", value))
+
     async def setup(self):
         timeout = aiohttp.ClientTimeout(total=None) # no timeout
         self.client_session = aiohttp.ClientSession(timeout=timeout)
@@ -742,6 +924,7 @@ class PromptServer():
         prompt_info = {}
         exec_info = {}
         exec_info['queue_remaining'] = self.prompt_queue.get_tasks_remaining()
+        exec_info['queue_version'] = self.prompt_queue.version
         prompt_info['exec_info'] = exec_info
         return prompt_info
 
@@ -762,7 +945,8 @@ class PromptServer():
         message.extend(data)
         return message
 
-    async def send_image(self, image_data, sid=None):
+    @staticmethod
+    def encode_image(image_data):
         image_type = image_data[0]
         image = image_data[1]
         max_size = image_data[2]
@@ -783,28 +967,30 @@ class PromptServer():
         header = struct.pack(">I", type_num)
         bytesIO.write(header)
         image.save(bytesIO, format=image_type, quality=95, compress_level=1)
-        preview_bytes = bytesIO.getvalue()
-        await self.send_bytes(BinaryEventTypes.PREVIEW_IMAGE, preview_bytes, sid=sid)
+        return bytesIO.getvalue()
 
-    async def send_bytes(self, event, data, sid=None):
-        message = self.encode_bytes(event, data)
+    async def send_image(self, image_data, sid=None):
+        # Encoding a preview takes long enough to hold up every other client if done on the event loop
+        preview_bytes = await self.loop.run_in_executor(None, self.encode_image, image_data)
+        await self.send_bytes(BinaryEventTypes.PREVIEW_IMAGE, preview_bytes, sid=sid)
 
+    def _queue_message(self, message, coalesce_key, sid):
         if sid is None:
-            sockets = list(self.sockets.values())
-            for ws in sockets:
-                await send_socket_catch_exception(ws.send_bytes, message)
-        elif sid in self.sockets:
-            await send_socket_catch_exception(self.sockets[sid].send_bytes, message)
+            for outbox in list(self.outboxes.values()):
+                outbox.put(message, coalesce_key)
+        elif sid in self.outboxes:
+            self.outboxes[sid].put(message, coalesce_key)
 
-    async def send_json(self, event, data, sid=None):
-        message = {"type": event, "data": data}
+    async def send_bytes(self, event, data, sid=None):
+        message = bytes(self.encode_bytes(event, data))
+        # Only the latest preview is worth sending to a client that is falling behind
+        coalesce_key = "preview" if event == BinaryEventTypes.PREVIEW_IMAGE else None
+        self._queue_message(message, coalesce_key, sid)
 
-        if sid is None:
-            sockets = list(self.sockets.values())
-            for ws in sockets:
-                await send_socket_catch_exception(ws.send_json, message)
-        elif sid in self.sockets:
-            await send_socket_catch_exception(self.sockets[sid].send_json, message)
+    async def send_json(self, event, data, sid=None):
+        message = json.dumps({"type": event, "data": data})
+        coalesce_key = "progress" if event == "progress" else None
+        self._queue_message(message, coalesce_key, sid)
 
     def send_sync(self, event, data, sid=None):
         self.loop.call_soon_threadsafe(
@@ -0,0 +1,45 @@
+import hashlib
+import os
+
+from app.file_hash_index import FileHashIndex
+
+
+class CountingHasher:
+    calls = 0
+
+    def __call__(self):
+        CountingHasher.calls += 1
+        return hashlib.sha256()
+
+
+def test_digest_is_reused_until_file_changes(tmp_path):
+    hasher = CountingHasher()
+    index = FileHashIndex(str(tmp_path / "index.sqlite3"), hasher, "sha256")
+    path = tmp_path / "a.png"
+    path.write_bytes(b"first")
+
+    digest = index.digest(str(path))
+    assert digest == hashlib.sha256(b"first").hexdigest()
+    calls = CountingHasher.calls
+    assert index.digest(str(path)) == digest
+    assert CountingHasher.calls == calls
+
+    path.write_bytes(b"second content")
+    os.utime(path, ns=(0, 12345))
+    assert index.digest(str(path)) == hashlib.sha256(b"second content").hexdigest()
+
+
+def test_set_and_persist(tmp_path):
+    db = str(tmp_path / "index.sqlite3")
+    path = tmp_path / "a.png"
+    path.write_bytes(b"data")
+    FileHashIndex(db, hashlib.sha256, "sha256").set(str(path), "known")
+
+    assert FileHashIndex(db, hashlib.sha256, "sha256").digest(str(path)) == "known"
+    # A different hashing function invalidates the entry
+    assert FileHashIndex(db, hashlib.md5, "md5").digest(str(path)) == hashlib.md5(b"data").hexdigest()
+
+
+def test_missing_file(tmp_path):
+    index = FileHashIndex(str(tmp_path / "index.sqlite3"), hashlib.sha256, "sha256")
+    assert index.digest(str(tmp_path / "missing.png")) is None
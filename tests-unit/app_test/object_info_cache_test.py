@@ -0,0 +1,174 @@
+import json
+import os
+
+import pytest
+
+import folder_paths
+from app.object_info_cache import ObjectInfoCache
+
+
+class StaticNode:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"value": ("INT",)}}
+
+
+class CheckpointNode:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"ckpt_name": (folder_paths.get_filename_list("checkpoints"),)}}
+
+
+class InputNode:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"image": (sorted(os.listdir(folder_paths.get_input_directory())),)}}
+
+
+class DiffusersNode:
+    @classmethod
+    def INPUT_TYPES(s):
+        paths = []
+        for search_path in folder_paths.get_folder_paths("diffusers"):
+            for root, subdir, files in os.walk(search_path, followlinks=True):
+                if "model_index.json" in files:
+                    paths.append(os.path.relpath(root, start=search_path))
+        return {"required": {"model_path": (paths,)}}
+
+
+class CustomListNode:
+    RELATIVE_PYTHON_MODULE = "custom_nodes.example"
+    directory = None
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"name": (sorted(os.listdir(s.directory)),)}}
+
+
+@pytest.fixture
+def folders(tmp_path, monkeypatch):
+    checkpoints = tmp_path / "checkpoints"
+    checkpoints.mkdir()
+    inputs = tmp_path / "input"
+    inputs.mkdir()
+    diffusers = tmp_path / "diffusers"
+    diffusers.mkdir()
+    monkeypatch.setitem(folder_paths.folder_names_and_paths, "checkpoints", ([str(checkpoints)], {".safetensors"}))
+    monkeypatch.setitem(folder_paths.folder_names_and_paths, "diffusers", ([str(diffusers)], {"folder"}))
+    monkeypatch.setattr(folder_paths, "filename_list_cache", {})
+    monkeypatch.setattr(folder_paths, "input_directory", str(inputs))
+    return checkpoints, inputs
+
+
+def touch(path, directory, mtime):
+    path.write_bytes(b"")
+    os.utime(directory, (mtime, mtime))
+
+
+class Counter:
+    def __init__(self, mappings):
+        self.mappings = mappings
+        self.calls = []
+
+    def __call__(self, name):
+        self.calls.append(name)
+        return {"name": name, "input": self.mappings[name].INPUT_TYPES()}
+
+
+def test_nodes_are_only_refreshed_when_their_folders_change(folders):
+    checkpoints, inputs = folders
+    mappings = {"StaticNode": StaticNode, "CheckpointNode": CheckpointNode, "InputNode": InputNode}
+    node_info = Counter(mappings)
+    cache = ObjectInfoCache(node_info)
+
+    document, etag, version = cache.get(mappings)
+    assert list(json.loads(document)) == list(mappings)
+    assert sorted(node_info.calls) == sorted(mappings)
+
+    node_info.calls.clear()
+    assert cache.get(mappings) == (document, etag, version)
+    assert node_info.calls == []
+
+    touch(checkpoints / "model.safetensors", checkpoints, 1000)
+    document, new_etag, new_version = cache.get(mappings)
+    assert node_info.calls == ["CheckpointNode"]
+    assert new_etag != etag
+    assert json.loads(document)["CheckpointNode"]["input"]["required"]["ckpt_name"] == [["model.safetensors"]]
+
+    node_info.calls.clear()
+    touch(inputs / "image.png", inputs, 1000)
+    cache.get(mappings)
+    assert node_info.calls == ["InputNode"]
+
+    changes = json.loads(cache.get_changes(mappings, new_version))
+    assert list(changes["nodes"]) == ["InputNode"]
+    assert changes["removed"] == []
+
+
+def test_changes_since_a_version(folders):
+    mappings = {"StaticNode": StaticNode, "CheckpointNode": CheckpointNode}
+    cache = ObjectInfoCache(Counter(mappings))
+    _, _, version = cache.get(mappings)
+
+    changes = json.loads(cache.get_changes(mappings, version))
+    assert changes == {"version": version, "removed": [], "nodes": {}}
+
+    del mappings["StaticNode"]
+    mappings["InputNode"] = InputNode
+    changes = json.loads(cache.get_changes(mappings, version))
+    assert changes["removed"] == ["StaticNode"]
+    assert list(changes["nodes"]) == ["InputNode"]
+    assert list(json.loads(cache.get(mappings)[0])) == ["CheckpointNode", "InputNode"]
+
+    # Versions of another instance need the full document
+    assert cache.get_changes(mappings, "other-1") is None
+    assert ObjectInfoCache(Counter(mappings)).get_changes(mappings, version) is None
+
+
+def test_failing_nodes_are_left_out(folders):
+    class Broken:
+        @classmethod
+        def INPUT_TYPES(s):
+            raise ValueError("broken")
+
+    mappings = {"StaticNode": StaticNode, "Broken": Broken}
+    cache = ObjectInfoCache(Counter(mappings))
+    assert list(json.loads(cache.get(mappings)[0])) == ["StaticNode"]
+    assert json.loads(cache.get_node(mappings, "StaticNode")) == {"StaticNode": {"name": "StaticNode", "input": {"required": {"value": ["INT"]}}}}
+
+
+def test_folder_paths_scanned_by_the_node(folders, tmp_path):
+    mappings = {"DiffusersNode": DiffusersNode}
+    node_info = Counter(mappings)
+    cache = ObjectInfoCache(node_info)
+    cache.get(mappings)
+    cache.get(mappings)
+    assert node_info.calls == ["DiffusersNode"]
+
+    model = tmp_path / "diffusers" / "model"
+    model.mkdir()
+    (model / "model_index.json").write_text("{}")
+    os.utime(tmp_path / "diffusers", (1000, 1000))
+    document = json.loads(cache.get(mappings)[0])
+    assert node_info.calls == ["DiffusersNode", "DiffusersNode"]
+    assert document["DiffusersNode"]["input"]["required"]["model_path"] == [["model"]]
+
+
+def test_custom_nodes_without_dependencies_are_not_kept(folders, tmp_path, monkeypatch):
+    monkeypatch.setattr(CustomListNode, "directory", str(tmp_path / "input"))
+    mappings = {"CustomListNode": CustomListNode}
+    node_info = Counter(mappings)
+    cache = ObjectInfoCache(node_info)
+    _, etag, version = cache.get(mappings)
+    # Asked again but the document only changes with the definition
+    assert cache.get(mappings) == (cache.document, etag, version)
+    assert node_info.calls == ["CustomListNode", "CustomListNode"]
+    (tmp_path / "input" / "new.txt").write_bytes(b"")
+    document = json.loads(cache.get(mappings)[0])
+    assert document["CustomListNode"]["input"]["required"]["name"] == [["new.txt"]]
+
+    monkeypatch.setattr(CustomListNode, "CACHEABLE_INPUT_TYPES", True, raising=False)
+    node_info.calls.clear()
+    cache.get(mappings)
+    cache.get(mappings)
+    assert node_info.calls == ["CustomListNode"]
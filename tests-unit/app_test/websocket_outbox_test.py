@@ -0,0 +1,49 @@
+import asyncio
+
+from app.websocket_outbox import WebSocketOutbox
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_str(self, message):
+        self.sent.append(message)
+
+    async def send_bytes(self, message):
+        self.sent.append(message)
+
+
+def test_coalesce_replaces_stale_message():
+    outbox = WebSocketOutbox(FakeWebSocket())
+    outbox.put("progress 1", "progress")
+    outbox.put("executing")
+    outbox.put("progress 2", "progress")
+    assert [m for _, m in outbox.pending] == ["executing", "progress 2"]
+    assert outbox.dropped == 1
+
+
+def test_full_outbox_drops_only_coalescable_messages():
+    outbox = WebSocketOutbox(FakeWebSocket(), max_size=2)
+    outbox.put("a")
+    outbox.put("b")
+    outbox.put(b"preview", "preview")
+    outbox.put("executed")
+    assert [m for _, m in outbox.pending] == ["a", "b", "executed"]
+    assert outbox.dropped == 1
+
+
+def test_sends_in_order():
+    async def run():
+        ws = FakeWebSocket()
+        outbox = WebSocketOutbox(ws)
+        outbox.start()
+        outbox.put("a")
+        outbox.put(b"b", "preview")
+        outbox.put("c")
+        for _ in range(10):
+            await asyncio.sleep(0)
+        outbox.stop()
+        return ws.sent
+
+    assert asyncio.run(run()) == ["a", b"b", "c"]
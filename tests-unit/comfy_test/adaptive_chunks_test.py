@@ -0,0 +1,110 @@
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.adaptive_chunks  # noqa: E402
+import comfy.batch_pipeline  # noqa: E402
+import comfy.model_management  # noqa: E402
+import comfy.utils  # noqa: E402
+
+
+class FakeModel:
+    pass
+
+
+@pytest.fixture(autouse=True)
+def memory(monkeypatch):
+    monkeypatch.setattr(comfy.adaptive_chunks, "size_limits", {})
+    free = {"memory": 1000}
+    monkeypatch.setattr(comfy.model_management, "get_free_memory", lambda device=None: free["memory"])
+    return free
+
+
+def chunks_up_to(limit, done, calls, first_failing=0):
+    """Processes items in chunks, running out of memory on chunks larger than limit from item first_failing on."""
+    def fn(start, size):
+        for x in range(start, len(done), size):
+            count = min(size, len(done) - x)
+            calls.append(count)
+            if count > limit and x >= first_failing:
+                raise comfy.model_management.OOM_EXCEPTION("out of memory")
+            for i in range(x, x + count):
+                done[i] += 1
+            yield x + count
+    return fn
+
+
+def test_finished_chunks_are_kept():
+    done = [0] * 20
+    calls = []
+    model = FakeModel()
+    key = comfy.adaptive_chunks.size_key(model, (4, 8, 8), torch.float16, "cpu")
+    assert comfy.adaptive_chunks.run_chunks(chunks_up_to(5, done, calls, first_failing=8), 20, 8, key) == 4
+    # The first chunk isn't run again
+    assert calls == [8, 8, 4, 4, 4]
+    assert done == [1] * 20
+
+    # The size that worked is used from the start
+    calls.clear()
+    comfy.adaptive_chunks.run_chunks(chunks_up_to(5, [0] * 20, calls), 20, 8, key)
+    assert calls == [4] * 5
+    # But not for other shapes or other models of the same class
+    for other in (comfy.adaptive_chunks.size_key(model, (4, 16, 16), torch.float16, "cpu"), comfy.adaptive_chunks.size_key(FakeModel(), (4, 8, 8), torch.float16, "cpu")):
+        calls.clear()
+        comfy.adaptive_chunks.run_chunks(chunks_up_to(8, [0] * 8, calls), 8, 8, other)
+        assert calls == [8]
+
+
+def test_learnt_size_is_forgotten_with_more_free_memory(memory):
+    key = comfy.adaptive_chunks.size_key(FakeModel(), (4, 8, 8), torch.float16, "cpu")
+    comfy.adaptive_chunks.run_chunks(chunks_up_to(3, [0] * 8, []), 8, 8, key)
+    assert comfy.adaptive_chunks.limit(key, 8) == 2
+    memory["memory"] = 2000
+    assert comfy.adaptive_chunks.limit(key, 8) == 8
+
+
+def test_single_item_out_of_memory_raises():
+    with pytest.raises(comfy.model_management.OOM_EXCEPTION):
+        comfy.adaptive_chunks.run_chunks(chunks_up_to(0, [0] * 4, []), 4, 4)
+
+
+def test_run_batches_falls_back_for_remaining_items():
+    inputs = torch.arange(6, dtype=torch.float32).view(6, 1, 1, 1)
+
+    def fn(x):
+        if (x >= 4).any():
+            raise comfy.model_management.OOM_EXCEPTION("out of memory")
+        return x * 2
+
+    fallback_inputs = []
+
+    def fallback(x):
+        fallback_inputs.append(x)
+        return x * 2
+
+    out = comfy.batch_pipeline.run_batches(fn, inputs, 4, torch.device("cpu"), torch.float32, torch.device("cpu"), fallback=fallback)
+    assert torch.equal(out, inputs * 2)
+    assert len(fallback_inputs) == 1 and torch.equal(fallback_inputs[0], inputs[4:])
+
+
+def test_tiles_are_not_added_twice_on_retry(monkeypatch):
+    samples = torch.randn(1, 1, 16, 16)
+    get_feather_mask = comfy.utils.get_feather_mask
+    calls = []
+    def failing_feather_mask(shape, feathers, device):
+        calls.append(shape)
+        # Runs out of memory after the first tile of the chunk was blended
+        if len(calls) == 2:
+            raise comfy.model_management.OOM_EXCEPTION("out of memory")
+        return get_feather_mask(shape, feathers, device)
+    # Outputs that differ between tiles so their blend weights matter
+    def function(x):
+        return x + x.mean(dim=(1, 2, 3), keepdim=True)
+    expected = comfy.utils.tiled_scale_multidim(samples, function, tile=(8, 8), overlap=4, upscale_amount=1, out_channels=1, max_batch=9)
+    monkeypatch.setattr(comfy.utils, "get_feather_mask", failing_feather_mask)
+    out = comfy.utils.tiled_scale_multidim(samples, function, tile=(8, 8), overlap=4, upscale_amount=1, out_channels=1, max_batch=9)
+    assert len(calls) > 9
+    assert torch.allclose(out, expected)
@@ -0,0 +1,90 @@
+import threading
+
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.batch_pipeline  # noqa: E402
+import comfy.model_management  # noqa: E402
+
+
+def double(x):
+    return (x * 2).movedim(1, -1)
+
+
+def check(device, output_device):
+    inputs = torch.randn(7, 3, 16, 16)
+    calls = []
+    def fn(x):
+        calls.append(x.shape[0])
+        assert x.device.type == device.type and x.dtype == torch.float16
+        return double(x)
+    out = comfy.batch_pipeline.run_batches(fn, inputs, 3, device, torch.float16, output_device)
+    assert calls == [3, 3, 1]
+    assert out.device.type == output_device.type and out.dtype == torch.float32
+    assert out.shape == (7, 16, 16, 3)
+    assert torch.equal(out.cpu(), double(inputs.half()).float())
+
+
+def test_run_batches():
+    check(torch.device("cpu"), torch.device("cpu"))
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA is not available")
+def test_run_batches_pipelined(monkeypatch):
+    # Staging buffers smaller than a chunk
+    monkeypatch.setattr(comfy.batch_pipeline, "STAGING_BYTES", 1000)
+    monkeypatch.setattr(comfy.batch_pipeline, "staging_pool", {})
+    device = comfy.model_management.get_torch_device()
+    check(device, torch.device("cpu"))
+
+
+class FakeStream:
+    def __init__(self, device=None):
+        pass
+
+    def record_event(self):
+        return None
+
+    def wait_event(self, event):
+        pass
+
+
+class FakeStaging:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lock.acquire()
+
+    def flush_all(self):
+        pass
+
+
+def test_compute_is_queued_before_the_next_upload(monkeypatch):
+    # The CUDA path with the streams and staging buffers replaced, only the order of the work is checked
+    monkeypatch.setattr(torch.cuda, "current_stream", lambda device=None: FakeStream())
+    monkeypatch.setattr(torch.cuda, "Stream", FakeStream)
+    monkeypatch.setattr(comfy.batch_pipeline, "get_staging", lambda direction: FakeStaging())
+    order = []
+    def upload(chunk, device, stream, staging):
+        order.append(("upload", chunk[0, 0, 0, 0].item()))
+        return chunk.clone(), None
+    def download(out, destination, stream, staging):
+        order.append(("download", out[0, 0, 0, 0].item()))
+        destination.copy_(out)
+    monkeypatch.setattr(comfy.batch_pipeline, "upload", upload)
+    monkeypatch.setattr(comfy.batch_pipeline, "download", download)
+    def fn(x):
+        order.append(("compute", x[0, 0, 0, 0].item()))
+        return x * 2
+
+    inputs = torch.arange(3).float().view(3, 1, 1, 1)
+    run = comfy.batch_pipeline.BatchRun(fn, inputs, torch.device("cpu"), torch.float32, torch.device("cpu"), torch.float32)
+    assert list(run.chunks_cuda(0, 1)) == [1, 2, 3]
+    assert order == [
+        ("upload", 0.0), ("compute", 0.0), ("upload", 1.0), ("download", 0.0),
+        ("compute", 1.0), ("upload", 2.0), ("download", 2.0), ("compute", 2.0), ("download", 4.0),
+    ]
+    assert torch.equal(run.output, inputs * 2)
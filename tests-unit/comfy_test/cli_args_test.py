@@ -0,0 +1,20 @@
+import argparse
+import pytest
+from comfy.cli_args import parse_size
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("1024", 1024),
+    ("512MB", 512 * 1024 ** 2),
+    ("24GB", 24 * 1024 ** 3),
+    ("1.5g", int(1.5 * 1024 ** 3)),
+    ("2T", 2 * 1024 ** 4),
+])
+def test_parse_size(value, expected):
+    assert parse_size(value) == expected
+
+
+@pytest.mark.parametrize("value", ["", "GB", "12XB", "abc"])
+def test_parse_size_invalid(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_size(value)
@@ -0,0 +1,139 @@
+import uuid
+
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.adaptive_chunks  # noqa: E402
+import comfy.conds  # noqa: E402
+import comfy.model_management  # noqa: E402
+import comfy.samplers  # noqa: E402
+
+
+class FakePatcher:
+    def prepare_state(self, timestep):
+        pass
+
+    def apply_hooks(self, hooks):
+        return {}
+
+
+class FakeModel:
+    current_patcher = FakePatcher()
+    manual_cast_dtype = None
+    model_lowvram = False
+
+    def __init__(self, memory_per_item=1, max_batch=None):
+        self.memory_per_item = memory_per_item
+        self.max_batch = max_batch
+        self.batch_sizes = []
+
+    def get_dtype(self):
+        return torch.float32
+
+    def memory_required(self, input_shape):
+        return input_shape[0] * self.memory_per_item
+
+    def apply_model(self, x, t, c_crossattn=None, transformer_options=None, **kwargs):
+        self.batch_sizes.append(x.shape[0])
+        if self.max_batch is not None and x.shape[0] > self.max_batch:
+            raise comfy.model_management.OOM_EXCEPTION("out of memory")
+        return x * 0.5 + c_crossattn.mean(dim=(1, 2)).view(-1, 1, 1, 1)
+
+
+def cond(area=None, strength=1.0, length=77):
+    c = {"model_conds": {"c_crossattn": comfy.conds.CONDCrossAttn(torch.randn(1, length, 8))}, "uuid": uuid.uuid4(), "strength": strength}
+    if area is not None:
+        c["area"] = area
+    return c
+
+
+def reference(conds, x):
+    """The conds applied one at a time."""
+    out = []
+    for cond_list in conds:
+        total = torch.zeros_like(x)
+        counts = torch.ones_like(x) * 1e-37
+        for c in cond_list:
+            p = comfy.samplers.get_area_and_mult(c, x, torch.tensor([1.0]))
+            output = p.input_x * 0.5 + p.conditioning["c_crossattn"].cond.mean()
+            t, n = total, counts
+            if p.area is not None:
+                for i in range(2):
+                    t = t.narrow(i + 2, p.area[i + 2], p.area[i])
+                    n = n.narrow(i + 2, p.area[i + 2], p.area[i])
+            t += output * p.mult
+            n += p.mult
+        out.append(total / counts)
+    return out
+
+
+def test_grouping_matches_concat_rules():
+    torch.manual_seed(0)
+    x = torch.randn(1, 4, 32, 32)
+    conds = [[cond(), cond(area=(16, 16, 0, 0), strength=0.5), cond(area=(16, 16, 16, 16)), cond(area=(8, 24, 0, 8))], [cond()]]
+    model = FakeModel()
+    out = comfy.samplers._calc_cond_batch(model, conds, x, torch.tensor([1.0]), {})
+    # Full size conds, the two 16x16 areas and the 8x24 area
+    assert sorted(model.batch_sizes) == [1, 2, 2]
+    for a, b in zip(out, reference(conds, x)):
+        assert torch.allclose(a, b, atol=1e-6)
+
+
+def test_conditioning_lengths_share_a_pass():
+    torch.manual_seed(0)
+    x = torch.randn(1, 4, 16, 16)
+    # 77 and 462 tokens can't be padded together but both can be with 154, which used to be missed when the 77 came first
+    conds = [[cond(length=77)], [cond(length=154), cond(length=462)]]
+    model = FakeModel()
+    out = comfy.samplers._calc_cond_batch(model, conds, x, torch.tensor([1.0]), {})
+    assert model.batch_sizes == [3]
+    for a, b in zip(out, reference(conds, x)):
+        assert torch.allclose(a, b, atol=1e-6)
+
+
+def test_batches_are_evenly_split_within_memory(monkeypatch):
+    torch.manual_seed(0)
+    monkeypatch.setattr(comfy.model_management, "get_free_memory", lambda device: 1000)
+    x = torch.randn(1, 4, 16, 16)
+    conds = [[cond() for _ in range(7)]]
+    # Room for 3 conds at a time, 7 conds take 3 passes
+    model = FakeModel(memory_per_item=200)
+    out = comfy.samplers._calc_cond_batch(model, conds, x, torch.tensor([1.0]), {})
+    assert model.batch_sizes == [3, 2, 2]
+    assert torch.allclose(out[0], reference(conds, x)[0], atol=1e-6)
+
+
+def test_batches_that_run_out_of_memory_are_split(monkeypatch):
+    torch.manual_seed(0)
+    monkeypatch.setattr(comfy.adaptive_chunks, "size_limits", {})
+    x = torch.randn(1, 4, 16, 16)
+    conds = [[cond() for _ in range(6)]]
+    model = FakeModel(max_batch=2)
+    out = comfy.samplers._calc_cond_batch(model, conds, x, torch.tensor([1.0]), {})
+    assert model.batch_sizes == [6, 3, 2, 2, 2]
+    assert torch.allclose(out[0], reference(conds, x)[0], atol=1e-6)
+
+    # The next step starts with the size that worked
+    model.batch_sizes.clear()
+    comfy.samplers._calc_cond_batch(model, conds, x, torch.tensor([1.0]), {})
+    assert model.batch_sizes == [2, 2, 2]
+
+
+def test_out_of_memory_leaves_outputs_unchanged(monkeypatch):
+    out_conds = [torch.zeros(1, 4, 8, 8)]
+    out_counts = [torch.zeros(1, 4, 8, 8)]
+    output = torch.ones(3, 4, 8, 8).chunk(3)
+    mult = [torch.ones(1, 4, 8, 8)] * 3
+    # One full size output and two for the same area, the area's sum runs out of memory
+    area = [None, (4, 4, 0, 0), (4, 4, 0, 0)]
+    def stack(*args, **kwargs):
+        raise comfy.model_management.OOM_EXCEPTION("out of memory")
+    monkeypatch.setattr(torch, "stack", stack)
+    with pytest.raises(comfy.model_management.OOM_EXCEPTION):
+        comfy.samplers.accumulate_cond_output(out_conds, out_counts, output, mult, area, [0, 0, 0])
+    assert torch.count_nonzero(out_conds[0]) == 0
+    assert torch.count_nonzero(out_counts[0]) == 0
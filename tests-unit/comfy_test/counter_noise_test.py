@@ -0,0 +1,47 @@
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.counter_noise  # noqa: E402
+import comfy.sample  # noqa: E402
+
+
+def test_distribution():
+    noise = comfy.counter_noise.randn((2, 4, 64, 63), [1, 1])
+    assert abs(noise.mean().item()) < 0.03
+    assert abs(noise.std().item() - 1.0) < 0.02
+    # Batch items and neighbouring values are independent
+    assert abs(torch.corrcoef(noise.reshape(2, -1))[0, 1].item()) < 0.04
+    flat = noise.flatten()
+    assert abs(torch.corrcoef(torch.stack((flat[:-1], flat[1:])))[0, 1].item()) < 0.04
+
+
+def test_any_batch_index_directly():
+    full = comfy.counter_noise.randn((6, 4, 8, 8), [42] * 6)
+    picked = comfy.counter_noise.randn((2, 4, 8, 8), [42] * 2, [5, 2])
+    assert torch.equal(picked, full[[5, 2]])
+    assert not torch.equal(full, comfy.counter_noise.randn((6, 4, 8, 8), [43] * 6))
+    # 64 bit seeds use all their bits
+    assert not torch.equal(comfy.counter_noise.randn((1, 16), [1]), comfy.counter_noise.randn((1, 16), [1 + 2 ** 32]))
+
+
+def test_prompt_batch_noise(monkeypatch):
+    monkeypatch.setattr(args, "device_noise", True)
+    latent = torch.zeros(2, 4, 8, 8)
+    expanded = comfy.sample.expand_latent_for_prompt_batch({"samples": latent, "batch_index": [3, 7]}, 3)
+    noise = comfy.sample.prepare_prompt_batch_noise(expanded["samples"], [10, 11, 12], expanded["batch_index"])
+    for i, seed in enumerate([10, 11, 12]):
+        assert torch.equal(noise[i::3].cpu(), comfy.sample.prepare_noise(latent, seed, [3, 7]).cpu())
+
+
+def test_noise_like_latent(monkeypatch):
+    monkeypatch.setattr(args, "device_noise", True)
+    latent = torch.zeros(2, 4, 8, 8)
+    noise = comfy.sample.prepare_noise(latent, 1)
+    # Consumers add it to the latent on the intermediate device
+    assert noise.device == latent.device
+    noise = comfy.sample.prepare_noise(latent.to_sparse(), 1)
+    assert noise.layout == torch.sparse_coo
+    assert torch.equal(noise.to_dense(), comfy.sample.prepare_noise(latent, 1))
@@ -0,0 +1,94 @@
+import gc
+import uuid
+import weakref
+
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.model_patcher  # noqa: E402
+from comfy.model_patcher import patch_list_signature, same_patch_list  # noqa: E402
+
+CPU = torch.device("cpu")
+
+
+def lora_patch(up, down, strength=1.0):
+    # (strength_patch, patch, strength_model, offset, function)
+    return [(strength, ("lora", (up, down, 1.0, None, None, None)), 1.0, None, None)]
+
+
+def test_same_patch_list():
+    up, down = torch.randn(4, 2), torch.randn(2, 4)
+    signature = patch_list_signature(lora_patch(up, down))
+    # Made again from the same loaded weights
+    assert same_patch_list(signature, lora_patch(up, down))
+    assert not same_patch_list(signature, lora_patch(up, down, strength=0.5))
+    assert not same_patch_list(signature, lora_patch(up.clone(), down))
+    assert not same_patch_list(signature, lora_patch(up, down) * 2)
+    assert not same_patch_list(signature, None)
+    assert same_patch_list(None, None)
+
+
+def test_signature_doesnt_keep_weights_alive():
+    up, down = torch.randn(4, 2), torch.randn(2, 4)
+    signature = patch_list_signature(lora_patch(up, down))
+    ref = weakref.ref(up)
+    del up
+    gc.collect()
+    assert ref() is None
+    assert not same_patch_list(signature, lora_patch(torch.randn(4, 2), down))
+
+
+@pytest.fixture
+def patched():
+    model = torch.nn.Sequential(torch.nn.Linear(2, 2), torch.nn.Linear(2, 2))
+    base = {k: v.clone() for k, v in model.state_dict().items()}
+    patcher = comfy.model_patcher.ModelPatcher(model, CPU, CPU)
+    patcher.add_patches({"0.weight": (torch.ones(2, 2),)}, 1.0)
+    patcher.patch_model(device_to=CPU)
+    return model, base, patcher
+
+
+def record_patched_keys(monkeypatch):
+    keys = []
+    original = comfy.model_patcher.ModelPatcher.patch_weight_to_device
+    def patch_weight_to_device(self, key, *args, **kwargs):
+        keys.append(key)
+        return original(self, key, *args, **kwargs)
+    monkeypatch.setattr(comfy.model_patcher.ModelPatcher, "patch_weight_to_device", patch_weight_to_device)
+    return keys
+
+
+def test_switching_clones_only_patches_changed_weights(patched, monkeypatch):
+    model, base, patcher = patched
+    keys = record_patched_keys(monkeypatch)
+    clone = patcher.clone()
+    clone.add_patches({"1.weight": (torch.full((2, 2), 2.0),)}, 1.0)
+
+    clone.partially_load(CPU, extra_memory=1e9)
+    assert keys == ["1.weight"]
+    assert torch.equal(model[0].weight, base["0.weight"] + 1)
+    assert torch.equal(model[1].weight, base["1.weight"] + 2)
+
+    keys.clear()
+    patcher.partially_load(CPU, extra_memory=1e9)
+    # 1.weight only had to be restored from its backup
+    assert keys == []
+    assert torch.equal(model[0].weight, base["0.weight"] + 1)
+    assert torch.equal(model[1].weight, base["1.weight"])
+
+
+def test_changed_strength_is_recomputed(patched, monkeypatch):
+    model, base, patcher = patched
+    keys = record_patched_keys(monkeypatch)
+    clone = patcher.clone()
+    clone.patches["0.weight"] = [(0.5,) + clone.patches["0.weight"][0][1:]]
+    clone.patches_uuid = uuid.uuid4()
+
+    clone.partially_load(CPU, extra_memory=1e9)
+    assert keys == ["0.weight"]
+    assert torch.equal(model[0].weight, base["0.weight"] + 0.5)
+    assert torch.equal(model[1].weight, base["1.weight"])
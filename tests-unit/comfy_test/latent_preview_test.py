@@ -0,0 +1,76 @@
+import threading
+import time
+
+import torch
+
+from comfy.cli_args import args, LatentPreviewMethod
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import latent_preview  # noqa: E402
+import comfy.latent_formats  # noqa: E402
+import comfy.utils  # noqa: E402
+
+
+class BlockingPreviewer:
+    def __init__(self):
+        self.release = threading.Event()
+        self.decoded = []
+
+    def decode_latent_to_preview_image(self, preview_format, x0):
+        self.release.wait()
+        self.decoded.append(x0[0, 0, 0, 0].item())
+        return ("JPEG", x0[0, 0, 0, 0].item(), 512)
+
+
+def test_previews_decode_in_the_background():
+    previewer = BlockingPreviewer()
+    pipeline = latent_preview.PreviewPipeline(previewer, "JPEG")
+    for step in range(4):
+        # Returns right away while the first preview is stuck decoding
+        assert pipeline.take_preview() is None
+        pipeline.submit(step, torch.full((2, 4, 8, 8), float(step)))
+    previewer.release.set()
+    # The preview thread runs one task at a time
+    latent_preview.get_preview_executor().submit(lambda: None).result()
+    # The steps submitted while the first one decoded were replaced by the latest
+    assert previewer.decoded == [0.0, 3.0]
+    assert pipeline.take_preview() == ("JPEG", 3.0, 512)
+    assert pipeline.take_preview() is None
+
+
+def test_throttling():
+    pipeline = latent_preview.PreviewPipeline(None, "JPEG", interval=2, max_fps=0.001)
+    assert not pipeline.ready(1)
+    assert pipeline.ready(2)
+    pipeline.last_submit = time.perf_counter()
+    assert not pipeline.ready(4)
+
+
+def test_previewers_are_shared(monkeypatch):
+    monkeypatch.setattr(args, "preview_method", LatentPreviewMethod.Latent2RGB)
+    monkeypatch.setattr(latent_preview, "previewers", {})
+    a = latent_preview.get_previewer(torch.device("cpu"), comfy.latent_formats.SD15())
+    assert a is latent_preview.get_previewer(torch.device("cpu"), comfy.latent_formats.SD15())
+    assert a is not latent_preview.get_previewer(torch.device("cpu"), comfy.latent_formats.SDXL())
+
+
+class FakeModel:
+    load_device = torch.device("cpu")
+
+    class model:
+        latent_format = comfy.latent_formats.SD15()
+
+
+def test_last_step_preview_is_sent(monkeypatch):
+    previewer = BlockingPreviewer()
+    previewer.release.set()
+    monkeypatch.setattr(latent_preview, "get_previewer", lambda device, latent_format: previewer)
+    # Throttled so that only the first step is previewed on the way
+    monkeypatch.setattr(args, "preview_max_fps", 0.001)
+    updates = []
+    monkeypatch.setattr(comfy.utils, "PROGRESS_BAR_HOOK", lambda value, total, preview: updates.append((value, preview)))
+    callback = latent_preview.prepare_callback(FakeModel(), 3)
+    for step in range(3):
+        callback(step, torch.full((1, 4, 8, 8), float(step)), None, 3)
+    assert updates[-1] == (3, ("JPEG", 2.0, 512))
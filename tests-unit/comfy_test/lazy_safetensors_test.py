@@ -0,0 +1,105 @@
+import pytest
+import safetensors.torch
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.utils  # noqa: E402
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    sd = {
+        "model.diffusion_model.a.weight": torch.randn(4, 3),
+        "model.diffusion_model.a.bias": torch.randn(4, dtype=torch.float16),
+        # An odd sized tensor makes the ones after it misaligned
+        "model.odd": torch.arange(3, dtype=torch.uint8),
+        "first_stage_model.b.weight": torch.randn(2, 2, dtype=torch.bfloat16),
+        "cond_stage_model.c": torch.arange(5, dtype=torch.int64),
+        "empty": torch.zeros(0, 3),
+    }
+    path = str(tmp_path / "model.safetensors")
+    safetensors.torch.save_file(sd, path, metadata={"format": "pt"})
+    return path
+
+
+def test_values_match_load_file(checkpoint):
+    sd, metadata = comfy.utils.load_safetensors_lazy(checkpoint, torch.device("cpu"))
+    expected = safetensors.torch.load_file(checkpoint)
+    assert isinstance(sd, comfy.utils.LazySafetensorsStateDict)
+    assert metadata == {"format": "pt"}
+    assert sorted(sd.keys()) == sorted(expected.keys())
+    for k, v in expected.items():
+        assert sd[k].dtype == v.dtype
+        assert torch.equal(sd[k], v)
+
+
+def test_load_torch_file_is_lazy(checkpoint):
+    sd = comfy.utils.load_torch_file(checkpoint)
+    if comfy.utils.LAZY_SAFETENSORS_LOAD:
+        assert isinstance(sd, comfy.utils.LazySafetensorsStateDict)
+    assert torch.equal(sd["cond_stage_model.c"], torch.arange(5))
+
+
+def test_key_replace_keeps_tensors_lazy(checkpoint):
+    sd, _ = comfy.utils.load_safetensors_lazy(checkpoint, torch.device("cpu"))
+    expected = safetensors.torch.load_file(checkpoint)
+    comfy.utils.state_dict_key_replace(sd, {"model.odd": "renamed", "missing": "other"})
+    assert "model.odd" not in sd
+    assert "other" not in sd
+    assert isinstance(sd.entries["renamed"], comfy.utils.LazyTensor)
+    assert torch.equal(sd["renamed"], expected["model.odd"])
+
+
+def test_prefix_replace(checkpoint):
+    sd, _ = comfy.utils.load_safetensors_lazy(checkpoint, torch.device("cpu"))
+    expected = safetensors.torch.load_file(checkpoint)
+
+    vae = comfy.utils.state_dict_prefix_replace(sd, {"first_stage_model.": ""}, filter_keys=True)
+    assert isinstance(vae, comfy.utils.LazySafetensorsStateDict)
+    assert list(vae.keys()) == ["b.weight"]
+    assert isinstance(vae.entries["b.weight"], comfy.utils.LazyTensor)
+    assert torch.equal(vae["b.weight"], expected["first_stage_model.b.weight"])
+    # Filtered keys are moved out of the original
+    assert "first_stage_model.b.weight" not in sd
+
+    out = comfy.utils.state_dict_prefix_replace(sd, {"model.diffusion_model.": "unet."})
+    assert out is sd
+    assert torch.equal(sd["unet.a.weight"], expected["model.diffusion_model.a.weight"])
+    assert "model.diffusion_model.a.bias" not in sd
+
+
+def test_inplace_writes_dont_reach_the_file(checkpoint):
+    expected = safetensors.torch.load_file(checkpoint)
+    sd, _ = comfy.utils.load_safetensors_lazy(checkpoint, torch.device("cpu"))
+    sd["model.diffusion_model.a.weight"].add_(1.0)
+    sd["cond_stage_model.c"].zero_()
+    sd["model.odd"].fill_(7)
+    del sd
+
+    reloaded = safetensors.torch.load_file(checkpoint)
+    for k, v in expected.items():
+        assert torch.equal(reloaded[k], v)
+    sd, _ = comfy.utils.load_safetensors_lazy(checkpoint, torch.device("cpu"))
+    assert torch.equal(sd["cond_stage_model.c"], expected["cond_stage_model.c"])
+
+
+def test_copy_is_independent(checkpoint):
+    sd, _ = comfy.utils.load_safetensors_lazy(checkpoint, torch.device("cpu"))
+    copy = sd.copy()
+    del copy["empty"]
+    copy["new"] = torch.ones(1)
+    assert "empty" in sd
+    assert "new" not in sd
+    assert sd["empty"].shape == (0, 3)
+
+
+def test_truncated_file(checkpoint):
+    with open(checkpoint, "rb") as f:
+        data = f.read()
+    with open(checkpoint, "wb") as f:
+        f.write(data[:-8])
+    with pytest.raises(ValueError, match="MetadataIncompleteBuffer"):
+        comfy.utils.load_safetensors_lazy(checkpoint, torch.device("cpu"))
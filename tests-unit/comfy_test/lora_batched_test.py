@@ -0,0 +1,90 @@
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.lora  # noqa: E402
+import comfy.model_patcher  # noqa: E402
+
+CPU = torch.device("cpu")
+
+
+def lora(up, down, strength=1.0, alpha=None, mid=None, dora_scale=None, offset=None):
+    # (strength_patch, patch, strength_model, offset, function)
+    return (strength, ("lora", (up, down, alpha, mid, dora_scale, None)), 1.0, offset, None)
+
+
+def make_patches(shape, ranks, generator):
+    patches = []
+    for i, rank in enumerate(ranks):
+        up = torch.randn(shape[0], rank, *([1] * (len(shape) - 2)), generator=generator)
+        down = torch.randn(rank, *shape[1:], generator=generator)
+        patches.append(lora(up, down, strength=0.5 + i, alpha=float(rank) / (i + 1)))
+    return patches
+
+
+@pytest.mark.parametrize("shape", [(8, 6), (8, 4, 3, 3)])
+def test_matches_calculate_weight(shape):
+    generator = torch.Generator().manual_seed(0)
+    weights = [torch.randn(shape, generator=generator) for _ in range(3)]
+    # Stacked LoRAs of different ranks with the same total rank
+    patch_lists = [make_patches(shape, ranks, generator) for ranks in ([4], [1, 3], [2, 2])]
+    for patches in patch_lists:
+        assert all(comfy.lora.is_plain_lora_patch(p, shape) for p in patches)
+
+    diffs = comfy.lora.calculate_lora_diffs_batched(patch_lists, shape, CPU)
+    assert diffs.shape == (3, *shape)
+    for weight, patches, diff in zip(weights, patch_lists, diffs):
+        expected = comfy.lora.calculate_weight(patches, weight.clone(), "key")
+        torch.testing.assert_close(weight + diff, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_writes_to_out():
+    generator = torch.Generator().manual_seed(0)
+    patch_lists = [make_patches((8, 6), [2], generator) for _ in range(2)]
+    out = torch.empty(2 * 8 * 6)
+    diffs = comfy.lora.calculate_lora_diffs_batched(patch_lists, (8, 6), CPU, out=out)
+    assert diffs.data_ptr() == out.data_ptr()
+
+
+def test_plain_lora_patch():
+    up, down = torch.randn(8, 2), torch.randn(2, 6)
+    assert comfy.lora.is_plain_lora_patch(lora(up, down), (8, 6))
+    assert not comfy.lora.is_plain_lora_patch(lora(up, down), (6, 8))
+    assert not comfy.lora.is_plain_lora_patch(lora(up, down, mid=torch.randn(2, 2)), (8, 6))
+    assert not comfy.lora.is_plain_lora_patch(lora(up, down, dora_scale=torch.ones(8, 1)), (8, 6))
+    assert not comfy.lora.is_plain_lora_patch(lora(up, down, offset=(0, 0, 4)), (8, 6))
+    assert not comfy.lora.is_plain_lora_patch((1.0, (torch.randn(8, 6),), 1.0, None, None), (8, 6))
+
+
+def test_patch_weights_to_device_matches_single_weights():
+    generator = torch.Generator().manual_seed(0)
+    def make_model():
+        torch.manual_seed(0)
+        return torch.nn.Sequential(*[torch.nn.Linear(6, 8) for _ in range(4)])
+
+    patches = {}
+    for i in range(4):
+        patches["{}.weight".format(i)] = make_patches((8, 6), [2, 2] if i % 2 == 0 else [4], generator)
+
+    results = []
+    for batched in (True, False):
+        model = make_model()
+        patcher = comfy.model_patcher.ModelPatcher(model, CPU, CPU)
+        for key, patch_list in patches.items():
+            for p in patch_list:
+                patcher.patches.setdefault(key, []).append(p)
+        if batched:
+            patcher.patch_weights_to_device(list(patches), device_to=CPU)
+        else:
+            for key in patches:
+                patcher.patch_weight_to_device(key, device_to=CPU)
+        results.append({k: v.clone() for k, v in model.state_dict().items()})
+        patcher.unpatch_model()
+        for key, value in make_model().state_dict().items():
+            assert torch.equal(model.state_dict()[key], value)
+
+    for key in results[0]:
+        torch.testing.assert_close(results[0][key], results[1][key], rtol=1e-5, atol=1e-5)
@@ -0,0 +1,93 @@
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+from comfy import memory_calibration  # noqa: E402
+from comfy.memory_calibration import MemoryCalibration  # noqa: E402
+
+
+class FakeConfig:
+    pass
+
+
+class FakeModel:
+    manual_cast_dtype = None
+    model_config = FakeConfig()
+
+    def get_dtype(self):
+        return torch.float16
+
+
+def peak(batch, pixels):
+    return 100 + batch * pixels * 3 + batch * pixels * pixels * 2
+
+
+def calibrate(calibration, sizes):
+    key = memory_calibration.model_key(FakeModel())
+    for batch, pixels in sizes:
+        calibration.add_sample(key, batch, pixels, peak(batch, pixels))
+
+
+def test_fit_recovers_curve():
+    calibration = MemoryCalibration()
+    calibrate(calibration, [(1, 64), (2, 256), (1, 1024), (4, 512)])
+    estimate = calibration.estimate(FakeModel(), [3, 4, 32, 64])
+    expected = peak(3, 32 * 64)
+    assert abs(estimate - expected) / expected < 1e-6
+
+
+def test_no_extrapolation_without_enough_resolutions():
+    calibration = MemoryCalibration()
+    assert calibration.estimate(FakeModel(), [1, 4, 32, 32]) is None
+    calibrate(calibration, [(1, 1024), (2, 1024)])
+    assert calibration.estimate(FakeModel(), [1, 4, 16, 16]) is not None
+    assert calibration.estimate(FakeModel(), [1, 4, 64, 64]) is None
+
+
+def test_never_below_measured():
+    calibration = MemoryCalibration()
+    key = memory_calibration.model_key(FakeModel())
+    calibration.add_sample(key, 1, 100, 1000)
+    calibration.add_sample(key, 1, 50, 5000)
+    assert calibration.estimate(FakeModel(), [1, 4, 10, 10]) >= 5000
+
+
+def test_persistence(tmp_path, monkeypatch):
+    monkeypatch.setattr(memory_calibration, "environment", lambda: "env1")
+    path = str(tmp_path / "calibration.json")
+    calibrate(MemoryCalibration(path), [(1, 64), (1, 128), (1, 256)])
+    assert MemoryCalibration(path).estimate(FakeModel(), [1, 4, 16, 16]) is not None
+
+    monkeypatch.setattr(memory_calibration, "environment", lambda: "env2")
+    assert MemoryCalibration(path).estimate(FakeModel(), [1, 4, 16, 16]) is None
+
+
+def test_patches_and_wrappers_are_measured_separately():
+    def attn1_patch(q, k, v, extra_options):
+        return q, k, v
+
+    def unet_wrapper(apply_model, args):
+        return apply_model(args["input"], args["timestep"], **args["c"])
+
+    patched = {"transformer_options": {"patches": {"attn1_patch": [attn1_patch]}}}
+    wrapped = {"model_function_wrapper": unet_wrapper}
+    keys = [memory_calibration.model_key(FakeModel(), options) for options in (None, {}, patched, wrapped)]
+    assert keys[0] == keys[1]
+    assert len(set(keys[1:])) == 3
+
+    calibration = MemoryCalibration()
+    calibrate(calibration, [(1, 64), (1, 128), (1, 256)])
+    assert calibration.estimate(FakeModel(), [1, 4, 16, 16]) is not None
+    assert calibration.estimate(FakeModel(), [1, 4, 16, 16], patched) is None
+
+
+def test_devices_are_measured_separately(monkeypatch):
+    monkeypatch.setattr(memory_calibration.comfy.model_management, "get_torch_device_name", lambda device: "GPU {}".format(device))
+    calibration = MemoryCalibration()
+    key = memory_calibration.model_key(FakeModel(), device=torch.device("cpu", 0))
+    for pixels in (64, 128, 256):
+        calibration.add_sample(key, 1, pixels, peak(1, pixels))
+    assert calibration.estimate(FakeModel(), [1, 4, 16, 16], device=torch.device("cpu", 0)) is not None
+    assert calibration.estimate(FakeModel(), [1, 4, 16, 16], device=torch.device("cpu", 1)) is None
@@ -0,0 +1,116 @@
+import gc
+import os
+
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.model_management  # noqa: E402
+from comfy.model_registry import ModelRegistry  # noqa: E402
+
+
+@pytest.fixture
+def model_file(tmp_path):
+    path = tmp_path / "model.safetensors"
+    path.write_bytes(b"0" * 16)
+    return str(path)
+
+
+class Loader:
+    def __init__(self, numel=4):
+        self.numel = numel
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return (torch.zeros(self.numel),)
+
+
+def test_shares_loaded_models(model_file):
+    registry = ModelRegistry()
+    loader = Loader()
+    first = registry.load("checkpoint", [model_file], None, loader)
+    second = registry.load("checkpoint", [model_file], None, loader)
+    assert first[0] is second[0]
+    assert loader.calls == 1
+
+
+def test_key(model_file, monkeypatch):
+    registry = ModelRegistry()
+    loader = Loader()
+    value = registry.load("checkpoint", [model_file], None, loader)
+    assert registry.load("lora", [model_file], None, loader)[0] is not value[0]
+    assert registry.load("checkpoint", [model_file], {"dtype": torch.float16}, loader)[0] is not value[0]
+    assert loader.calls == 3
+
+    # Another prompt worker loading the same file for its own device
+    monkeypatch.setattr(comfy.model_management, "get_torch_device", lambda: torch.device("cuda", 1))
+    assert registry.load("checkpoint", [model_file], None, loader)[0] is not value[0]
+    assert loader.calls == 4
+
+
+def test_reloads_changed_files(model_file):
+    registry = ModelRegistry()
+    loader = Loader()
+    value = registry.load("checkpoint", [model_file], None, loader)
+    with open(model_file, "ab") as f:
+        f.write(b"1")
+    os.utime(model_file, ns=(0, 0))
+    assert registry.load("checkpoint", [model_file], None, loader)[0] is not value[0]
+    assert loader.calls == 2
+
+
+def test_only_shares_while_referenced(model_file):
+    registry = ModelRegistry()
+    loader = Loader()
+    value = registry.load("checkpoint", [model_file], None, loader)
+    registry.load("checkpoint", [model_file], None, loader)
+    assert loader.calls == 1
+    del value
+    gc.collect()
+    registry.load("checkpoint", [model_file], None, loader)
+    assert loader.calls == 2
+
+
+def test_retains_recently_used(tmp_path):
+    # Room for two of the 16 byte tensors
+    registry = ModelRegistry(max_size=32)
+    loaders = {}
+    paths = {}
+    for name in "abc":
+        paths[name] = str(tmp_path / name)
+        with open(paths[name], "wb") as f:
+            f.write(b"0")
+        loaders[name] = Loader()
+
+    registry.load("checkpoint", [paths["a"]], None, loaders["a"])
+    registry.load("checkpoint", [paths["b"]], None, loaders["b"])
+    # a becomes the most recently used, b is evicted by c
+    registry.load("checkpoint", [paths["a"]], None, loaders["a"])
+    registry.load("checkpoint", [paths["c"]], None, loaders["c"])
+    assert registry.retained_size == 32
+    gc.collect()
+
+    registry.load("checkpoint", [paths["a"]], None, loaders["a"])
+    registry.load("checkpoint", [paths["b"]], None, loaders["b"])
+    assert loaders["a"].calls == 1
+    assert loaders["b"].calls == 2
+
+    registry.clear()
+    assert registry.retained_size == 0
+    gc.collect()
+    registry.load("checkpoint", [paths["c"]], None, loaders["c"])
+    assert loaders["c"].calls == 2
+
+
+def test_too_large_values_are_not_retained(model_file):
+    registry = ModelRegistry(max_size=8)
+    loader = Loader(numel=4)
+    registry.load("checkpoint", [model_file], None, loader)
+    assert registry.retained_size == 0
+    gc.collect()
+    registry.load("checkpoint", [model_file], None, loader)
+    assert loader.calls == 2
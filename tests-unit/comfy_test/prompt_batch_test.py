@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.sample  # noqa: E402
+from node_helpers import batch_conditioning  # noqa: E402
+
+
+def test_batch_conditioning():
+    a = [[torch.randn(1, 77, 8), {"pooled_output": torch.randn(1, 4), "strength": 1.0}]]
+    b = [[torch.randn(1, 154, 8), {"pooled_output": torch.randn(1, 4), "strength": 1.0}]]
+    out = batch_conditioning([a, b])
+    assert len(out) == 1
+    cond, options = out[0]
+    assert cond.shape == (2, 154, 8)
+    # Shorter conds are padded by repeating them
+    assert torch.equal(cond[0], a[0][0][0].repeat(2, 1))
+    assert torch.equal(cond[1], b[0][0][0])
+    assert torch.equal(options["pooled_output"], torch.cat([a[0][1]["pooled_output"], b[0][1]["pooled_output"]]))
+    assert options["strength"] == 1.0
+
+
+def test_batch_conditioning_rejects_mismatches():
+    a = [[torch.randn(1, 77, 8), {"strength": 1.0}]]
+    with pytest.raises(ValueError):
+        batch_conditioning([a, [[torch.randn(1, 77, 8), {"strength": 0.5}]]])
+    with pytest.raises(ValueError):
+        batch_conditioning([a, a + a])
+    with pytest.raises(ValueError):
+        batch_conditioning([a, [[torch.randn(2, 77, 8), {"strength": 1.0}]]])
+
+
+def test_expand_latent_for_prompt_batch():
+    samples = torch.arange(2).reshape(2, 1, 1, 1).float()
+    latent = {"samples": samples, "batch_index": [4, 5]}
+    out = comfy.sample.expand_latent_for_prompt_batch(latent, 3)
+    assert out["samples"].flatten().tolist() == [0, 0, 0, 1, 1, 1]
+    assert out["batch_index"] == [4, 4, 4, 5, 5, 5]
+    # Expanding twice doesn't repeat the items again
+    assert comfy.sample.expand_latent_for_prompt_batch(out, 3) is out
+
+
+@pytest.mark.parametrize("noise_inds", [None, [0, 2]])
+def test_prompt_batch_noise_matches_single_prompts(noise_inds):
+    seeds = [11, 22, 33]
+    latent = comfy.sample.expand_latent_for_prompt_batch({"samples": torch.zeros(2, 4, 8, 8)}, len(seeds))
+    expanded_inds = None
+    if noise_inds is not None:
+        expanded_inds = [i for i in noise_inds for _ in seeds]
+    noise = comfy.sample.prepare_prompt_batch_noise(latent["samples"], seeds, expanded_inds)
+    assert noise.shape == latent["samples"].shape
+    for i, seed in enumerate(seeds):
+        expected = comfy.sample.prepare_noise(torch.zeros(2, 4, 8, 8), seed, noise_inds)
+        assert torch.equal(noise[i::len(seeds)], expected)
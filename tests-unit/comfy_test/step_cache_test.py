@@ -0,0 +1,68 @@
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.ops  # noqa: E402
+from comfy.step_cache import StepCache  # noqa: E402
+from comfy.ldm.modules.diffusionmodules.openaimodel import UNetModel  # noqa: E402
+
+
+def options(cache, sigma, cond_or_uncond=[0]):
+    return {"step_cache": cache, "cond_or_uncond": cond_or_uncond, "sigmas": torch.tensor([sigma])}
+
+
+def step(cache, probe, sigma, cond_or_uncond=[0]):
+    entry = cache.lookup(options(cache, sigma, cond_or_uncond), probe)
+    if not entry.reuse:
+        entry.value = probe
+    return entry.reuse
+
+
+def test_reuse_until_change_accumulates():
+    cache = StepCache(0.25, max_skipped=10)
+    probe = torch.ones(1, 4)
+    assert not step(cache, probe, 10.0)
+    assert step(cache, probe * 1.1, 9.0)
+    assert step(cache, probe * 1.2, 8.0)
+    # 0.1 + 0.09 + 0.08 of change since the last run
+    assert not step(cache, probe * 1.3, 7.0)
+    assert step(cache, probe * 1.3, 6.0)
+
+
+def test_max_skipped_and_sigma_range():
+    cache = StepCache(1.0, start_sigma=8.0, end_sigma=2.0, max_skipped=2)
+    probe = torch.ones(1, 4)
+    reused = [step(cache, probe, sigma) for sigma in [10.0, 9.0, 8.0, 7.0, 6.0, 5.0, 4.0, 1.0]]
+    assert reused == [False, False, True, True, False, True, True, False]
+
+
+def test_cond_and_uncond_are_cached_apart():
+    cache = StepCache(1.0)
+    assert not step(cache, torch.ones(1, 4), 10.0, [0])
+    assert not step(cache, torch.ones(1, 4), 10.0, [1])
+    assert step(cache, torch.ones(1, 4), 9.0, [0])
+    assert step(cache, torch.ones(1, 4), 9.0, [1])
+    # A new sampling run starts at a higher sigma
+    assert not step(cache, torch.ones(1, 4), 10.0, [0])
+
+
+def test_unet_reuses_deep_features():
+    torch.manual_seed(0)
+    unet = UNetModel(image_size=32, in_channels=4, model_channels=32, out_channels=4, num_res_blocks=[1, 1], channel_mult=(1, 2), num_head_channels=8,
+                     use_spatial_transformer=True, transformer_depth=[1, 1], transformer_depth_output=[1, 1, 1, 1], transformer_depth_middle=1,
+                     context_dim=16, use_linear_in_transformer=True, operations=comfy.ops.disable_weight_init)
+    with torch.no_grad():
+        for p in unet.parameters():
+            p.copy_(torch.randn_like(p) * 0.1)
+        x = torch.randn(1, 4, 16, 16)
+        t = torch.tensor([10.0])
+        context = torch.randn(1, 5, 16)
+        expected = unet(x, t, context)
+        cache = StepCache(1.0)
+        first = unet(x, t, context, transformer_options=options(cache, 1.0))
+        second = unet(x, t, context, transformer_options=options(cache, 1.0))
+    assert cache.reused == 1
+    assert torch.allclose(first, expected, atol=1e-5)
+    assert torch.allclose(second, expected, atol=1e-5)
@@ -0,0 +1,52 @@
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.utils  # noqa: E402
+
+
+def upscale(x):
+    return torch.nn.functional.interpolate(x, scale_factor=2, mode="nearest") * 2 + 1
+
+
+def test_batched_tiles_match_single_tiles():
+    torch.manual_seed(0)
+    samples = torch.randn(2, 3, 50, 70)
+    calls = []
+
+    def function(x):
+        calls.append(x.shape[0])
+        return upscale(x)
+
+    single = comfy.utils.tiled_scale(samples, function, tile_x=24, tile_y=24, overlap=4, upscale_amount=2)
+    single_calls = len(calls)
+    calls.clear()
+    batched = comfy.utils.tiled_scale(samples, function, tile_x=24, tile_y=24, overlap=4, upscale_amount=2, max_batch=8)
+    assert max(calls) == 8
+    assert len(calls) < single_calls
+    assert torch.allclose(single, batched, atol=1e-5)
+    # Without overlap artifacts the blended result is the function applied to the whole input
+    assert torch.allclose(batched, upscale(samples), atol=1e-5)
+
+
+def test_single_tile_is_batched():
+    samples = torch.randn(5, 3, 16, 16)
+    calls = []
+
+    def function(x):
+        calls.append(x.shape[0])
+        return upscale(x)
+
+    out = comfy.utils.tiled_scale(samples, function, tile_x=32, tile_y=32, overlap=4, upscale_amount=2, max_batch=2)
+    assert calls == [2, 2, 1]
+    assert torch.equal(out, upscale(samples))
+
+
+def test_feather_masks_are_cached():
+    a = comfy.utils.get_feather_mask((32, 32), (8, 8), "cpu")
+    assert comfy.utils.get_feather_mask((32, 32), (8, 8), "cpu") is a
+    assert a.shape == (1, 1, 32, 32)
+    assert a[0, 0, 0, 0].item() == 1 / 64
+    assert a[0, 0, 16, 16].item() == 1
@@ -0,0 +1,143 @@
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.ops  # noqa: E402
+from comfy.weight_streaming import StreamBackend, WeightStreamer  # noqa: E402
+
+
+class RecordingBackend(StreamBackend):
+    def __init__(self):
+        self.copies = []
+        self.waits = 0
+
+    def copy(self, tensor, dtype, device, copy):
+        self.copies.append(tensor)
+        return super().copy(tensor, dtype, device, copy)
+
+    def record(self):
+        return len(self.copies)
+
+    def wait(self, event, tensors):
+        self.waits += 1
+
+
+class CacheablePatch:
+    comfy_cacheable = True
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, weight):
+        self.calls += 1
+        return weight + 1
+
+
+def make_layers(count):
+    layers = []
+    for _ in range(count):
+        layer = comfy.ops.disable_weight_init.Linear(4, 4)
+        torch.nn.init.normal_(layer.weight)
+        torch.nn.init.normal_(layer.bias)
+        layer.comfy_cast_weights = True
+        layers.append(layer)
+    return layers
+
+
+def run(streamer, layers, x):
+    for layer in layers:
+        layer.comfy_weight_streamer = streamer
+        x = layer(x)
+    return x
+
+
+def test_same_result_as_synchronous_cast():
+    layers = make_layers(4)
+    x = torch.randn(2, 4)
+    expected = run(None, layers, x)
+    streamer = WeightStreamer(RecordingBackend())
+    for _ in range(3):
+        assert torch.equal(run(streamer, layers, x), expected)
+
+
+def test_next_layers_are_prefetched():
+    layers = make_layers(4)
+    backend = RecordingBackend()
+    streamer = WeightStreamer(backend, prefetch_depth=1)
+    x = torch.randn(2, 4)
+    run(streamer, layers, x)
+    assert len(backend.copies) == 8
+    assert len(streamer.pending) == 0
+    run(streamer, layers, x)
+    # The first layer of the next step is copied while the last one runs
+    assert len(backend.copies) == 18
+    assert list(streamer.pending) == [layers[0]]
+    run(streamer, layers, x)
+    assert len(backend.copies) == 26
+    assert list(streamer.pending) == [layers[0]]
+
+
+def test_patched_weights_are_cached():
+    layers = make_layers(2)
+    patch = CacheablePatch()
+    layers[1].weight_function = [patch]
+    backend = RecordingBackend()
+    streamer = WeightStreamer(backend, cache_size=1024 * 1024)
+    x = torch.randn(2, 4)
+    expected = run(None, layers, x)
+    patch.calls = 0
+    for _ in range(3):
+        assert torch.equal(run(streamer, layers, x), expected)
+    assert patch.calls == 1
+
+
+def test_uncacheable_functions_run_every_time():
+    layers = make_layers(1)
+    calls = []
+    layers[0].weight_function = [lambda w: calls.append(1) or w]
+    streamer = WeightStreamer(RecordingBackend(), cache_size=1024 * 1024)
+    x = torch.randn(2, 4)
+    run(streamer, layers, x)
+    run(streamer, layers, x)
+    assert len(calls) == 2
+
+
+class PinningBackend(StreamBackend):
+    """Stands in for pinned memory with copies it keeps track of."""
+    def __init__(self):
+        self.pinned = set()
+
+    def pin(self, tensor):
+        if tensor.data_ptr() in self.pinned:
+            return tensor
+        pinned = tensor.clone()
+        self.pinned.add(pinned.data_ptr())
+        return pinned
+
+    def unpin(self, tensor):
+        if tensor.data_ptr() not in self.pinned:
+            return tensor
+        self.pinned.discard(tensor.data_ptr())
+        return tensor.clone()
+
+
+def test_unpin_releases_pinned_weights():
+    layers = make_layers(2)
+    weights = [layer.weight.detach().clone() for layer in layers]
+    backend = PinningBackend()
+    streamer = WeightStreamer(backend)
+    for layer in layers:
+        streamer.pin(layer)
+        # Pinning twice doesn't copy again
+        streamer.pin(layer)
+    assert len(backend.pinned) == 4
+    assert all(layer.weight.data_ptr() in backend.pinned for layer in layers)
+
+    streamer.unpin()
+    assert len(backend.pinned) == 0
+    assert streamer.pinned == []
+    for layer, weight in zip(layers, weights):
+        assert isinstance(layer.weight, torch.nn.Parameter)
+        assert torch.equal(layer.weight, weight)
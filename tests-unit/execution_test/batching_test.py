@@ -0,0 +1,102 @@
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+from comfy_execution.batching import prompt_batch_key, merge_prompts, split_history_result  # noqa: E402
+from comfy_execution.graph_utils import PromptBatch  # noqa: E402
+
+
+def make_prompt(text, seed, sampler="KSampler"):
+    seed_input = "noise_seed" if sampler == "KSamplerAdvanced" else "seed"
+    return {
+        "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "model.safetensors"}},
+        "2": {"class_type": "CLIPTextEncode", "inputs": {"text": text, "clip": ["1", 1]}},
+        "3": {"class_type": "EmptyLatentImage", "inputs": {"width": 512, "height": 512, "batch_size": 1}},
+        "4": {"class_type": sampler, "inputs": {seed_input: seed, "model": ["1", 0], "positive": ["2", 0], "negative": ["2", 0], "latent_image": ["3", 0]}},
+        "5": {"class_type": "VAEDecode", "inputs": {"samples": ["4", 0], "vae": ["1", 2]}},
+        "6": {"class_type": "SaveImage", "inputs": {"images": ["5", 0], "filename_prefix": "ComfyUI"}},
+    }
+
+
+def make_item(prompt, number=0):
+    return (number, "prompt{}".format(number), prompt, {}, ["6"])
+
+
+def test_key_ignores_batchable_inputs():
+    a = prompt_batch_key(make_item(make_prompt("a cat", 1)))
+    b = prompt_batch_key(make_item(make_prompt("a dog", 2)))
+    assert a is not None
+    assert a == b
+    assert prompt_batch_key(make_item(make_prompt("a cat", 1, "KSamplerAdvanced"))) is not None
+
+
+def test_key_depends_on_other_inputs():
+    prompt = make_prompt("a dog", 2)
+    prompt["3"]["inputs"]["width"] = 768
+    assert prompt_batch_key(make_item(make_prompt("a cat", 1))) != prompt_batch_key(make_item(prompt))
+
+
+def test_no_key_without_batchable_inputs():
+    prompt = {"1": {"class_type": "EmptyLatentImage", "inputs": {"width": 512, "height": 512, "batch_size": 1}}}
+    assert prompt_batch_key((0, "p", prompt, {}, ["1"])) is None
+
+
+def test_no_key_for_linked_batchable_input():
+    prompt = make_prompt("a cat", 1)
+    prompt["7"] = {"class_type": "PrimitiveInt", "inputs": {"value": 3}}
+    prompt["4"]["inputs"]["seed"] = ["7", 0]
+    assert prompt_batch_key(make_item(prompt)) is None
+
+
+def test_no_key_for_two_samplers_in_a_chain():
+    # Hires fix in pixel space, VAEEncode makes a new latent that the second KSampler would expand again
+    prompt = make_prompt("a cat", 1)
+    prompt["6"] = {"class_type": "ImageScaleBy", "inputs": {"image": ["5", 0], "upscale_method": "bilinear", "scale_by": 1.5}}
+    prompt["7"] = {"class_type": "VAEEncode", "inputs": {"pixels": ["6", 0], "vae": ["1", 2]}}
+    prompt["8"] = {"class_type": "KSampler", "inputs": {"seed": 1, "model": ["1", 0], "positive": ["2", 0], "negative": ["2", 0], "latent_image": ["7", 0]}}
+    prompt["9"] = {"class_type": "VAEDecode", "inputs": {"samples": ["8", 0], "vae": ["1", 2]}}
+    prompt["10"] = {"class_type": "SaveImage", "inputs": {"images": ["9", 0], "filename_prefix": "ComfyUI"}}
+    assert prompt_batch_key((0, "p", prompt, {}, ["10"])) is None
+
+    # Two samplers side by side still batch
+    prompt = make_prompt("a cat", 1)
+    prompt["8"] = {"class_type": "KSampler", "inputs": {"seed": 2, "model": ["1", 0], "positive": ["2", 0], "negative": ["2", 0], "latent_image": ["3", 0]}}
+    prompt["9"] = {"class_type": "VAEDecode", "inputs": {"samples": ["8", 0], "vae": ["1", 2]}}
+    prompt["10"] = {"class_type": "SaveImage", "inputs": {"images": ["9", 0], "filename_prefix": "ComfyUI"}}
+    assert prompt_batch_key((0, "p", prompt, {}, ["6", "10"])) is not None
+
+
+def test_no_key_for_samplers_that_dont_expand_the_latent():
+    # The conditioning would be batched per prompt but SamplerCustom keeps the latent as is
+    prompt = make_prompt("a cat", 1)
+    prompt["4"] = {"class_type": "SamplerCustom", "inputs": {"noise_seed": 1, "model": ["1", 0], "positive": ["2", 0], "negative": ["2", 0], "latent_image": ["3", 0]}}
+    assert prompt_batch_key(make_item(prompt)) is None
+
+
+def test_no_key_when_conditioning_goes_through_other_nodes():
+    prompt = make_prompt("a cat", 1)
+    prompt["7"] = {"class_type": "ConditioningCombine", "inputs": {"conditioning_1": ["2", 0], "conditioning_2": ["2", 0]}}
+    prompt["4"]["inputs"]["positive"] = ["7", 0]
+    assert prompt_batch_key(make_item(prompt)) is None
+
+
+def test_merge_prompts():
+    merged = merge_prompts([make_prompt("a cat", 1), make_prompt("a dog", 2)])
+    assert isinstance(merged["2"]["inputs"]["text"], PromptBatch)
+    assert merged["2"]["inputs"]["text"] == ["a cat", "a dog"]
+    assert merged["4"]["inputs"]["seed"] == [1, 2]
+    assert merged["3"]["inputs"]["width"] == 512
+    assert merged["2"]["inputs"]["clip"] == ["1", 1]
+
+
+def test_split_history_result():
+    images = [{"filename": "{}.png".format(i)} for i in range(4)]
+    history_result = {"outputs": {"6": {"images": images, "text": ["shared"]}}, "meta": {"6": {"node_id": "6"}}}
+    first, second = split_history_result(history_result, 2)
+    # Batch item k belongs to prompt k % 2
+    assert first["outputs"]["6"]["images"] == [images[0], images[2]]
+    assert second["outputs"]["6"]["images"] == [images[1], images[3]]
+    assert first["outputs"]["6"]["text"] == ["shared"]
+    assert second["meta"] == history_result["meta"]
@@ -0,0 +1,97 @@
+import collections
+import os
+import threading
+import time
+
+import pytest
+import torch
+
+from comfy_execution.disk_cache import DiskCache, FileLock, NotSerializable, deserialize_value, serialize_value
+
+Point = collections.namedtuple("Point", ["x", "y"])
+
+
+class Scores(dict):
+    pass
+
+
+def roundtrip(value):
+    skeleton, tensors = serialize_value(value)
+    return deserialize_value(skeleton, tensors)
+
+
+def test_roundtrip():
+    t = torch.randn(2, 3)
+    value = [[t, t[0], {"samples": torch.ones(4), "batch_index": [0, 1]}, (1, "a"), Point(t, 2.5), None]]
+    out = roundtrip(value)
+    assert torch.equal(out[0][0], t)
+    assert torch.equal(out[0][1], t[0])
+    assert torch.equal(out[0][2]["samples"], torch.ones(4))
+    assert out[0][2]["batch_index"] == [0, 1]
+    assert out[0][3] == (1, "a") and type(out[0][3]) is tuple
+    assert type(out[0][4]) is Point and torch.equal(out[0][4].x, t) and out[0][4].y == 2.5
+    assert out[0][5] is None
+
+
+@pytest.mark.parametrize("value", [[Scores(a=1)], [object()], [{1: "a"}], [{"__tensor__": "0"}]])
+def test_not_serializable(value):
+    with pytest.raises(NotSerializable):
+        serialize_value(value)
+
+
+def test_get_and_set(tmp_path):
+    cache = DiskCache(str(tmp_path), 1024 * 1024)
+    value = [[torch.arange(10)]]
+    assert cache.get("a" * 64) is None
+    cache.set("a" * 64, value)
+    cache.set("b" * 64, [[Scores()]])
+    cache.flush()
+    assert torch.equal(cache.get("a" * 64)[0][0], torch.arange(10))
+    assert cache.get("b" * 64) is None
+    # Unhashable keys are never stored
+    cache.set(object(), value)
+    stats = cache.get_stats()
+    assert stats["writes"] == 1 and stats["hits"] == 1 and stats["misses"] == 2
+
+    # Another instance on the same directory sees the entry
+    assert DiskCache(str(tmp_path), 1024 * 1024).get("a" * 64) is not None
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    entry = [[torch.zeros(64 * 1024, dtype=torch.uint8)]]
+    cache = DiskCache(str(tmp_path), 200 * 1024)
+    keys = [c * 64 for c in "abcd"]
+    for i, key in enumerate(keys[:3]):
+        cache.set(key, entry)
+        cache.flush()
+        os.utime(cache._path(key), (1000 + i, 1000 + i))
+    # Reading a refreshes it
+    assert cache.get(keys[0]) is not None
+    cache.set(keys[3], entry)
+    cache.flush()
+    assert os.path.exists(cache._path(keys[0]))
+    assert not os.path.exists(cache._path(keys[1]))
+    assert os.path.exists(cache._path(keys[3]))
+    assert cache.get_stats()["bytes"] <= 200 * 1024
+
+
+def test_file_lock_is_exclusive(tmp_path):
+    lock = FileLock(str(tmp_path / ".lock"))
+    inside = []
+    overlaps = []
+
+    def worker():
+        for _ in range(20):
+            with lock:
+                inside.append(1)
+                if len(inside) > 1:
+                    overlaps.append(1)
+                time.sleep(0.0005)
+                inside.pop()
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert overlaps == []
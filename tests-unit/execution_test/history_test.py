@@ -0,0 +1,91 @@
+import pytest
+from comfy_execution.history import MemoryHistoryStore, SQLiteHistoryStore
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_store(request, tmp_path):
+    def make(max_size=100):
+        if request.param == "memory":
+            return MemoryHistoryStore(max_size)
+        return SQLiteHistoryStore(str(tmp_path / "history.sqlite3"), max_size)
+    return make
+
+
+def fill(store, count):
+    for i in range(count):
+        store.put("p{}".format(i), {"outputs": {"i": i}}, float(i), "success" if i % 2 == 0 else "error")
+
+
+def test_get(make_store):
+    store = make_store()
+    fill(store, 3)
+    assert store.get("p1") == {"outputs": {"i": 1}}
+    assert store.get("missing") is None
+
+
+def test_max_size(make_store):
+    store = make_store(max_size=5)
+    fill(store, 8)
+    assert len(store) == 5
+    assert store.get("p2") is None
+    assert list(store.query()[0]) == ["p3", "p4", "p5", "p6", "p7"]
+
+
+def test_max_items_and_offset(make_store):
+    store = make_store()
+    fill(store, 6)
+    # Without offset the newest items are returned, oldest first
+    assert list(store.query(max_items=2)[0]) == ["p4", "p5"]
+    assert list(store.query(max_items=2, offset=1)[0]) == ["p1", "p2"]
+
+
+def test_cursor_pagination(make_store):
+    store = make_store()
+    fill(store, 5)
+    pages = []
+    cursor = None
+    while True:
+        page, cursor = store.query(max_items=2, before=cursor)
+        pages.append(list(page))
+        if cursor is None:
+            break
+    assert pages == [["p3", "p4"], ["p1", "p2"], ["p0"]]
+
+
+def test_filters(make_store):
+    store = make_store()
+    fill(store, 6)
+    assert list(store.query(status="error")[0]) == ["p1", "p3", "p5"]
+    assert list(store.query(since=2.0, until=4.0)[0]) == ["p2", "p3", "p4"]
+
+
+def test_delete_and_wipe(make_store):
+    store = make_store()
+    fill(store, 3)
+    store.delete("p1")
+    assert list(store.query()[0]) == ["p0", "p2"]
+    store.wipe()
+    assert len(store) == 0
+    assert store.query()[0] == {}
+
+
+def test_sqlite_persists(tmp_path):
+    path = str(tmp_path / "history.sqlite3")
+    fill(SQLiteHistoryStore(path, 100), 3)
+    store = SQLiteHistoryStore(path, 100)
+    assert len(store) == 3
+    assert store.get("p2") == {"outputs": {"i": 2}}
+
+
+def test_sqlite_stores_entries_that_arent_json(tmp_path):
+    store = SQLiteHistoryStore(str(tmp_path / "history.sqlite3"), 100)
+    store.put("p0", {"outputs": {"1": {"value": object()}}, "status": {"completed": True}}, 0.0, "success")
+    entry = store.get("p0")
+    assert isinstance(entry["outputs"]["1"]["value"], str)
+    assert entry["status"] == {"completed": True}
+
+    circular = {"outputs": {}, "status": {"completed": True}}
+    circular["outputs"]["self"] = circular
+    store.put("p1", circular, 1.0, "success")
+    assert store.get("p1") == {"outputs": {}, "status": {"completed": True}}
+    assert len(store) == 2
@@ -0,0 +1,93 @@
+import hashlib
+
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+from comfy_execution import caching  # noqa: E402
+from comfy_execution.caching import CacheKeySetInputSignature, NotHashable, Unhashable, update_hash  # noqa: E402
+from comfy_execution.graph import DynamicPrompt  # noqa: E402
+
+
+class IsChanged:
+    def get(self, node_id):
+        return None
+
+
+def prompt(width=512, seed=1):
+    return {
+        "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "model.safetensors"}},
+        "2": {"class_type": "EmptyLatentImage", "inputs": {"width": width, "height": 512, "batch_size": 1}},
+        "3": {"class_type": "KSampler", "inputs": {"model": ["1", 0], "latent_image": ["2", 0], "seed": seed, "steps": 20, "cfg": 8.0,
+                                                   "sampler_name": "euler", "scheduler": "normal", "denoise": 1.0, "positive": ["4", 0], "negative": ["4", 0]}},
+        "4": {"class_type": "CLIPTextEncode", "inputs": {"clip": ["1", 1], "text": "a cat"}},
+    }
+
+
+def keys(p):
+    key_set = CacheKeySetInputSignature(DynamicPrompt(p), list(p.keys()), IsChanged())
+    return {node_id: key_set.get_data_key(node_id) for node_id in p}
+
+
+def digest(value):
+    h = hashlib.sha256()
+    update_hash(h, value)
+    return h.hexdigest()
+
+
+def test_changes_propagate_to_descendants_only():
+    base = keys(prompt())
+    assert base == keys(prompt())
+    changed = keys(prompt(width=768))
+    assert changed["1"] == base["1"] and changed["4"] == base["4"]
+    assert changed["2"] != base["2"] and changed["3"] != base["3"]
+    seed = keys(prompt(seed=2))
+    assert seed["2"] == base["2"] and seed["3"] != base["3"]
+
+
+def test_ancestor_digests_are_computed_once(monkeypatch):
+    calls = []
+    original = CacheKeySetInputSignature.get_immediate_node_signature
+
+    def counting(self, dynprompt, node_id):
+        calls.append(node_id)
+        return original(self, dynprompt, node_id)
+
+    monkeypatch.setattr(CacheKeySetInputSignature, "get_immediate_node_signature", counting)
+    keys(prompt())
+    assert sorted(calls) == ["1", "2", "3", "4"]
+
+
+def test_tensor_hashing():
+    t = torch.arange(6, dtype=torch.float32).view(2, 3)
+    assert digest(t) == digest(t.clone())
+    assert digest(t) != digest(t.view(3, 2))
+    assert digest(t) != digest(t.half())
+    assert digest(t) != digest(t + 1)
+    # Non contiguous views hash their values
+    assert digest(t.t()) == digest(t.t().contiguous())
+
+
+def test_unhashable_inputs_propagate():
+    p = prompt()
+    p["2"]["inputs"]["width"] = float("nan")
+    k = keys(p)
+    assert isinstance(k["2"], Unhashable) and isinstance(k["3"], Unhashable)
+    assert isinstance(k["1"], str)
+    # Unhashable keys never match each other
+    assert keys(p)["3"] != k["3"]
+    with pytest.raises(NotHashable):
+        digest(object())
+
+
+def test_model_file_version_is_part_of_the_key(monkeypatch):
+    versions = {"model.safetensors": (100, 1)}
+    monkeypatch.setattr(caching, "model_file_version", lambda folder_name, filename: versions[filename])
+    base = keys(prompt())
+    versions["model.safetensors"] = (100, 2)
+    changed = keys(prompt())
+    assert changed["1"] != base["1"] and changed["3"] != base["3"]
+    assert changed["2"] == base["2"]
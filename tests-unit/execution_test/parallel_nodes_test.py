@@ -0,0 +1,134 @@
+import threading
+
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import execution  # noqa: E402
+import nodes  # noqa: E402
+
+
+class FakeServer:
+    def __init__(self):
+        self.client_id = None
+        self.last_node_id = None
+        self.last_prompt_id = None
+        self.messages = []
+        self.thread_contexts = {}
+
+    def send_sync(self, event, data, sid=None):
+        self.messages.append((event, data))
+
+    def set_thread_execution_context(self, client_id, last_prompt_id, last_node_id):
+        self.thread_contexts[last_node_id] = (client_id, last_prompt_id, threading.current_thread().name)
+
+
+events = []
+fast_done = threading.Event()
+
+
+class SlowLoad:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"value": ("INT", {})}}
+
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "load"
+    THREAD_SAFE = True
+
+    def load(self, value):
+        # Only returns in time if the main loop keeps going while this runs
+        finished = fast_done.wait(timeout=10)
+        events.append(("slow", finished))
+        return (value,)
+
+
+class Fast:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"value": ("INT", {})}}
+
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "run"
+
+    def run(self, value):
+        events.append(("fast", value))
+        fast_done.set()
+        return (value,)
+
+
+class Consumer:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"value": ("INT", {})}}
+
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "run"
+    OUTPUT_NODE = True
+
+    def run(self, value):
+        events.append(("consumer", value))
+        return (value,)
+
+
+@pytest.fixture
+def node_classes(monkeypatch):
+    events.clear()
+    fast_done.clear()
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TestSlowLoad", SlowLoad)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TestFast", Fast)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TestConsumer", Consumer)
+
+
+PROMPT = {
+    "1": {"class_type": "TestSlowLoad", "inputs": {"value": 7}},
+    "2": {"class_type": "TestFast", "inputs": {"value": 3}},
+    "3": {"class_type": "TestConsumer", "inputs": {"value": ["1", 0]}},
+    "4": {"class_type": "TestConsumer", "inputs": {"value": ["2", 0]}},
+}
+
+
+def run_prompt(parallel_workers, client_id=None):
+    server = FakeServer()
+    executor = execution.PromptExecutor(server, parallel_workers=parallel_workers)
+    extra_data = {} if client_id is None else {"client_id": client_id}
+    # The slow node is staged before the fast one
+    executor.execute(PROMPT, "prompt", extra_data, ["3", "4"])
+    return executor, server
+
+
+def test_thread_safe_node_runs_in_background(node_classes):
+    executor, _ = run_prompt(parallel_workers=1)
+    assert executor.success
+    assert events.index(("fast", 3)) < events.index(("slow", True))
+    assert sorted(events) == [("consumer", 3), ("consumer", 7), ("fast", 3), ("slow", True)]
+    assert executor.caches.outputs.get("3") == [[7]]
+
+
+def test_dependents_wait_for_background_node(node_classes):
+    executor, _ = run_prompt(parallel_workers=1)
+    # The consumer is an output node and is preferred, but only runs once the slow node is done
+    assert events.index(("consumer", 7)) > events.index(("slow", True))
+    assert executor.caches.outputs.get("1") == [[7]]
+
+
+def test_without_workers_nodes_run_in_order(node_classes):
+    fast_done.set()
+    executor, _ = run_prompt(parallel_workers=0)
+    assert executor.success
+    assert events == [("slow", True), ("consumer", 7), ("fast", 3), ("consumer", 3)]
+
+
+def test_background_node_gets_its_own_context(node_classes):
+    executor, server = run_prompt(parallel_workers=1, client_id="client")
+    assert executor.success
+    client_id, _, thread_name = server.thread_contexts["1"]
+    assert client_id == "client"
+    assert thread_name.startswith("node_worker")
+    executing = [data["node"] for event, data in server.messages if event == "executing"]
+    assert executing[:2] == ["1", "2"]
+    assert sorted(executing) == ["1", "2", "3", "4"]
+    assert server.last_node_id is None
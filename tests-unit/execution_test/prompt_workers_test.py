@@ -0,0 +1,132 @@
+import threading
+
+import pytest
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.model_management  # noqa: E402
+import comfy.model_patcher  # noqa: E402
+import execution  # noqa: E402
+
+
+class FakeServer:
+    def queue_updated(self):
+        pass
+
+
+def make_item(number, prompt_id, model_file):
+    prompt = {"1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": model_file}}}
+    return (number, prompt_id, prompt, {}, ["1"])
+
+
+def run_in_thread(fn):
+    result = {}
+    def run():
+        try:
+            result["value"] = fn()
+        except Exception as e:
+            result["error"] = e
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    return result
+
+
+@pytest.fixture(autouse=True)
+def clean_interrupts():
+    yield
+    comfy.model_management.interrupted_prompts.clear()
+    comfy.model_management.interrupt_current_processing(False)
+
+
+def check_interrupt(prompt_ids):
+    def check():
+        comfy.model_management.set_interrupt_scope(prompt_ids)
+        comfy.model_management.throw_exception_if_processing_interrupted()
+    return check
+
+
+def test_interrupt_only_stops_its_prompt():
+    comfy.model_management.interrupt_current_processing(prompt_id="a")
+    assert isinstance(run_in_thread(check_interrupt(["a"])).get("error"), comfy.model_management.InterruptProcessingException)
+    assert "error" not in run_in_thread(check_interrupt(["b"]))
+    # The interrupt is consumed once it was raised
+    assert "error" not in run_in_thread(check_interrupt(["a"]))
+
+
+def test_interrupt_stops_batched_prompts():
+    comfy.model_management.interrupt_current_processing(prompt_id="b")
+    assert isinstance(run_in_thread(check_interrupt(["a", "b"])).get("error"), comfy.model_management.InterruptProcessingException)
+
+
+def test_processing_interrupted_is_scoped():
+    comfy.model_management.interrupt_current_processing(prompt_id="a")
+    def interrupted(prompt_ids):
+        def check():
+            comfy.model_management.set_interrupt_scope(prompt_ids)
+            return comfy.model_management.processing_interrupted()
+        return check
+    assert run_in_thread(interrupted(["a"]))["value"]
+    assert not run_in_thread(interrupted(["b"]))["value"]
+    assert not run_in_thread(interrupted([]))["value"]
+
+
+def test_global_interrupt_still_applies():
+    comfy.model_management.interrupt_current_processing()
+    assert isinstance(run_in_thread(check_interrupt([])).get("error"), comfy.model_management.InterruptProcessingException)
+
+
+def test_loaded_model_files_does_not_wait_for_loads():
+    # Another worker picking the models to unload holds the lock
+    with comfy.model_management.model_management_lock:
+        result = run_in_thread(lambda: comfy.model_management.loaded_model_files(torch.device("cpu")))
+    assert result["value"] == set()
+
+
+def test_affinity_picks_prompt_using_loaded_model():
+    q = execution.PromptQueue(FakeServer())
+    q.put(make_item(0, "first", "a.safetensors"))
+    q.put(make_item(1, "second", "b.safetensors"))
+    item, _ = q.get(affinity=lambda item: item[2]["1"]["inputs"]["ckpt_name"] == "b.safetensors")
+    assert item[1] == "second"
+    item, _ = q.get(affinity=lambda item: False)
+    assert item[1] == "first"
+
+
+def test_every_worker_sees_the_flags():
+    q = execution.PromptQueue(FakeServer())
+    workers = [q.register_worker() for _ in range(2)]
+    q.set_flag("free_memory", True)
+    assert q.get_flags(worker=workers[0]) == {"free_memory": True}
+    assert q.get_flags(worker=workers[0]) == {}
+    assert q.get_flags(reset=False, worker=workers[1]) == {"free_memory": True}
+    assert q.get_flags(worker=workers[1]) == {"free_memory": True}
+    assert q.get_flags(worker=workers[1]) == {}
+
+
+def test_weights_are_copied_without_the_lock(monkeypatch):
+    patcher = comfy.model_patcher.ModelPatcher(torch.nn.Linear(4, 4), torch.device("cpu"), torch.device("cpu"))
+    lock_free = []
+
+    def take_lock():
+        if not comfy.model_management.model_management_lock.acquire(timeout=1):
+            return False
+        comfy.model_management.model_management_lock.release()
+        return True
+
+    model_load = comfy.model_management.LoadedModel.model_load
+    def checked_model_load(self, *args, **kwargs):
+        # Another device's worker can take the lock meanwhile
+        lock_free.append(run_in_thread(take_lock)["value"])
+        return model_load(self, *args, **kwargs)
+    monkeypatch.setattr(comfy.model_management.LoadedModel, "model_load", checked_model_load)
+    try:
+        comfy.model_management.load_models_gpu([patcher])
+        assert lock_free == [True]
+        assert comfy.model_management.LoadedModel(patcher) in comfy.model_management.current_loaded_models
+    finally:
+        comfy.model_management.unload_all_models()
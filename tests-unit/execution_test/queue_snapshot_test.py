@@ -0,0 +1,76 @@
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import execution  # noqa: E402
+
+
+class FakeServer:
+    def __init__(self):
+        self.updates = 0
+
+    def queue_updated(self):
+        self.updates += 1
+
+
+def make_item(number, prompt_id):
+    return (number, prompt_id, {"1": {"class_type": "EmptyLatentImage", "inputs": {}}}, {"client_id": "client"}, ["1"])
+
+
+def make_queue(count):
+    q = execution.PromptQueue(FakeServer())
+    for i in range(count):
+        q.put(make_item(i, "p{}".format(i)))
+    return q
+
+
+def test_snapshot():
+    q = make_queue(3)
+    _, task_id = q.get()
+    snapshot = q.get_queue_snapshot()
+    assert snapshot["version"] == 4
+    assert snapshot["queue_running"] == [{"number": 0, "prompt_id": "p0", "client_id": "client", "outputs_to_execute": ["1"], "task_id": task_id}]
+    assert [item["prompt_id"] for item in snapshot["queue_pending"]] == ["p1", "p2"]
+
+
+def test_snapshot_with_prompts():
+    q = make_queue(2)
+    snapshot = q.get_queue_snapshot(include_prompts=True)
+    assert snapshot["queue_running"] == []
+    assert snapshot["queue_pending"] == [make_item(0, "p0"), make_item(1, "p1")]
+
+
+def test_changes_since_version():
+    q = make_queue(2)
+    version = q.get_queue_snapshot()["version"]
+    q.get()
+    q.delete_queue_item(lambda item: item[1] == "p1")
+    q.put(make_item(5, "p5"))
+    changes = q.get_queue_changes(version)
+    assert [(c["version"], c["action"], c["prompt_id"]) for c in changes] == [(3, "started", "p0"), (4, "removed", "p1"), (5, "added", "p5")]
+    assert "task_id" in changes[0]
+    assert q.get_queue_changes(q.get_queue_snapshot()["version"]) == []
+    assert q.server.updates == 5
+
+
+def test_changes_from_the_start():
+    q = make_queue(2)
+    assert [c["version"] for c in q.get_queue_changes(0)] == [1, 2]
+
+
+def test_changes_from_the_future():
+    q = make_queue(2)
+    assert q.get_queue_changes(3) is None
+
+
+def test_changes_after_log_overflow(monkeypatch):
+    monkeypatch.setattr(execution, "QUEUE_CHANGE_LOG_SIZE", 4)
+    q = make_queue(6)
+    # Versions 1 and 2 dropped out of the log
+    assert q.get_queue_changes(0) is None
+    assert q.get_queue_changes(1) is None
+    assert [c["version"] for c in q.get_queue_changes(2)] == [3, 4, 5, 6]
+    q.wipe_queue()
+    assert [c["action"] for c in q.get_queue_changes(5)] == ["added", "cleared"]
@@ -0,0 +1,95 @@
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+from comfy_execution.caching import CacheKeySet, RAMBudget, RAMBudgetCache, estimate_size  # noqa: E402
+
+
+class NodeIdKeySet(CacheKeySet):
+    def __init__(self, dynprompt, node_ids, is_changed_cache):
+        super().__init__(dynprompt, node_ids, is_changed_cache)
+        self.add_keys(node_ids)
+
+    def add_keys(self, node_ids):
+        for node_id in node_ids:
+            self.keys[node_id] = node_id
+
+
+MB = 1024 * 1024
+
+
+def output(megabytes):
+    return [[torch.zeros(megabytes * MB, dtype=torch.uint8)]]
+
+
+def run(cache, node_ids, values=None):
+    """A prompt using node_ids, the ones in values are computed and cached."""
+    cache.set_prompt(None, node_ids, None)
+    for node_id in node_ids:
+        if cache.get(node_id) is None and values is not None and node_id in values:
+            cache.set(node_id, values[node_id])
+    cache.clean_unused()
+
+
+def test_estimate_size():
+    t = torch.zeros(MB, dtype=torch.uint8)
+    assert estimate_size(t) == MB
+    # Views of the same storage are only counted once
+    assert MB <= estimate_size([[t, t[:10]]]) < MB + 1024
+    assert estimate_size({"samples": torch.zeros(4, 4)}) >= 64
+
+
+def test_eviction_keeps_current_prompt_and_budget():
+    cache = RAMBudgetCache(NodeIdKeySet, max_bytes=3 * MB)
+    run(cache, ["a", "b"], {"a": output(1), "b": output(1)})
+    assert cache.total_bytes >= 2 * MB
+
+    run(cache, ["c", "d"], {"c": output(1), "d": output(1)})
+    # The entries of the running prompt stay, older ones go to stay under the budget
+    assert cache.budget.total_bytes <= 3 * MB + 1024
+    run(cache, ["c", "d"])
+    assert cache.get("c") is not None and cache.get("d") is not None
+
+    # The current prompt alone can go over the budget
+    run(cache, ["e", "f", "g", "h"], {n: output(1) for n in "efgh"})
+    assert all(cache.get(n) is not None for n in "efgh")
+    assert cache.get_stats()["evictions"] >= 3
+
+
+def test_cheap_to_recompute_entries_are_evicted_first(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("comfy_execution.caching.time.perf_counter", lambda: now[0])
+    cache = RAMBudgetCache(NodeIdKeySet, max_bytes=2 * MB + MB // 2)
+
+    def compute(node_id, seconds):
+        cache.set_prompt(None, [node_id], None)
+        assert cache.get(node_id) is None
+        now[0] += seconds
+        cache.set(node_id, output(1))
+        cache.clean_unused()
+
+    compute("slow", 10.0)
+    compute("fast", 0.01)
+    compute("new", 1.0)
+    run(cache, ["slow", "fast"])
+    assert cache.get("slow") is not None
+    assert cache.get("fast") is None
+
+
+def test_stats_and_shared_budget():
+    budget = RAMBudget(3 * MB)
+    outputs = RAMBudgetCache(NodeIdKeySet, budget=budget)
+    ui = RAMBudgetCache(NodeIdKeySet, budget=budget)
+    run(outputs, ["a", "b"], {"a": output(1), "b": output(1)})
+    run(ui, ["a"], {"a": output(1)})
+    run(outputs, ["a", "b"])
+    stats = outputs.get_stats()
+    assert stats["hits"] == 2 and stats["misses"] == 2
+    assert stats["entries"] == 2
+
+    # Both caches together stay under the budget
+    run(ui, ["c"], {"c": output(1)})
+    assert budget.total_bytes == outputs.total_bytes + ui.total_bytes
+    assert budget.total_bytes <= 3 * MB + 2048
@@ -0,0 +1,67 @@
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.model_management  # noqa: E402
+from comfy_execution import residency  # noqa: E402
+
+
+class FakeLoader:
+    MODEL_FILE_INPUTS = {"ckpt_name": "checkpoints"}
+
+
+class FakeQueue:
+    def __init__(self, running, pending):
+        self.running = running
+        self.pending = pending
+
+    def get_current_queue(self):
+        return self.running, self.pending
+
+
+def item(number, ckpt):
+    prompt = {
+        "1": {"class_type": "FakeLoader", "inputs": {"ckpt_name": ckpt}},
+        "2": {"class_type": "KSampler", "inputs": {"model": ["1", 0], "seed": 1}},
+    }
+    return (number, "prompt{}".format(number), prompt, {}, ["2"])
+
+
+def setup(monkeypatch):
+    monkeypatch.setitem(residency.nodes.NODE_CLASS_MAPPINGS, "FakeLoader", FakeLoader)
+    monkeypatch.setattr(residency.folder_paths, "get_full_path", lambda folder, name: "/models/{}/{}".format(folder, name))
+    monkeypatch.setattr(residency, "read_ahead", lambda path: None)
+    monkeypatch.setattr(comfy.model_management, "upcoming_model_files", {})
+
+
+def test_prompt_model_files(monkeypatch):
+    setup(monkeypatch)
+    assert residency.prompt_model_files(item(0, "a.safetensors")[2]) == ["/models/checkpoints/a.safetensors"]
+
+
+def test_plan_ranks_files_by_next_use(monkeypatch):
+    setup(monkeypatch)
+    queue = FakeQueue([item(0, "a.safetensors")], [item(3, "a.safetensors"), item(2, "c.safetensors"), item(1, "b.safetensors")])
+    planner = residency.ResidencyPlanner()
+    planner.plan(queue)
+    assert comfy.model_management.upcoming_model_files == {
+        "/models/checkpoints/a.safetensors": 0,
+        "/models/checkpoints/b.safetensors": 1,
+        "/models/checkpoints/c.safetensors": 2,
+    }
+
+
+def test_plan_reads_ahead_once(monkeypatch):
+    setup(monkeypatch)
+    read = []
+    monkeypatch.setattr(residency, "read_ahead", read.append)
+    planner = residency.ResidencyPlanner()
+    queue = FakeQueue([item(0, "a.safetensors")], [item(1, "b.safetensors")])
+    planner.plan(queue)
+    planner.plan(queue)
+    assert read == ["/models/checkpoints/b.safetensors"]
+    # Prompts that left the queue are forgotten
+    planner.plan(FakeQueue([item(1, "b.safetensors")], []))
+    assert list(planner.prompt_files) == ["prompt1"]
@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import utils.json_util  # noqa: E402, F401 - before nodes puts comfy/ on sys.path
+import comfy.model_management  # noqa: E402
+import folder_paths  # noqa: E402
+import execution  # noqa: E402
+import server  # noqa: E402
+
+pytestmark = (
+    pytest.mark.asyncio
+)  # This applies the asyncio mark to all test functions in the module
+
+
+def make_item(number, prompt_id):
+    return (number, prompt_id, {"1": {"class_type": "EmptyLatentImage", "inputs": {}}}, {}, ["1"])
+
+
+@pytest_asyncio.fixture
+async def prompt_server(tmp_path, monkeypatch):
+    (tmp_path / "web").mkdir()
+    monkeypatch.setattr(args, "front_end_root", str(tmp_path / "web"))
+    user_directory = folder_paths.get_user_directory()
+    folder_paths.set_user_directory(str(tmp_path / "user"))
+    previous = getattr(server.PromptServer, "instance", None)
+    try:
+        prompt_server = server.PromptServer(asyncio.get_running_loop())
+        execution.PromptQueue(prompt_server)
+        prompt_server.add_routes()
+        yield prompt_server
+    finally:
+        folder_paths.set_user_directory(user_directory)
+        server.PromptServer.instance = previous
+
+
+async def test_snapshot(aiohttp_client, prompt_server):
+    prompt_server.prompt_queue.put(make_item(0, "p0"))
+    client = await aiohttp_client(prompt_server.app)
+    resp = await client.get("/queue/snapshot")
+    assert resp.status == 200
+    data = await resp.json()
+    assert data["version"] == 1
+    assert [item["prompt_id"] for item in data["queue_pending"]] == ["p0"]
+    assert "prompt" not in data["queue_pending"][0]
+
+    resp = await client.get("/api/queue/snapshot?include_prompts=true")
+    data = await resp.json()
+    assert data["queue_pending"][0][1] == "p0"
+
+
+async def test_changes(aiohttp_client, prompt_server):
+    q = prompt_server.prompt_queue
+    q.put(make_item(0, "p0"))
+    client = await aiohttp_client(prompt_server.app)
+    q.put(make_item(1, "p1"))
+    resp = await client.get("/queue/changes?since=1")
+    data = await resp.json()
+    assert data["reset"] is False
+    assert data["version"] == 2
+    assert [c["prompt_id"] for c in data["changes"]] == ["p1"]
+
+    resp = await client.get("/queue/changes?since=2")
+    data = await resp.json()
+    assert data == {"reset": False, "version": 2, "changes": []}
+
+
+async def test_changes_gap_resets(aiohttp_client, prompt_server, monkeypatch):
+    monkeypatch.setattr(execution, "QUEUE_CHANGE_LOG_SIZE", 2)
+    prompt_server.prompt_queue = None
+    q = execution.PromptQueue(prompt_server)
+    for i in range(4):
+        q.put(make_item(i, "p{}".format(i)))
+    client = await aiohttp_client(prompt_server.app)
+    # Versions 1 and 2 dropped out of the log and a version that doesn't exist yet is also a gap
+    for since in (0, 1, 9):
+        resp = await client.get("/queue/changes?since={}".format(since))
+        data = await resp.json()
+        assert data["reset"] is True
+        assert data["version"] == 4
+        assert len(data["queue_pending"]) == 4
+    resp = await client.get("/queue/changes?since=2")
+    data = await resp.json()
+    assert [c["version"] for c in data["changes"]] == [3, 4]
+
+
+async def test_changes_needs_since(aiohttp_client, prompt_server):
+    client = await aiohttp_client(prompt_server.app)
+    resp = await client.get("/queue/changes")
+    assert resp.status == 400
+    resp = await client.get("/queue/changes?since=abc")
+    assert resp.status == 400
+
+
+async def test_interrupt(aiohttp_client, prompt_server):
+    client = await aiohttp_client(prompt_server.app)
+    try:
+        # Nothing registered as running, between the prompts of a batch for example
+        resp = await client.post("/interrupt")
+        assert resp.status == 200
+        assert comfy.model_management.processing_interrupted()
+        comfy.model_management.interrupt_current_processing(False)
+
+        prompt_server.prompt_queue.put(make_item(0, "p0"))
+        prompt_server.prompt_queue.get()
+        await client.post("/interrupt", json={"prompt_id": "other"})
+        assert comfy.model_management.interrupted_prompts == set()
+        await client.post("/interrupt", json={"prompt_id": "p0"})
+        assert comfy.model_management.interrupted_prompts == {"p0"}
+        assert not comfy.model_management.processing_interrupted()
+    finally:
+        comfy.model_management.interrupt_current_processing(False)
+        comfy.model_management.interrupted_prompts.clear()
@@ -0,0 +1,61 @@
+import asyncio
+import shutil
+import time
+
+import aiohttp
+import pytest
+import pytest_asyncio
+import torch
+
+from comfy.cli_args import args
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import utils.json_util  # noqa: E402, F401 - before nodes puts comfy/ on sys.path
+import folder_paths  # noqa: E402
+import server  # noqa: E402
+
+pytestmark = (
+    pytest.mark.asyncio
+)  # This applies the asyncio mark to all test functions in the module
+
+
+@pytest_asyncio.fixture
+async def prompt_server(tmp_path, monkeypatch):
+    (tmp_path / "web").mkdir()
+    (tmp_path / "input").mkdir()
+    monkeypatch.setattr(args, "front_end_root", str(tmp_path / "web"))
+    monkeypatch.setattr(folder_paths, "input_directory", str(tmp_path / "input"))
+    monkeypatch.setattr(folder_paths, "temp_directory", str(tmp_path / "temp"))
+    user_directory = folder_paths.get_user_directory()
+    folder_paths.set_user_directory(str(tmp_path / "user"))
+    previous = getattr(server.PromptServer, "instance", None)
+    try:
+        prompt_server = server.PromptServer(asyncio.get_running_loop())
+        prompt_server.add_routes()
+        yield prompt_server
+    finally:
+        folder_paths.set_user_directory(user_directory)
+        server.PromptServer.instance = previous
+
+
+async def test_concurrent_uploads_with_the_same_name(aiohttp_client, prompt_server, tmp_path, monkeypatch):
+    move = shutil.move
+    def slow_move(*args):
+        # Both uploads check the name before either is moved into place
+        time.sleep(0.2)
+        return move(*args)
+    monkeypatch.setattr(shutil, "move", slow_move)
+    client = await aiohttp_client(prompt_server.app)
+
+    async def upload(content):
+        data = aiohttp.FormData()
+        data.add_field("image", content, filename="image.png")
+        resp = await client.post("/upload/image", data=data)
+        assert resp.status == 200
+        return (await resp.json())["name"]
+
+    names = await asyncio.gather(upload(b"first"), upload(b"second"))
+    assert sorted(names) == ["image (1).png", "image.png"]
+    contents = {(tmp_path / "input" / name).read_bytes() for name in names}
+    assert contents == {b"first", b"second"}
@@ -0,0 +1,91 @@
+"""
+Per step overhead of sampling previews.
+
+Runs fake sampling steps (a few large matmuls) with the preview callback of latent_preview and reports the time per
+step without previews, with the previews decoded on every step before the step returns (how previews used to work)
+and with the background preview pipeline. TAESD uses random weights so no model files are needed. Example:
+
+    python tests/benchmarks/latent_preview.py --method taesd --size 1024 --steps 30
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", ".."))
+
+import comfy.options  # noqa: E402
+comfy.options.enable_args_parsing(False)
+
+import torch  # noqa: E402
+
+from comfy.cli_args import args  # noqa: E402
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.latent_formats  # noqa: E402
+import comfy.model_management  # noqa: E402
+import comfy.utils  # noqa: E402
+import latent_preview  # noqa: E402
+from comfy.taesd.taesd import TAESD  # noqa: E402
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def run(device, x0, steps, work, callback):
+    synchronize(device)
+    start = time.perf_counter()
+    for step in range(steps):
+        for _ in range(4):
+            work = work @ work
+            work = work / work.norm()
+        if callback is not None:
+            callback(step, x0, x0, steps)
+    synchronize(device)
+    return (time.perf_counter() - start) / steps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--method", choices=["latent2rgb", "taesd"], default="taesd")
+    parser.add_argument("--size", type=int, default=1024, help="Image size in pixels.")
+    parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--work", type=int, default=2048, help="Size of the matmuls standing in for the model.")
+    parser.add_argument("--interval", type=int, default=1)
+    parser.add_argument("--max-fps", type=float, default=args.preview_max_fps)
+    options = parser.parse_args()
+
+    device = comfy.model_management.get_torch_device()
+    latent_format = comfy.latent_formats.SDXL()
+    if options.method == "taesd":
+        previewer = latent_preview.TAESDPreviewerImpl(TAESD(None, None, latent_channels=latent_format.latent_channels).to(device))
+    else:
+        previewer = latent_preview.Latent2RGBPreviewer(latent_format.latent_rgb_factors, latent_format.latent_rgb_factors_bias)
+    x0 = torch.randn(1, latent_format.latent_channels, options.size // 8, options.size // 8, device=device)
+    work = torch.randn(options.work, options.work, device=device)
+
+    def synchronous_callback(step, x0, x, total_steps):
+        previewer.decode_latent_to_preview_image("JPEG", x0)
+
+    def pipeline_callback():
+        pipeline = latent_preview.PreviewPipeline(previewer, "JPEG", options.interval, options.max_fps)
+        def callback(step, x0, x, total_steps):
+            pipeline.take_preview()
+            pipeline.submit(step, x0)
+        return callback
+
+    # Warm up
+    run(device, x0, 2, work, synchronous_callback)
+    baseline = run(device, x0, options.steps, work, None)
+    print("device {}, {} previews of {}x{} images".format(device, options.method, options.size, options.size))  # noqa: T201
+    print("no previews: {:.1f} ms/step".format(baseline * 1000))  # noqa: T201
+    for name, callback in (("synchronous previews", synchronous_callback), ("preview pipeline", pipeline_callback())):
+        elapsed = run(device, x0, options.steps, work, callback)
+        print("{}: {:.1f} ms/step, {:+.1f} ms/step overhead".format(name, elapsed * 1000, (elapsed - baseline) * 1000))  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Speed and quality benchmark of comfy.step_cache.
+
+Samples the same prompt and seed with a checkpoint without the step cache and with each of the given thresholds,
+then reports the time taken and the PSNR of the decoded images against the uncached one. Example:
+
+    python tests/benchmarks/step_cache.py models/checkpoints/sd_xl_base_1.0.safetensors --thresholds 0.1 0.2 0.4
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", ".."))
+
+import comfy.options  # noqa: E402
+comfy.options.enable_args_parsing(False)
+
+import torch  # noqa: E402
+
+from comfy.cli_args import args  # noqa: E402
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.model_management  # noqa: E402
+import comfy.sample  # noqa: E402
+import comfy.sd  # noqa: E402
+import comfy.step_cache  # noqa: E402
+
+
+def encode(clip, text):
+    tokens = clip.tokenize(text)
+    return clip.encode_from_tokens_scheduled(tokens)
+
+
+def run(model, vae, positive, negative, latent, options):
+    noise = comfy.sample.prepare_noise(latent, options.seed)
+    device = comfy.model_management.get_torch_device()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    samples = comfy.sample.sample(model, noise, options.steps, options.cfg, options.sampler, options.scheduler, positive, negative, latent,
+                                  disable_pbar=True, seed=options.seed)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+    return elapsed, vae.decode(samples).float()
+
+
+def psnr(image, reference):
+    mse = torch.mean((image - reference) ** 2).item()
+    if mse == 0:
+        return float("inf")
+    return -10 * torch.log10(torch.tensor(mse)).item()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoint")
+    parser.add_argument("--prompt", default="a photograph of a lighthouse on a rocky coast at sunset, detailed")
+    parser.add_argument("--negative", default="blurry, low quality")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.1, 0.2, 0.3, 0.5])
+    parser.add_argument("--start-percent", type=float, default=0.1)
+    parser.add_argument("--end-percent", type=float, default=1.0)
+    parser.add_argument("--max-skipped", type=int, default=comfy.step_cache.MAX_SKIPPED)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--cfg", type=float, default=5.0)
+    parser.add_argument("--sampler", default="euler")
+    parser.add_argument("--scheduler", default="normal")
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args()
+
+    model, clip, vae, _ = comfy.sd.load_checkpoint_guess_config(options.checkpoint)
+    positive = encode(clip, options.prompt)
+    negative = encode(clip, options.negative)
+    latent = torch.zeros([1, 4, options.height // 8, options.width // 8])
+    latent = comfy.sample.fix_empty_latent_channels(model, latent)
+
+    # Warm up, the first run includes loading the model
+    run(model, vae, positive, negative, latent, options)
+    baseline_time, reference = run(model, vae, positive, negative, latent, options)
+    print("no cache: {:.2f}s".format(baseline_time))  # noqa: T201
+    for threshold in options.thresholds:
+        cached = comfy.step_cache.add_step_cache(model.clone(), threshold, options.start_percent, options.end_percent, options.max_skipped)
+        elapsed, image = run(cached, vae, positive, negative, latent, options)
+        print("threshold {}: {:.2f}s, {:.2f}x, PSNR {:.2f}dB".format(threshold, elapsed, baseline_time / elapsed, psnr(image, reference)))  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
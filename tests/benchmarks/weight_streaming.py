@@ -0,0 +1,93 @@
+"""
+Benchmark of lowvram sampling steps with and without comfy.weight_streaming.
+
+Runs a stack of linear layers, optionally with LoRA patches, with only a fraction of its weights
+loaded on the device and reports the time per step. Example:
+
+    python tests/benchmarks/weight_streaming.py --layers 40 --dim 4096 --loaded 0.25 --lora-rank 16
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", ".."))
+
+import comfy.options  # noqa: E402
+comfy.options.enable_args_parsing(False)
+
+import torch  # noqa: E402
+
+from comfy.cli_args import args  # noqa: E402
+if not torch.cuda.is_available():
+    args.cpu = True
+
+import comfy.model_management  # noqa: E402
+import comfy.model_patcher  # noqa: E402
+import comfy.ops  # noqa: E402
+
+
+class LayerStack(torch.nn.Module):
+    def __init__(self, layers, dim, dtype):
+        super().__init__()
+        self.layers = torch.nn.ModuleList([comfy.ops.disable_weight_init.Linear(dim, dim, dtype=dtype) for _ in range(layers)])
+        for p in self.parameters():
+            torch.nn.init.normal_(p, std=dim ** -0.5)
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+
+def run(patcher, device, loaded_memory, x, steps, streaming):
+    args.disable_weight_streaming = not streaming
+    patcher.load(device, lowvram_model_memory=loaded_memory)
+    with torch.inference_mode():
+        patcher.model(x)
+        comfy.model_management.soft_empty_cache()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        for _ in range(steps):
+            patcher.model(x)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        elapsed = (time.perf_counter() - start) / steps
+    patcher.unpatch_model(patcher.offload_device)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--layers", type=int, default=24)
+    parser.add_argument("--dim", type=int, default=3072)
+    parser.add_argument("--tokens", type=int, default=4096)
+    parser.add_argument("--loaded", type=float, default=0.25, help="Fraction of the weights loaded on the device.")
+    parser.add_argument("--lora-rank", type=int, default=0)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--dtype", choices=["float16", "bfloat16", "float32"], default="bfloat16")
+    options = parser.parse_args()
+
+    dtype = getattr(torch, options.dtype)
+    device = comfy.model_management.get_torch_device()
+    model = LayerStack(options.layers, options.dim, dtype)
+    patcher = comfy.model_patcher.ModelPatcher(model, device, torch.device("cpu"))
+    if options.lora_rank > 0:
+        patches = {}
+        for i in range(options.layers):
+            up = torch.randn(options.dim, options.lora_rank, dtype=dtype) * 0.01
+            down = torch.randn(options.lora_rank, options.dim, dtype=dtype) * 0.01
+            patches["layers.{}.weight".format(i)] = ("lora", (up, down, None, None, None, None))
+        patcher.add_patches(patches, 1.0)
+
+    loaded_memory = int(patcher.model_size() * options.loaded)
+    x = torch.randn(1, options.tokens, options.dim, dtype=dtype, device=device)
+    print("device {}, model {:.0f}MB, {:.0f}MB loaded".format(device, patcher.model_size() / (1024 * 1024), loaded_memory / (1024 * 1024)))  # noqa: T201
+    for streaming in (False, True):
+        elapsed = run(patcher, device, loaded_memory, x, options.steps, streaming)
+        print("streaming {}: {:.1f} ms/step".format("on " if streaming else "off", elapsed * 1000))  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()